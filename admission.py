@@ -0,0 +1,194 @@
+"""
+Admission control in front of the query endpoints.
+
+A pure ASGI middleware, so it costs one dict lookup per request instead of a
+BaseHTTPMiddleware wrapper, and its refusals are real responses (raising
+HTTPException from @app.middleware("http") turned the Tableau check into a
+500). In order, it:
+
+  1. requires ``X-Tableau-Extension: true`` (403 otherwise), except for
+     CORS preflight and the ``exempt`` paths (health, readiness, metrics);
+  2. on the ``limited`` paths, charges the client — its address, the first
+     X-Forwarded-For hop, never the body's ``client_id``, which the caller
+     can rotate at will — one token per request, or per item for a batch
+     (the body is buffered and replayed to the app). A body over
+     ``max_body`` gets 413 as soon as the limit is passed, so it is never
+     held in memory whole;
+  3. sheds with 429 + Retry-After, instead of queuing behind the pool and
+     the gunicorn timeout, when the worker already runs ``max_concurrent``
+     limited requests, the client already runs ``client_concurrent``, or the
+     client's / the worker's token bucket is empty.
+
+Every limit is per worker process; 0 turns it off. ``stats`` counts what was
+admitted and what was shed, by reason.
+"""
+import json
+import math
+import time
+
+from responses import dumps
+
+stats = {"admitted": 0, "forbidden": 0, "too_large": 0, "in_flight": 0, "clients": 0,
+         "shed": {"concurrency": 0, "client_concurrency": 0, "client_rate": 0, "rate": 0}}
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self, cost: float, now: float) -> float:
+        """Seconds until ``cost`` tokens are available (0 = now); doesn't take them."""
+        self._refill(now)
+        needed = min(cost, self.burst) - self.tokens
+        return 0.0 if needed <= 0 else needed / self.rate
+
+    def take(self, cost: float):
+        self.tokens -= min(cost, self.burst)
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class _Client:
+    __slots__ = ("in_flight", "bucket")
+
+    def __init__(self, bucket):
+        self.in_flight = 0
+        self.bucket = bucket
+
+
+async def _respond(send, status: int, body: dict, headers: list = ()):
+    payload = dumps(body)
+    await send({"type": "http.response.start", "status": status, "headers": [
+        (b"content-type", b"application/json"), (b"content-length", str(len(payload)).encode()), *headers]})
+    await send({"type": "http.response.body", "body": payload})
+
+
+class AdmissionMiddleware:
+    def __init__(self, app, limited=("/ai_query",), exempt=("/",), max_concurrent: int = 0,
+                 client_concurrent: int = 0, client_rate: float = 0, client_burst: float = 10,
+                 rate: float = 0, burst: float = 50, max_body: int = 1024 * 1024, max_clients: int = 10000):
+        self.app = app
+        self.limited = frozenset(limited)
+        self.exempt = frozenset(exempt)
+        self.max_concurrent = max_concurrent
+        self.client_concurrent = client_concurrent
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.bucket = TokenBucket(rate, burst) if rate > 0 else None
+        self.max_body = max_body
+        self.max_clients = max_clients
+        self._clients = {}  # client key -> _Client
+        self._in_flight = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "OPTIONS" or scope["path"] in self.exempt:
+            return await self.app(scope, receive, send)
+        headers = dict(scope["headers"])
+        if headers.get(b"x-tableau-extension") != b"true":
+            stats["forbidden"] += 1
+            return await _respond(send, 403, {"detail": "Unauthorized use"})
+        if scope["path"] not in self.limited:
+            return await self.app(scope, receive, send)
+
+        try:
+            declared = int(headers.get(b"content-length", 0))
+        except ValueError:
+            declared = 0
+        read = await self._read_body(receive) if declared <= self.max_body else None
+        if read is None:
+            stats["too_large"] += 1
+            return await _respond(send, 413, {"detail": f"Request body is larger than {self.max_body} bytes"})
+        messages, body = read
+        client_key, cost = self._identify(scope, headers, body)
+
+        now = time.monotonic()
+        client = self._clients.get(client_key)
+        if client is None:
+            client = self._clients[client_key] = _Client(
+                TokenBucket(self.client_rate, self.client_burst) if self.client_rate > 0 else None)
+            if len(self._clients) > self.max_clients:
+                self._prune(now)
+            stats["clients"] = len(self._clients)
+        if self.max_concurrent and self._in_flight >= self.max_concurrent:
+            return await self._shed(send, "concurrency", 1)
+        if self.client_concurrent and client.in_flight >= self.client_concurrent:
+            return await self._shed(send, "client_concurrency", 1)
+        wait = client.bucket.wait(cost, now) if client.bucket else 0.0
+        if wait:
+            return await self._shed(send, "client_rate", wait)
+        wait = self.bucket.wait(cost, now) if self.bucket else 0.0
+        if wait:
+            return await self._shed(send, "rate", wait)
+        if client.bucket:
+            client.bucket.take(cost)
+        if self.bucket:
+            self.bucket.take(cost)
+
+        async def replay():
+            return messages.pop(0) if messages else await receive()
+
+        stats["admitted"] += 1
+        self._in_flight += 1
+        client.in_flight += 1
+        stats["in_flight"] = self._in_flight
+        try:
+            await self.app(scope, replay, send)
+        finally:
+            self._in_flight -= 1
+            client.in_flight -= 1
+            stats["in_flight"] = self._in_flight
+
+    async def _read_body(self, receive):
+        """(messages to replay, body), or None once the body passes ``max_body``."""
+        messages, chunks, size = [], [], 0
+        while True:
+            message = await receive()
+            messages.append(message)
+            if message["type"] != "http.request":
+                break
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > self.max_body:
+                return None
+            chunks.append(chunk)
+            if not message.get("more_body"):
+                break
+        return messages, b"".join(chunks)
+
+    @staticmethod
+    def _identify(scope, headers: dict, body: bytes) -> tuple:
+        """(client key, tokens to charge): the address, and one token per batch item."""
+        cost = 1
+        try:
+            data = json.loads(body) if body else None
+        except ValueError:
+            data = None
+        if isinstance(data, dict) and isinstance(data.get("items"), list):  # /ai_query/batch
+            cost = max(len(data["items"]), 1)
+        # Behind App Service the peer is the front end; the first X-Forwarded-For hop is the browser
+        forwarded = headers.get(b"x-forwarded-for", b"").split(b",")[0].strip().decode("latin-1")
+        address = forwarded.rsplit(":", 1)[0] if forwarded.count(":") == 1 else forwarded
+        return f"{address or (scope.get('client') or ('?',))[0]}", cost
+
+    def _prune(self, now: float):
+        idle = [key for key, c in self._clients.items() if c.in_flight == 0 and (c.bucket is None or c.bucket.full(now))]
+        for key in idle:
+            del self._clients[key]
+        stats["clients"] = len(self._clients)
+
+    async def _shed(self, send, reason: str, retry_after: float):
+        stats["shed"][reason] += 1
+        seconds = max(1, math.ceil(retry_after))
+        await _respond(send, 429, {"detail": "Too many requests, please retry shortly", "reason": reason},
+                       [(b"retry-after", str(seconds).encode())])
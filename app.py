@@ -1,21 +1,43 @@
 from pydantic import BaseModel
 from fastapi import FastAPI, Request, HTTPException
-import pyodbc
-from azure.identity import DefaultAzureCredential #pip install azure-identity
-from azure.identity import AzureCliCredential
-import struct
-import platform
-pyodbc.pooling = True # Testing True
-import time
+import asyncio
+import hmac
 import logging
+import math
 import os
+import threading
+from contextlib import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware 
-from openai import AzureOpenAI
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+import openai
+from openai import AsyncAzureOpenAI
 import httpx
 import re
-from datetime import datetime, date, timedelta
-import calendar
-from typing import Optional
+from datetime import datetime, date, timedelta, timezone
+from typing import List, Optional
+import db_pool
+from db_pool import get_db_connection, get_pool, run_db, shutdown_db
+from token_cache import OPENAI_SCOPE, get_broker
+from cache import LRUCache, ResultCache, normalize_question
+from result_set import ResultSet
+from responses import CompressionMiddleware, FastJSONResponse, dumps
+import sql_templates
+import rollup
+from filter_matcher import ValueMatcher, expand_abbreviations
+from date_parser import parse_date_from_query
+import sql_prompt
+import sql_governor
+import partition_pruning
+import local_summary
+import metrics
+from metrics import annotate, span
+from log_writer import QUERY_LOG_SQL, QUESTION_SQL, get_log_writer
+from single_flight import SingleFlight
+from admission import AdmissionMiddleware
+import admission
+from warmup import Warmup
+import shared_cache
+import resilience
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("app")
@@ -25,7 +47,51 @@ for var in ["HTTP_PROXY", "HTTPS_PROXY", "ALL_PROXY", "NO_PROXY"]:
     os.environ.pop(var, None)
 #That will prevent Azure’s system proxy from being passed into the client’s constructor.
 
-app = FastAPI()
+# --- Startup / shutdown ---
+# Each worker builds its clients and warms them (see warmup.py) before it
+# starts serving; shutdown flushes the audit log and closes everything.
+WARMUP = os.getenv("WARMUP", "1") == "1"
+warmup = Warmup(timeout=float(os.getenv("WARMUP_TIMEOUT", "30")),
+                retry_interval=float(os.getenv("WARMUP_RETRY_INTERVAL", "10")))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    get_openai_client()
+    if WARMUP:
+        await warmup.wait()
+    yield
+    await warmup.close()
+    await run_db(get_log_writer().close)  # flush queued audit rows before the pool closes
+    shutdown_db()
+    get_broker().close()
+    if http_client is not None:
+        await http_client.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
+
+# --- Response compression (see responses.py) ---
+# brotli or gzip for complete JSON bodies of at least COMPRESS_MIN_BYTES;
+# the SSE endpoints stream uncompressed.
+if os.getenv("RESPONSE_COMPRESSION", "1") == "1":
+    app.add_middleware(CompressionMiddleware, minimum_size=int(os.getenv("COMPRESS_MIN_BYTES", "1024")))
+
+# --- Tableau-only access and admission control (see admission.py) ---
+# Registered before CORS so that its 403/429 responses carry CORS headers
+# and the extension can read them. Limits are per worker; 0 disables one.
+app.add_middleware(
+    AdmissionMiddleware,
+    limited=("/ai_query", "/ai_query/stream", "/ai_query/batch"),
+    exempt=("/", "/ready", "/metrics"),  # Azure health/readiness checks and Prometheus scrapes
+    max_concurrent=int(os.getenv("ADMISSION_MAX_CONCURRENT", "64")),
+    client_concurrent=int(os.getenv("ADMISSION_CLIENT_CONCURRENT", "4")),
+    client_rate=float(os.getenv("ADMISSION_CLIENT_RATE", "1")),
+    client_burst=float(os.getenv("ADMISSION_CLIENT_BURST", "20")),
+    rate=float(os.getenv("ADMISSION_RATE", "0")),
+    burst=float(os.getenv("ADMISSION_BURST", "100")),
+    max_body=int(os.getenv("ADMISSION_MAX_BODY", str(1024 * 1024))),
+)
 
 origins = [
     "https://witty-bush-00501930f.3.azurestaticapps.net",  # static web app hostname
@@ -40,280 +106,43 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-#ensure Tableau-only access
-@app.middleware("http")
-async def require_tableau(request: Request, call_next):
-
-    # Allow CORS preflight and Azure health checks
-    if request.method == "OPTIONS" or request.url.path == "/":
-        return await call_next(request)
-
-    # Enforce Tableau-only header
-    tableau_flag = request.headers.get("X-Tableau-Extension")
-
-    if tableau_flag != "true":
-        raise HTTPException(
-            status_code=403,
-            detail="Unauthorized use"
-        )
+# --- Request timing (registered last, so it wraps the Tableau check too) ---
+app.add_middleware(metrics.TraceMiddleware)
 
-    return await call_next(request)
+# --- Dependency outages (see resilience.py) ---
+# An open circuit is a 503 with Retry-After rather than a 500 after a timeout.
+@app.exception_handler(resilience.CircuitOpen)
+async def circuit_open(request: Request, exc: resilience.CircuitOpen):
+    return JSONResponse(
+        {"detail": "A backing service is temporarily unavailable, please retry shortly", "service": exc.name},
+        status_code=503, headers={"Retry-After": str(max(1, math.ceil(exc.retry_after)))})
 
 # --- Healthcheck endpoint ---
+# Liveness: the process is up. Readiness: this worker has warmed up.
 @app.get("/")
 def healthcheck():
     return {"status": "ok"}
 
-# --- Helper functions ---
-def get_db_connection(retries=3, delay=3):
-    """
-    Returns a pyodbc connection to Azure SQL Database.
-    - Windows local: uses AzureCliCredential + token
-    - Linux / Azure App Service: uses DefaultAzureCredential + token
-    """
-    server = os.getenv("SQL_SERVER", "azsqlserverejcampaignmanager.database.windows.net")
-    database = os.getenv("SQL_DATABASE", "devazsqldbejcampaignmanager")
-
-
-    driver = "{ODBC Driver 17 for SQL Server}"
-    encrypt = "yes"
-    trust_cert = "no"
-
-    conn_str = (
-        f"Driver={driver};"
-        f"Server={server};"
-        f"Database={database};"
-        f"Encrypt={encrypt};TrustServerCertificate={trust_cert};"
-    )
-
-    for attempt in range(1, retries + 1):
-        try:
-            if platform.system() == "Windows":
-                # Windows local development
-                
-                credential = AzureCliCredential()
-                token = credential.get_token("https://database.windows.net/.default")
-
-                exptoken = b""
-                for i in bytes(token.token, "utf-8"):
-                    exptoken += bytes([i])
-                    exptoken += b"\0"
-                tokenstruct = struct.pack("=i", len(exptoken)) + exptoken
-
-                conn = pyodbc.connect(conn_str, attrs_before={1256: tokenstruct})
-                logger.info("✅ Connected successfully (Windows)")
-                return conn
-
-            else:
-                # Linux / Azure App Service (Managed Identity)
-                credential = DefaultAzureCredential()
-                token = credential.get_token("https://database.windows.net/.default")
-
-                # Encode UTF-16-LE and pack length prefix
-                access_token = token.token.encode("utf-16-le")
-                # =i = little-endian 4-byte integer (matches ODBC driver expectation)
-                # Without this length prefix, the driver reads memory incorrectly → segfault 139.
-                token_struct = struct.pack("=i", len(access_token)) + access_token
-
-                conn = pyodbc.connect(conn_str, attrs_before={1256: token_struct})
-                logger.info("✅ Connected successfully (Linux/Azure)")
-                return conn
-        except Exception as e:
-            logger.warning(f"⚠️ Connection attempt {attempt} failed: {e}")
-            if attempt < retries:
-                time.sleep(delay)
-            else:
-                logger.error("❌ All connection attempts failed.")
-                raise
+@app.get("/ready")
+async def readiness():
+    warmup.start()  # retries steps that failed, at most every WARMUP_RETRY_INTERVAL
+    # Breaker state is reported but doesn't fail readiness: taking every
+    # instance out of rotation for a shared outage would only add 502s.
+    status = {**warmup.status(), "breakers": resilience.status()}
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
 
+# --- Prometheus metrics ---
+@app.get("/metrics")
+def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
-def parse_date_from_query(query: str):
-    """Extract date range from natural language query"""
-    query_lower = query.lower()
-    today = date.today()
-    
-    # ==== MONTH DETECTION (most specific) ====
-    month_names = {
-        'january': 1, 'february': 2, 'march': 3, 'april': 4,
-        'may': 5, 'june': 6, 'july': 7, 'august': 8,
-        'september': 9, 'october': 10, 'november': 11, 'december': 12
-    }
-
-    # Normalize Unicode en/em dashes to ASCII hyphen for date range matching
-    query_for_dates = re.sub(r'[–—]', '-', query_lower)
-
-    # ==== NUMERIC DATE RANGE (most specific) e.g. "1/6/26 - 2/14/26" ====
-    numeric_range = re.search(
-        r'\b(\d{1,2})/(\d{1,2})/(\d{2,4})\s*-+\s*(\d{1,2})/(\d{1,2})/(\d{2,4})\b',
-        query_for_dates
-    )
-    if numeric_range:
-        def _y(s): y = int(s); return 2000 + y if y < 100 else y
-        return {"field": "date", "values": [
-            str(date(_y(numeric_range.group(3)), int(numeric_range.group(1)), int(numeric_range.group(2)))),
-            str(date(_y(numeric_range.group(6)), int(numeric_range.group(4)), int(numeric_range.group(5))))
-        ]}
-
-    # ==== WEEK RANGE same month e.g. "Mar 16-22, 2026" ====
-    week_range = re.search(
-        r'\b(january|february|march|april|may|june|july|august|september|october|november|december)'
-        r'\s+(\d{1,2})\s*-+\s*(\d{1,2}),?\s+(20\d{2})\b',
-        query_for_dates
-    )
-    if week_range:
-        m = month_names[week_range.group(1)]
-        y = int(week_range.group(4))
-        return {"field": "date", "values": [
-            f"{y}-{m:02d}-{int(week_range.group(2)):02d}",
-            f"{y}-{m:02d}-{int(week_range.group(3)):02d}"
-        ]}
-
-    # ==== CROSS-MONTH DATE RANGE e.g. "Apr 8 - Jun 2, 2025" or "Jan 6, 2026 - Feb 14, 2026" ====
-    cross_month_range = re.search(
-        r'\b(january|february|march|april|may|june|july|august|september|october|november|december)'
-        r'\s+(\d{1,2})(?:,?\s+(20\d{2}))?\s*-+\s*'
-        r'(january|february|march|april|may|june|july|august|september|october|november|december)'
-        r'\s+(\d{1,2}),?\s+(20\d{2})\b',
-        query_for_dates
-    )
-    if cross_month_range:
-        end_year = int(cross_month_range.group(6))
-        start_year = int(cross_month_range.group(3)) if cross_month_range.group(3) else end_year
-        s_m = month_names[cross_month_range.group(1)]
-        e_m = month_names[cross_month_range.group(4)]
-        return {"field": "date", "values": [
-            f"{start_year}-{s_m:02d}-{int(cross_month_range.group(2)):02d}",
-            f"{end_year}-{e_m:02d}-{int(cross_month_range.group(5)):02d}"
-        ]}
-
-    # ==== MONTH-TO-MONTH RANGE e.g. "March 2026 and April 2026", "January and April 2026", "in 2026 between January and April" ====
-    month_range = re.search(
-        r'\b(january|february|march|april|may|june|july|august|september|october|november|december)'
-        r'(?:\s+(20\d{2}))?\s+(?:and|through|to|-)\s+'
-        r'(january|february|march|april|may|june|july|august|september|october|november|december)'
-        r'(?:\s+(20\d{2}))?\b',
-        query_for_dates
-    )
-    if month_range:
-        s_m = month_names[month_range.group(1)]
-        e_m = month_names[month_range.group(3)]
-        year_str = month_range.group(4) or month_range.group(2)
-        if not year_str:
-            y_match = re.search(r'\b(20\d{2})\b', query_for_dates)
-            year_str = y_match.group(1) if y_match else None
-        if year_str:
-            end_year = int(year_str)
-            start_year = int(month_range.group(2)) if month_range.group(2) else end_year
-            last_day = calendar.monthrange(end_year, e_m)[1]
-            return {"field": "date", "values": [
-                f"{start_year}-{s_m:02d}-01",
-                f"{end_year}-{e_m:02d}-{last_day:02d}"
-            ]}
-
-    # ==== MONTH DETECTION (month + year) ====
-    month_match = re.search(r'\b(january|february|march|april|may|june|july|august|september|october|november|december)\s+(20\d{2})\b', query_lower)
-    if month_match:
-        month_name = month_match.group(1)
-        month_num = month_names[month_name]
-        year = int(month_match.group(2))
-        
-        start_date = f"{year}-{month_num:02d}-01"
-        last_day = calendar.monthrange(year, month_num)[1]
-        end_date = f"{year}-{month_num:02d}-{last_day:02d}"
-        
-        return {
-            "field": "date",
-            "values": [start_date, end_date]
-        }
-    
-    # ==== QUARTER DETECTION ====
-    quarter_match = re.search(r'\b(q[1-4]|quarter\s+[1-4])\s+(20\d{2})\b', query_lower)
-    if quarter_match:
-        quarter = int(re.search(r'[1-4]', quarter_match.group(1)).group())
-        year = int(quarter_match.group(2))
-        
-        month_map = {1: 1, 2: 4, 3: 7, 4: 10}
-        start_month = month_map[quarter]
-        end_month = start_month + 2
-        
-        start_date = f"{year}-{start_month:02d}-01"
-        last_day = calendar.monthrange(year, end_month)[1]
-        end_date = f"{year}-{end_month:02d}-{last_day:02d}"
-        
-        return {
-            "field": "date",
-            "values": [start_date, end_date]
-        }
-    
-    # ==== RELATIVE DATES ====
-    if "last month" in query_lower:
-        if today.month == 1:
-            start_date = date(today.year - 1, 12, 1)
-        else:
-            start_date = date(today.year, today.month - 1, 1)
-        
-        end_date = date(today.year, today.month, 1) - timedelta(days=1)
-        
-        return {
-            "field": "date",
-            "values": [str(start_date), str(end_date)]
-        }
-    
-    if "last quarter" in query_lower:
-        current_quarter = (today.month - 1) // 3 + 1
-        if current_quarter == 1:
-            quarter = 4
-            year = today.year - 1
-        else:
-            quarter = current_quarter - 1
-            year = today.year
-        
-        month_map = {1: 1, 2: 4, 3: 7, 4: 10}
-        start_month = month_map[quarter]
-        end_month = start_month + 2
-        
-        start_date = f"{year}-{start_month:02d}-01"
-        last_day = calendar.monthrange(year, end_month)[1]
-        end_date = f"{year}-{end_month:02d}-{last_day:02d}"
-        
-        return {
-            "field": "date",
-            "values": [start_date, end_date]
-        }
-    
-    # ==== YEAR-TO-DATE ====
-    if "ytd" in query_lower or "year to date" in query_lower:
-        start_date = f"{today.year}-01-01"
-        end_date = str(today)
-        return {
-            "field": "date",
-            "values": [start_date, end_date]
-        }
-    
-    # ==== BARE MONTH (no year specified - default to most recent occurrence) ====
-    bare_month_match = re.search(r'\b(january|february|march|april|may|june|july|august|september|october|november|december)\b', query_lower)
-    if bare_month_match and not re.search(r'\b(20\d{2})\b', query_lower):
-        month_name = bare_month_match.group(1)
-        month_num = month_names[month_name]
-        # If the month has already passed or is current this year, use this year; otherwise last year
-        year = today.year if month_num <= today.month else today.year - 1
-        start_date = f"{year}-{month_num:02d}-01"
-        last_day = calendar.monthrange(year, month_num)[1]
-        end_date = f"{year}-{month_num:02d}-{last_day:02d}"
-        return {"field": "date", "values": [start_date, end_date]}
-
-    # ==== YEAR DETECTION (least specific - run last) ====
-    year_match = re.search(r'\b(20\d{2})\b', query_lower)
-    if year_match:
-        year = int(year_match.group(1))
-        start_date = f"{year}-01-01"
-        end_date = f"{year}-12-31"
-        return {
-            "field": "date",
-            "values": [start_date, end_date]
-        }
-    
-    return None
+# --- Helper functions ---
+# Precompiled patterns for extract_filters_from_query
+VIDEO_METRIC_RE = re.compile(r'\b(video views|video plays|video completion|vcr|video completes?|video completion rate)\b')
+LEADS_RE = re.compile(r'\bleads?\b')
+CPL_RE = re.compile(r'\b(cp lead|cost per lead|cpl)\b')
+VCR_RE = re.compile(r'\bvcr\b|\bvideo completion rate\b')
+CPCV_RE = re.compile(r'\bcpcv\b|\bcost per completed view\b')
 
 #enhanced filter extraction to include value prioritization and date ranges
 def extract_filters_from_query(user_query: str):
@@ -322,61 +151,30 @@ def extract_filters_from_query(user_query: str):
     query_lower = user_query.lower()
 
     # Expand Journey Phase abbreviations so PREA/PREF/EVA/EXP match the full FILTER_MAP values
-    query_normalized = re.sub(r'\bprea\b', 'pre-explore awareness', query_lower)
-    query_normalized = re.sub(r'\bpref\b', 'pre-explore familiarity', query_normalized)
-    query_normalized = re.sub(r'\bpre-a\b', 'pre-explore awareness', query_normalized)
-    query_normalized = re.sub(r'\bpre-f\b', 'pre-explore familiarity', query_normalized)
-    query_normalized = re.sub(r'\bexp\b', 'explore', query_normalized)
-    query_normalized = re.sub(r'\beva\b', 'evaluate', query_normalized)
-
-    # Extract standard categorical filters (your existing logic)
-    for field, values in FILTER_MAP.items():
-        if values == "RANGE":  # Skip range filters in value matching
-            continue
-
-        # ... your existing categorical filter matching logic ...
-        # (keep everything you currently have for Publisher, Platform, etc.)
-        sorted_values = sorted(values, key=lambda v: len(v or ""), reverse=True)
-
-        matched_values = []
-        matched_text = set()
-
-        for value in sorted_values:
-            if not value or value.lower() == "none":
-                continue
-
-            val_lower = value.lower()
-            pattern = r"\b" + re.escape(val_lower) + r"\b"
-
-            if re.search(pattern, query_normalized):
-                if any(val_lower in m for m in matched_text):
-                    continue
-
-                matched_values.append(value)
-                matched_text.add(val_lower)
-
+    query_normalized = expand_abbreviations(query_lower)
+
+    # Extract standard categorical filters in one pass over the query (see filter_matcher.py)
+    for field, matched_values in FILTER_MATCHER.match(query_normalized).items():
+        # Prevent "Video" channel from matching when the user is asking about a video metric
+        if field == "Channel" and "Video" in matched_values:
+            if VIDEO_METRIC_RE.search(query_lower):
+                matched_values.remove("Video")
         if matched_values:
-            # Prevent "Video" channel from matching when the user is asking about a video metric
-            if field == "Channel" and "Video" in matched_values:
-                video_metric_pattern = r'\b(video views|video plays|video completion|vcr|video completes?|video completion rate)\b'
-                if re.search(video_metric_pattern, query_lower):
-                    matched_values.remove("Video")
-            if matched_values:
-                filters[field] = matched_values
+            filters[field] = matched_values
 
     # NEW: Extract date range
     date_filter = parse_date_from_query(user_query)
     if date_filter:
         filters[date_filter["field"]] = date_filter["values"]
-        print(f"Detected date filter: {date_filter['values']}")
+        logger.debug(f"📅 Detected date filter: {date_filter['values']}")
 
     # Measure Names filter — only for metrics not shown by default in the dashboard.
     measure_names = []
     # Leads: excluded from default view; add when asked (but not for CPL/cost per lead queries)
-    if re.search(r'\bleads?\b', query_lower) and not re.search(r'\b(cp lead|cost per lead|cpl)\b', query_lower):
+    if LEADS_RE.search(query_lower) and not CPL_RE.search(query_lower):
         measure_names.append("Leads")
     # VCR: not in default view; add when asked (but not for CPCV/cost per completed view queries)
-    if re.search(r'\bvcr\b|\bvideo completion rate\b', query_lower) and not re.search(r'\bcpcv\b|\bcost per completed view\b', query_lower):
+    if VCR_RE.search(query_lower) and not CPCV_RE.search(query_lower):
         measure_names.append("VCR")
     if measure_names:
         filters["Measure Names"] = measure_names
@@ -416,28 +214,29 @@ class AskRequest(BaseModel):
 # --- Ask endpoint ---
 @app.post("/ask")
 async def ask(payload: AskRequest):
-    # Optional: store/fetch question from DB
-    try:
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("INSERT INTO tableau_ai_test (question) VALUES (?)", payload.question)
-            conn.commit()
-    except Exception as e:
-        return {"answer": f"You asked: {payload.question}", "db_error": str(e)}
+    # Optional: store question in DB (queued; written in batches by log_writer)
+    if not get_log_writer().submit(QUESTION_SQL, (payload.question,)):
+        return {"answer": f"You asked: {payload.question}", "db_error": "log queue full"}
 
     return {"answer": f"You asked: {payload.question}"}
 
 # --- DB Test endpoint ---
+def _last_question():
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT TOP 1 question FROM tableau_ai_test ORDER BY id DESC;")
+        row = cursor.fetchone()
+        return row[0] if row else None
+
 @app.get("/db-test")
 async def db_test():
     try:
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT TOP 1 question FROM tableau_ai_test ORDER BY id DESC;")
-            row = cursor.fetchone()
-            return {"status": "ok", "last_question": row[0] if row else None}
+        last_question = await run_db(_last_question)
+        return {"status": "ok", "last_question": last_question, "pool": get_pool().stats(), "tokens": get_broker().stats(),
+                "prompt": sql_prompt.get_stats(), "summary": local_summary.stats, "log": get_log_writer().stats(),
+                "breakers": resilience.status()}
     except Exception as e:
-        return {"status": "error", "message": str(e)}
+        return {"status": "error", "message": str(e), "pool": get_pool().stats(), "breakers": resilience.status()}
     
 # --- Tableau Filter Map ---
 
@@ -524,173 +323,308 @@ FILTER_MAP = {
   "Date Granularity": ["Year", "Quarter", "Month", "Week", "Day"]
 }
 
+# Built once at startup; extract_filters_from_query matches against it per request
+FILTER_MATCHER = ValueMatcher(FILTER_MAP)
+
 
 # --- Azure OpenAI Setup ---
-# ---- Custom httpx client with no proxies ----
-transport = httpx.HTTPTransport(retries=3)
-http_client = httpx.Client(transport=transport, timeout=60)
+# ---- Shared async httpx client with no proxies ----
+# One connection pool for every OpenAI call; OPENAI_MAX_CONNECTIONS caps how
+# many requests can be in flight to Azure OpenAI at once (per worker). Built on
+# first use rather than at import, so a pre-forking server never hands the
+# parent's pool, or a token provider bound to the parent's broker, to workers.
+http_client = None
+client = None
+_client_lock = threading.Lock()
+
+
+def get_openai_client() -> AsyncAzureOpenAI:
+    global http_client, client
+    with _client_lock:
+        if client is None:
+            http_client = httpx.AsyncClient(
+                transport=httpx.AsyncHTTPTransport(retries=3),
+                timeout=60,
+                limits=httpx.Limits(
+                    max_connections=int(os.getenv("OPENAI_MAX_CONNECTIONS", "20")),
+                    max_keepalive_connections=int(os.getenv("OPENAI_MAX_KEEPALIVE", "10")),
+                    # Long enough for the connection opened at warm-up to still be there for the first question
+                    keepalive_expiry=float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "60")),
+                ),
+            )
+            # Served from the shared token cache; refreshed in the background before expiry.
+            # AZURE_OPENAI_API_KEY is only for local stand-ins such as bench/fake_openai.py.
+            if os.getenv("AZURE_OPENAI_API_KEY"):
+                openai_auth = {"api_key": os.getenv("AZURE_OPENAI_API_KEY")}
+            else:
+                openai_auth = {"azure_ad_token_provider": get_broker().async_token_provider(OPENAI_SCOPE)}  # <-- instead of api_key
 
-credential = DefaultAzureCredential()
+            client = AsyncAzureOpenAI(
+                **openai_auth,
+                azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+                api_version="2025-01-01-preview",
+                http_client=http_client,
+                max_retries=0,  # retried by call_openai, which also feeds the circuit breaker
+            )
+        return client
 
-def token_provider():
-    token = credential.get_token("https://cognitiveservices.azure.com/.default")
-    return token.token  # return just the string
 
-client = AzureOpenAI(
-    azure_ad_token_provider=token_provider,  # <-- instead of api_key
-    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-    api_version="2025-01-01-preview",
-    http_client=http_client
+def _reset_openai_client():
+    global http_client, client, _client_lock
+    http_client = client = None
+    _client_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_openai_client)
+
+
+# --- Retries and circuit breakers (see resilience.py) ---
+# Transient failures are retried with jittered backoff (honouring Retry-After
+# on 429s); a dependency that keeps failing opens its breaker and requests
+# fail fast with a 503 until a trial call gets through again.
+sql_breaker = resilience.CircuitBreaker(
+    "sql",
+    failure_threshold=int(os.getenv("SQL_BREAKER_THRESHOLD", "5")),
+    reset_timeout=float(os.getenv("SQL_BREAKER_RESET", "30")),
+)
+openai_breaker = resilience.CircuitBreaker(
+    "openai",
+    failure_threshold=int(os.getenv("OPENAI_BREAKER_THRESHOLD", "5")),
+    reset_timeout=float(os.getenv("OPENAI_BREAKER_RESET", "30")),
 )
+SQL_RETRY_ATTEMPTS = int(os.getenv("SQL_RETRY_ATTEMPTS", "3"))
+OPENAI_RETRY_ATTEMPTS = int(os.getenv("OPENAI_RETRY_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "10"))
+
+
+def openai_transient(e: Exception) -> bool:
+    if isinstance(e, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    return isinstance(e, openai.APIStatusError) and (e.status_code in (408, 409, 429) or e.status_code >= 500)
+
+
+def openai_retry_after(e: Exception) -> Optional[float]:
+    """Seconds Azure OpenAI asked us to wait (retry-after-ms / retry-after), if any."""
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass  # an HTTP date; fall back to our own backoff
+    return None
+
+
+def call_openai(**kwargs):
+    """chat.completions.create through the OpenAI breaker, retrying transient errors."""
+    return resilience.call(lambda: get_openai_client().chat.completions.create(**kwargs), openai_breaker,
+                           openai_transient, attempts=OPENAI_RETRY_ATTEMPTS, base_delay=RETRY_BASE_DELAY,
+                           max_delay=RETRY_MAX_DELAY, retry_after=openai_retry_after)
+
+
+def call_db(fn, *args):
+    """run_db through the SQL breaker, retrying connection drops and Azure SQL's transient errors."""
+    return resilience.call(lambda: run_db(fn, *args), sql_breaker, db_pool.is_transient,
+                           attempts=SQL_RETRY_ATTEMPTS, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY)
 
 class AIQueryRequest(BaseModel):
     query: str
     client_id: Optional[str] = None
+    columnar: bool = False  # rows as {"columns": [...], "rows": [[...], ...]} instead of one dict per row
 
 
-@app.post("/ai_query")
-async def ai_query(payload: AIQueryRequest):
+# Rows included in each answer; the summary still sees the full result
+RESPONSE_ROWS = int(os.getenv("RESPONSE_ROWS", "25"))
 
-    user_query = normalize_journey_phases(sanitize_user_query(payload.query))
 
-    client_id = payload.client_id or "unknown"  #uuid retreived from index.html based on client browser
-    
-    schema_info = """
-    The database contains advertising campaign performance data with the following tables (table name: description):
-        v_TableauData_30Days: view with data 1-31 days old. 
-        Tableau_31DaysandOlder: table with data older than 32 days and up to 25 months old.
-    
-    These two tables have identical columns. Relevant columns and their descriptions are outlined below (column name: description):
-        date: day.
-        Campaign: campaign category. Valid values are: 250K, EdWoW, GenNext, Investor, NA, PIC, PII. IMPORTANT: '250K' is a campaign name, not a dollar amount — never interpret it as a numeric threshold.
-        channel: media channel. Values include Connected TV, Paid Search, Article, TV, Skimms IG, Video - Pre-Roll, Display, None, Podcast, Paid Social, YouTube, Native, Video, Newsletter, Audio, DOOH.
-        FunnelStrategy: funnel strategy. Valid values are: Brand and Performance. NULL, NA, and Quarter 2 should not be queried unless specified.
-        journeyPhase: journey/funnel location. Values include Pre-Explore Awareness (aka PREA or PRE-A), None, Evaluate (aka EVA), Explore (aka EXP), Pre-Explore Familiarity (aka PREF or PRE-F).
-        Platform: Values include ABC, Amazon, Bing, Bleacher Report, CBS, CNBC, Discovery Plus, Disney, DV360, ENT, ESP2, ESPN, Facebook, FBN, FOX, FS1, GOLF, Google, HTS, Hulu, Instagram,
-            LinkedIn, Meredith, NASDAQ, Nativo, NBAT, NBC, Netflix, NGC, NPR, Pandora, Paramount, PARB, PARC, Pinterest, She Media, SiriusXM, SoundCloud, Spotify, TBS,
-            The Street Editorial, The Trade Desk, TheSkimm, TNT, TRU, USA, Vox, WSJ
-        Geography: Values include Designated Market Areas, National, High Net Worth, None, Local.
-        [Targeting Strategy]: Values include Hyper Local Targeting, 1st Party Audience Data, Demographic Targeting Only,Google Custom Intent, Recency RTG, Retargeting Targeting, Lookalike Modeling, 
-            Topic Targeting, Google Custom Affinity, Specific Site List, Google In Market, Keyword Contextual, Run of Site Targeting, Video Retargeting, Multiple Targeting Methods, Google Affinity Data
-            None, Run of Network Targeting, Behavioral Targeting, Website Retargeting, Contextual Targeting.
-        [Target Audience]: target audience.
-        Publisher: BusinessInsider, Conde Nast, Discovery, Meredith, Nasdaq, Nativo, NBC, Netflix, None, Paramount, Pinterest, Roku, Sirius XM, The Trade Desk, TripleLift, USA Today, Wall Street Journal, YouTube
-        callcount: number of calls.
-        clicks: number of clicks.
-        impressions: number of impressions.
-        mediaCost: media spend/budget.
-        siteVisits: direct site visits recorded at the placement level.
-        TotalConversions: conversion count used for CM Floodlight and LinkedIn-sourced site visits.
-        ConversionTagName: name of the conversion tag. Rows where this field matches specific CM Floodlight tag names represent additional site visits.
-        Site Visits (combined, matches Tableau dashboard): ALWAYS use this formula — never use siteVisits alone — when the user asks about site visits or CPSV:
-            ISNULL(SUM(siteVisits), 0)
-            + ISNULL(SUM(CASE WHEN ConversionTagName IN (
-                'Floodlight - ACC - EJ Investor All Pages',
-                'ejgen : Floodlight - ACC - EJ Investor All Pages: Paid Search Actions',
-                'Floodlight - ACC - Match Tool - Landing Page',
-                'Floodlight - ACC - Starting Point - Homepage',
-                'MatchTool : Floodlight - ACC - Match Tool - Landing Page: Paid Search Actions',
-                'Startp002 : Floodlight - ACC - Starting Point - Homepage: Paid Search Actions',
-                'FLOODLIGHT_ACC_EJ_INVESTOR_ALL_PAGES',
-                'FLOODLIGHT_ACC_MATCH_TOOL_LANDING_PAGE',
-                'FLOODLIGHT_ACC_STARTING_POINT_HOMEPAGE',
-                'EJGEN_FLOODLIGHT_ACC_EJ_INVESTOR_ALL_PAGES_PAID_SEARCH_ACTIONS',
-                'MATCHTOOL_FLOODLIGHT_ACC_MATCH_TOOL_LANDING_PAGE_PAID_SEARCH_ACTIONS',
-                'STARTP002_FLOODLIGHT_ACC_STARTING_POINT_HOMEPAGE_PAID_SEARCH_ACTIONS'
-            ) THEN TotalConversions ELSE 0 END), 0)
-            + ISNULL(SUM(CASE WHEN tablename = 'v_LinkedInCampaign' THEN TotalConversions ELSE 0 END), 0)
-        videoFullyPlayed: videos played completely, 100%. Frequently referred to as "Video Completes".
-        videoViews: video view count for non-YouTube platforms.
-        VideoPlays: video play/start count, primarily for YouTube and other platforms.
-        tablename: source table identifier. The value 'v_YouTubePaidMedia' identifies YouTube rows.
-        mediaBuyName: name of the media buy/placement.
-        Video Views (calculated): The correct formula for "Video Views" matches the Tableau dashboard and MUST be used whenever the user asks for video views, video plays, or any metric whose denominator is video views (VCR, CPCV). Formula: COALESCE(SUM(videoViews),0) + COALESCE(SUM(VideoPlays),0) + COALESCE(SUM(CASE WHEN tablename='v_YouTubePaidMedia' AND (mediaBuyName LIKE '%NonSkippable%' OR mediaBuyName LIKE '%Bumper%') THEN impressions ELSE 0 END),0)
-        Viewability: calculated as SUM([Viewable Impressions]) / SUM([Measured Impressions]). Use this formula directly when asked for viewability — do not use these two columns for anything else.
-        [Engaged Visits]: engaged visits. IMPORTANT: this column name contains a space and MUST always be referenced as [Engaged Visits] in SQL.
-        CallCount: number of calls (Google only).
-        Leads: leads (applies only to pinterest data).
-    """
+def shape_rows(response: dict, columnar: bool = False) -> dict:
+    """Render the ResultSet under "rows" as records, or column names plus row arrays when asked."""
+    rows = response.get("rows")
+    if not isinstance(rows, ResultSet):
+        return response
+    if columnar:
+        return {**response, "columns": rows.columns, "rows": rows.rows()}
+    return {**response, "rows": rows.records()}
+
+
+# Prompts are assembled per question from sql_prompt.py; estimated tokens, 0 = no cap
+SQL_PROMPT_MAX_TOKENS = int(os.getenv("SQL_PROMPT_MAX_TOKENS", "0"))
+
 
-    # --- Step 1: Ask Azure OpenAI to generate SQL ---
-    today = date.today()
-    yesterday = today - timedelta(days=1)
-    prompt = f"""
-    You are a data assistant. Convert this natural-language question into a safe SQL query 
-    for Microsoft SQL Server. All data is stored in two tables with the following schema:
-    {schema_info}
-
-    Return only **valid SQL**, do not include explanations, comments, or markdown.
-    Do not include any text outside the SQL query.
-    Queries that reference both tables should use a UNION ALL in a subquery. You MUST include AND FunnelStrategy NOT IN ('Null', 'NA', 'Quarter 2') in the WHERE clause of EVERY inner subquery — no exceptions, even if FunnelStrategy is not selected or grouped:
-    SELECT ...
-    FROM (
-        SELECT ...
-        FROM v_TableauData_30Days
-        WHERE <date or other conditions> AND FunnelStrategy NOT IN ('Null', 'NA', 'Quarter 2')
-        UNION ALL
-        SELECT ...
-        FROM Tableau_31DaysandOlder
-        WHERE <date or other conditions> AND FunnelStrategy NOT IN ('Null', 'NA', 'Quarter 2')
-    ) AS CombinedData
-    Acronyms: CPC = Cost Per Click, CPL = Cost Per Lead, CTR = Click-Through Rate (clicks / impressions), CPEV = Cost Per Engaged Visit, CPM = Cost Per Mille (Cost per 1000 Impressions), CPSV = Cost Per Site Visit, CPCV = Cost Per Completed View, VCR = Video Completion Rate (also called Audio Completion Rate for audio placements — same formula), EV = Engaged Visits, TTD = The Trade Desk. CPV = Cost Per View = CPCV.
-    For CP EV / CPEV calculations, use: SUM(mediaCost) / NULLIF(SUM([Engaged Visits]), 0). Note: [Engaged Visits] must always be in square brackets.
-    For CPSV (Cost Per Site Visit) and any site visit count, NEVER use SUM(siteVisits) alone — always use the combined Site Visits formula from the schema above: ISNULL(SUM(siteVisits),0) + ISNULL(SUM(CASE WHEN ConversionTagName IN (...12 floodlight values...) THEN TotalConversions ELSE 0 END),0) + ISNULL(SUM(CASE WHEN tablename='v_LinkedInCampaign' THEN TotalConversions ELSE 0 END),0). CPSV = SUM(mediaCost) / NULLIF(<combined site visits>, 0).
-    For CPL / CP Lead (Cost Per Lead) calculations, use: SUM(mediaCost) / NULLIF(SUM(Leads), 0).
-    For CPC (Cost Per Click) calculations, use: SUM(mediaCost) / NULLIF(SUM(clicks), 0). IMPORTANT: CPC (Cost Per Click) is completely different from CPCV (Cost Per Completed View) — never use videoFullyPlayed for CPC.
-    For CPCV (Cost Per Completed View) calculations, use: SUM(mediaCost) / NULLIF(SUM(videoFullyPlayed), 0).
-    For VCR (Video Completion Rate) calculations, use: SUM(videoFullyPlayed) / NULLIF(<Video Views formula>, 0) where <Video Views formula> = COALESCE(SUM(videoViews),0) + COALESCE(SUM(VideoPlays),0) + COALESCE(SUM(CASE WHEN tablename='v_YouTubePaidMedia' AND (mediaBuyName LIKE '%NonSkippable%' OR mediaBuyName LIKE '%Bumper%') THEN impressions ELSE 0 END),0).
-    For CPM calculations, use the weighted average formula: SUM(mediaCost) * 1000.0 / NULLIF(SUM(impressions), 0). Do NOT add a WHERE impressions > 0 filter — non-impression channels (Audio, Podcast, Paid Search) have impressions = 0 and their spend must still be included in the mediaCost numerator. NULLIF handles division by zero.
-    Today's date is {today.strftime('%B %d, %Y')}. There is a 1 day lag in data availability — the most recent data in the database is for {yesterday.strftime('%B %d, %Y')}. Use today's date to resolve any ambiguous time references (e.g., "this month", "since January", "last quarter", bare month names with no year).
-    INTERVAL should not be used for date ranges (it is not valid SQL); use DATEADD and DATEDIFF functions instead.
-    Integers cannot be added to dates in SQL code like: WHERE date < '2025-01-01' + 365; use DATEADD and DATEDIFF functions instead.
-    When a user asks about a specific brand, network, or service by name (e.g., ESPN, CNBC, Pandora, Spotify, Disney, Hulu, Netflix, Instagram, Nativo, SiriusXM, YouTube, Facebook, Roku, LinkedIn, Pinterest, Bloomberg, NBC, ABC, CBS, FOX, Amazon), always filter by the Platform or Publisher column — NEVER by channel. The channel column only contains broad media types: Connected TV, Paid Search, Paid Social, Display, Video, Audio, TV, Podcast, Native, Article, Newsletter, DOOH.
-    Column names that contain spaces must be wrapped in square brackets, e.g., [Engaged Visits], [Keyword Type], [Budget Source].
-    Unless the user specifically asks about FunnelStrategy 'Null', 'NA', or 'Quarter 2', always exclude those rows by default using WHERE FunnelStrategy NOT IN ('Null', 'NA', 'Quarter 2').
-    When grouping or filtering by Journey Phase (journeyPhase), always exclude rows where journeyPhase = 'None'.
-    When ordering results by Journey Phase, always use this order via a CASE expression in ORDER BY: Pre-Explore Awareness = 1, Pre-Explore Familiarity = 2, Explore = 3, Evaluate = 4.
-    When the user asks to see results 'by [dimension]' (e.g., 'by Journey Phase', 'by Platform', 'by month', 'by Channel'), always include that dimension in both SELECT and GROUP BY. For 'by month', use FORMAT(date, 'yyyy-MM') AS Month in SELECT and GROUP BY, ordered by Month. When asked for 'top N per month' (e.g., 'top 3 platforms by month'), use a CTE to compute monthly totals per dimension, then apply ROW_NUMBER() OVER (PARTITION BY Month ORDER BY metric DESC) and filter WHERE rn <= N in the outer SELECT.
-    When the user specifies a channel type (e.g., 'Paid Social platform', 'Display publisher', 'Connected TV placement'), filter by channel = 'channel_value' (e.g., WHERE channel = 'Paid Social') — never match channel type names against the Platform or Publisher columns. The channel column holds broad media types; Platform and Publisher hold specific vendor/network names within a channel.
-    When filtering Publisher or Platform by a name that may have variants (e.g., 'Hulu' could match 'Hulu', 'Hulu Slate', 'Hulu DSE'), use LIKE '%name%' in the WHERE clause to include all variants.
-    Direction rules — always apply ORDER BY and TOP N to return only what the user asked for:
-      - For volume metrics (impressions, clicks, leads, site visits, engaged visits): "highest/most/top" = ORDER BY metric DESC; "lowest/fewest/least" = ORDER BY metric ASC.
-      - For cost-efficiency metrics (CPM, CPC, CPL, CPSV, CPEV, CPCV): LOWER values are better. "lowest/cheapest/most efficient/best" = ORDER BY metric ASC; "highest/most expensive/worst" = ORDER BY metric DESC.
-      - Use SELECT TOP 1 when asking for a single winner; TOP N when the user specifies a count (e.g., "top 3").
-    When querying any metric over a time period (month, quarter, year), always use a date range with >= and < (e.g., date >= '2025-10-01' AND date < '2025-11-01'). Never use a single date equality filter (WHERE date = 'YYYY-MM-DD') unless the user explicitly asks about a specific single day.
-    For period-over-period comparisons (month-over-month, year-over-year, or any "change from X to Y"): compute both periods in a single query using conditional aggregation with CASE WHEN inside a CTE, then calculate the difference in the outer SELECT. For simple metrics: SUM(CASE WHEN date >= 'A_start' AND date < 'A_end' THEN column ELSE 0 END) AS period_A. For weighted-average metrics like CPM, compute numerator and denominator separately per period: SUM(CASE WHEN period_A THEN mediaCost ELSE 0 END)*1000.0/NULLIF(SUM(CASE WHEN period_A THEN impressions ELSE 0 END),0) AS CPM_A. Percent change: (metric_B - metric_A) / NULLIF(metric_A, 0) * 100. Always label columns clearly (e.g., CPM_March, CPM_April, CPM_Change, CPM_PctChange).
-
-    User question: {user_query}
+async def generate_sql(user_query: str, filters: dict) -> str:
+    with span("llm_sql") as s:
+        response = await call_openai(
+            model="gpt-4o-mini",
+            messages=[
+                {"role": "system", "content": "You are a helpful SQL assistant."},
+                {"role": "user", "content": sql_prompt.build_sql_prompt(user_query, filters, max_tokens=SQL_PROMPT_MAX_TOKENS)}
+            ],
+            temperature=0,
+            max_tokens=1000
+        )
+        usage = sql_prompt.record_usage(response.usage)
+        s.update(usage)
+    metrics.record_tokens("sql", usage)
+    if usage:
+        logger.info(f"🧮 SQL prompt: {usage['prompt_tokens']} tokens ({usage['cached_tokens']} cached, "
+                    f"{usage['uncached_tokens']} uncached), {usage['completion_tokens']} completion")
+    return response.choices[0].message.content.strip()
+
+
+# --- Cross-process cache (see shared_cache.py) ---
+# With several workers (WEB_CONCURRENCY in startup.sh), SHARED_CACHE_PATH puts
+# one SQLite file under every worker's SQL, result and token caches.
+shared_store = shared_cache.get_store()
+
+
+async def off_loop(fn, *args):
+    """
+    Call ``fn`` in a thread if it may touch the shared store (SQLite reads and
+    writes, with a busy timeout); purely in-process cache calls stay here.
     """
+    if shared_store is None:
+        return fn(*args)
+    return await asyncio.to_thread(fn, *args)
+
+
+# --- Question → SQL cache ---
+# The prompt embeds today's date, so the cache is dropped when the day rolls
+# over; within a day the key also carries the resolved date range so that
+# relative phrases ("last month") can never map to a stale range.
+sql_cache = LRUCache(
+    maxsize=int(os.getenv("SQL_CACHE_SIZE", "512")),
+    ttl=float(os.getenv("SQL_CACHE_TTL", "21600")),
+    epoch=date.today,
+    name="sql",
+    shared=shared_store,
+)
+
+
+def sql_cache_key(user_query: str, filters: dict) -> tuple:
+    date_values = filters.get("date")
+    return (normalize_question(user_query), tuple(date_values) if date_values else None)
+
+
+# --- Result-set cache ---
+# Data is loaded once a night (1 day lag), so rows for a given SQL string
+# can't change until the next load. DATA_REFRESH_HOUR_UTC is the hour by which
+# the nightly load has finished; the cache rolls over at that boundary, and
+# POST /cache/invalidate drops it early if the load lands at another time.
+DATA_REFRESH_HOUR_UTC = int(os.getenv("DATA_REFRESH_HOUR_UTC", "6"))
+
 
-    response = client.chat.completions.create(
-    model="gpt-4o-mini",
-    messages=[
-        {"role": "system", "content": "You are a helpful SQL assistant."},
-        {"role": "user", "content": prompt}
-    ],
-    temperature=0,
-    max_tokens=1000
+def data_epoch() -> date:
+    """Date of the most recent nightly load boundary."""
+    return (datetime.now(timezone.utc) - timedelta(hours=DATA_REFRESH_HOUR_UTC)).date()
+
+
+def data_version() -> str:
+    """data_epoch(), plus how often POST /cache/invalidate has dropped results on any worker."""
+    generation = shared_store.generation("results") if shared_store else 0
+    return f"{data_epoch()}.{generation}" if generation else str(data_epoch())
+
+
+result_cache = ResultCache(
+    max_bytes=int(os.getenv("RESULT_CACHE_MAX_MB", "64")) * 1024 * 1024,
+    spill_dir=os.getenv("RESULT_CACHE_DIR") or None,
+    spill_max_bytes=int(os.getenv("RESULT_CACHE_DIR_MAX_MB", "512")) * 1024 * 1024,
+    epoch=data_epoch,
+    shared=shared_store,
+    name="results",
 )
 
-    sql_query = response.choices[0].message.content.strip()
 
-    # --- Step 2: Run SQL (safely) ---
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(sql_query)
-        columns = [desc[0] for desc in cursor.description]
-        rows = cursor.fetchall()
-        results = [dict(zip(columns, row)) for row in rows]
-    except Exception as e:
-        return {
-            "query": user_query,
-            "sql": sql_query,
-            "error": str(e)[:300],  # truncate long ODBC errors
-            "summary": "The query could not be executed. Please rephrase or simplify."
-        }
+# Row cap per query; anything beyond it is never pulled off the wire.
+SQL_MAX_ROWS = int(os.getenv("SQL_MAX_ROWS", "5000"))
+SQL_FETCH_BATCH = int(os.getenv("SQL_FETCH_BATCH", "500"))
+# Per-statement limit enforced by the driver (see sql_governor.py); 0 = none
+SQL_QUERY_TIMEOUT = int(os.getenv("SQL_QUERY_TIMEOUT", "60"))
+# Largest result passed to the summarizer verbatim; bigger ones get a digest.
+SUMMARY_MAX_ROWS = int(os.getenv("SUMMARY_MAX_ROWS", "50"))
+# "auto" summarizes single rows and small one-dimension tables without the LLM,
+# "llm" always asks the LLM, "local" never does.
+SUMMARY_MODE = os.getenv("SUMMARY_MODE", "auto").lower()
+if SUMMARY_MODE not in local_summary.MODES:
+    logger.warning(f"⚠️ Unknown SUMMARY_MODE {SUMMARY_MODE!r}, using 'auto'")
+    SUMMARY_MODE = "auto"
+LOCAL_SUMMARY_MAX_ROWS = int(os.getenv("LOCAL_SUMMARY_MAX_ROWS", "10"))
 
-    # --- Step 3: Summarize results ---
-    summary_prompt = f"""Summarize these results briefly for a user who asked: "{user_query}"
+
+def run_sql(sql_query: str, guard: sql_governor.QueryGuard = None) -> ResultSet:
+    """
+    Execute already governed SQL and cache the result. Blocking — call
+    through run_db (execute_sql does, after checking the result cache).
+    """
+    with span("db_execute") as s:
+        with get_db_connection() as conn:
+            # pyodbc copies the timeout into a cursor when it creates it, so set it first
+            conn.timeout = SQL_QUERY_TIMEOUT
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                if guard is not None:
+                    guard.attach(cursor)
+                cursor.execute(sql_query)
+                results = ResultSet.from_cursor(cursor, max_rows=SQL_MAX_ROWS, batch_size=SQL_FETCH_BATCH)
+            except Exception as e:
+                if not sql_governor.is_timeout(e):
+                    raise
+                sql_governor.stats["timed_out"] += 1
+                logger.warning(f"⏱️ Query timed out after {SQL_QUERY_TIMEOUT}s: {sql_query[:300]}")
+                raise sql_governor.QueryTimeout(
+                    f"The query took longer than {SQL_QUERY_TIMEOUT}s and was stopped. Try a narrower date range.") from e
+            finally:
+                conn.timeout = 0  # pooled connection: don't leak the limit to other statements
+                if guard is not None:
+                    guard.detach()
+                if cursor is not None:
+                    cursor.close()
+        s["rows"] = len(results)
+        s["truncated"] = results.truncated
+    result_cache.set(sql_query, results)
+    return results
+
+
+# --- Cache invalidation (called by the nightly load when it completes) ---
+class CacheInvalidateRequest(BaseModel):
+    scope: str = "results"  # "results", "sql" or "all"
+
+@app.post("/cache/invalidate")
+async def invalidate_cache(payload: CacheInvalidateRequest, request: Request):
+    # Off unless CACHE_ADMIN_KEY is set: a flush forces a rollup rebuild and a partition re-probe
+    admin_key = os.getenv("CACHE_ADMIN_KEY")
+    if not admin_key:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not hmac.compare_digest(request.headers.get("X-Cache-Admin-Key", "").encode(), admin_key.encode()):
+        raise HTTPException(status_code=403, detail="Unauthorized use")
+    if payload.scope not in ("results", "sql", "all"):
+        raise HTTPException(status_code=400, detail="scope must be 'results', 'sql' or 'all'")
+
+    # Unlinks spill files and the rollup directory and writes the shared store: not on the event loop
+    await asyncio.to_thread(_invalidate, payload.scope)
+    return {"status": "ok", "results": result_cache.stats(), "sql": sql_cache.stats()}
+
+
+def _invalidate(scope: str):
+    if scope in ("results", "all"):
+        result_cache.invalidate()
+        _partition_bounds.clear()
+        if ROLLUP:
+            rollup_store.invalidate()
+    if scope in ("sql", "all"):
+        sql_cache.clear()
+
+
+def build_summary_prompt(user_query: str, results: ResultSet) -> str:
+    digest = results.digest(SUMMARY_MAX_ROWS)
+    note = ""
+    if isinstance(digest, dict):
+        note = (f"\nNote: the result has {digest['row_count']}{'+' if digest['truncated'] else ''} rows; only the first "
+                f"{len(digest['top_rows'])} are listed. 'totals' are sums over all {digest['row_count']} fetched rows.")
+    return f"""Summarize these results briefly for a user who asked: "{user_query}"
 IMPORTANT: Use only these acronym definitions — do not invent alternatives:
 VCR = Video Completion Rate (NEVER "Value Creation Ratio" or any other meaning)
 CPCV = Cost Per Completed View, CPM = Cost Per Mille, CPL = Cost Per Lead,
@@ -700,32 +634,526 @@ Formatting rules:
 - All cost metrics (CPM, CPC, CPL, CPSV, CPEV, CPCV, mediaCost) should be prefixed with $.
 - For period-over-period results, clearly label each period and show the change and percent change.
 - When results include Publisher or Platform variants as separate rows (e.g., 'Hulu' and 'Hulu Slate' and 'Hulu DSE'), list each variant separately — never merge or consolidate them into a single entry.
-Results:
-{results}"""
-    summary = client.chat.completions.create(
+Results:{note}
+{digest}"""
+
+
+def local_summary_for(user_query: str, results: ResultSet) -> Optional[str]:
+    """The rule-based summary, or None when the result needs the LLM."""
+    with span("local_summary") as s:
+        summary = local_summary.summarize(user_query, results, mode=SUMMARY_MODE, max_rows=LOCAL_SUMMARY_MAX_ROWS)
+        s["used"] = summary is not None
+    annotate(summary_source="local" if summary is not None else "llm")
+    return summary
+
+
+async def summarize_results(user_query: str, results: ResultSet) -> str:
+    summary = local_summary_for(user_query, results)
+    if summary is not None:
+        return summary
+    try:
+        with span("llm_summary") as s:
+            response = await call_openai(
+                model="gpt-4o-mini",
+                messages=[{"role": "user", "content": build_summary_prompt(user_query, results)}],
+                temperature=0.2
+            )
+            usage = metrics.usage_numbers(response.usage)
+            s.update(usage)
+    except Exception as e:
+        if not openai_unavailable(e):
+            raise
+        return fallback_summary(user_query, results, e)
+    metrics.record_tokens("summary", usage)
+    return response.choices[0].message.content
+
+
+def openai_unavailable(e: Exception) -> bool:
+    return isinstance(e, resilience.CircuitOpen) or openai_transient(e)
+
+
+def fallback_summary(user_query: str, results: ResultSet, error: Exception) -> str:
+    """The rows are already here, so an OpenAI outage degrades the summary instead of failing the answer."""
+    logger.warning(f"⚠️ Summary model unavailable, summarizing locally: {str(error)[:200]}")
+    annotate(summary_source="local_fallback")
+    return local_summary.summarize(user_query, results, mode="local", max_rows=LOCAL_SUMMARY_MAX_ROWS) or \
+        "The summary is temporarily unavailable; the rows below answer the question."
+
+
+async def stream_summary(user_query: str, results: ResultSet):
+    """Same as summarize_results, but yields the completion text as it arrives."""
+    stream = await call_openai(
         model="gpt-4o-mini",
-        messages=[{"role": "user", "content": summary_prompt}],
-        temperature=0.2
-    ).choices[0].message.content
+        messages=[{"role": "user", "content": build_summary_prompt(user_query, results)}],
+        temperature=0.2,
+        stream=True
+    )
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+def log_query(user_query: str, sql_query: str, rows_returned: int, summary: str, client_id: str):
+    """Queue one row for Tableau_AI_QueryLog. Non-blocking; see log_writer.py."""
+    with span("log_enqueue"):
+        get_log_writer().submit(QUERY_LOG_SQL, (user_query, sql_query, rows_returned, summary[:4000], client_id))
+
+
+# Deterministic fast path for common metric questions (see sql_templates.py)
+SQL_TEMPLATES = os.getenv("SQL_TEMPLATES", "1") == "1"
+
+# --- Daily rollup (see rollup.py) ---
+# Template plans are answered in-process from a NumPy rollup rebuilt after each
+# nightly load; ROLLUP_DIR keeps it on disk (memory-mapped) across restarts,
+# and with the shared cache one worker builds it while the others wait and map it.
+ROLLUP = os.getenv("ROLLUP", "1") == "1"
+if ROLLUP and not rollup.available():
+    logger.warning("⚠️ numpy is not installed; ROLLUP disabled")
+    ROLLUP = False
+ROLLUP_DIR = os.getenv("ROLLUP_DIR") or None
+rollup_store = rollup.RollupStore(
+    connect=get_db_connection,
+    epoch=data_version,
+    directory=ROLLUP_DIR,
+    lock=(lambda: shared_store.lock("rollup")) if shared_store and ROLLUP_DIR else None,
+)
 
-    # --- Step 4: log to table ---
+# --- Request coalescing (see single_flight.py) ---
+# Identical questions that arrive together share one pipeline run; the SQL
+# and DB flights also cover the streaming endpoint and differently worded
+# questions that resolve to the same SQL.
+SINGLE_FLIGHT = os.getenv("SINGLE_FLIGHT", "1") == "1"
+answer_flight = SingleFlight("answer", enabled=SINGLE_FLIGHT)
+sql_flight = SingleFlight("sql", enabled=SINGLE_FLIGHT)
+db_flight = SingleFlight("db", enabled=SINGLE_FLIGHT)
+
+
+async def get_sql(user_query: str, filters: dict):
+    """
+    Step 1: template fast path, then the question → SQL cache, then the LLM.
+    Returns (sql, cache_key, plan); plan is the template plan, if any, for the rollup.
+    """
+    if SQL_TEMPLATES:
+        with span("sql_template") as s:
+            plan = sql_templates.plan_question(user_query, filters)
+            sql_query = sql_templates.render(plan) if plan is not None else None
+            s["hit"] = plan is not None
+        if plan is not None:
+            annotate(sql=sql_query, sql_source="template")
+            return sql_query, None, plan
+    cache_key = sql_cache_key(user_query, filters)
+    sql_query = await off_loop(sql_cache.get, cache_key)
+    source = "cache"
+    if sql_query is None:
+        async def generate():
+            generated = await generate_sql(user_query, filters)
+            await off_loop(sql_cache.set, cache_key, generated)
+            return generated
+
+        sql_query, shared = await sql_flight.do(cache_key, generate)
+        source = "coalesced" if shared else "llm"
+    annotate(sql=sql_query, sql_source=source)
+    return sql_query, cache_key, None
+
+
+async def execute_sql(sql_query: str, plan: dict = None) -> ResultSet:
+    """
+    Step 2: answer a template plan from the rollup if it can; otherwise check
+    and row-cap the SQL and serve it from the result cache, or run it in the
+    DB pool, shared with concurrent runs of the same statement. If every caller goes away the statement is
+    cancelled on the server.
+    """
+    if plan is not None and ROLLUP:
+        with span("rollup") as s:
+            results = await asyncio.to_thread(rollup_store.answer, plan, SQL_MAX_ROWS)
+            s["hit"] = results is not None
+        if results is not None:
+            annotate(data_source="rollup")
+            return results
+
+    with span("sql_check"):
+        # One row over the cap so ResultSet can still tell the result was truncated
+        governed = sql_governor.prepare(sql_query, SQL_MAX_ROWS + 1)
+    governed = await prune_partitions(governed)
+
+    # Ahead of the SQL breaker and the DB threads: cached answers are served
+    # while Azure SQL is down and don't queue behind slow statements
+    with span("result_cache") as s:
+        results = await off_loop(result_cache.get, governed)
+        s["hit"] = isinstance(results, ResultSet)
+    if s["hit"]:  # RESULT_CACHE_DIR may hold entries from an older deploy
+        annotate(data_source="result_cache")
+        return results
+
+    async def run():
+        guard = sql_governor.QueryGuard()
+        try:
+            return await call_db(run_sql, governed, guard)
+        except asyncio.CancelledError:
+            guard.cancel()
+            raise
+
+    results, _ = await db_flight.do(governed, run)
+    return results
+
+
+# --- Partition pruning (see partition_pruning.py) ---
+# Data bounds of the two sources, probed once per nightly load and per day
+# (the 30-day view moves at midnight); cleared by /cache/invalidate. A load
+# landing before DATA_REFRESH_HOUR_UTC leaves them a day stale, which prune()
+# allows for with partition_pruning.SLACK.
+PARTITION_PRUNING = os.getenv("PARTITION_PRUNING", "1") == "1"
+_partition_bounds = {}
+
+
+def _probe_partitions() -> tuple:
+    with get_db_connection() as conn:
+        return partition_pruning.probe(conn)
+
+
+async def partition_bounds() -> Optional[tuple]:
+    key = (await off_loop(data_version), date.today())
+    bounds = _partition_bounds.get(key)
+    if bounds is None:
+        try:
+            bounds, _ = await db_flight.do(("partition_bounds", key), lambda: call_db(_probe_partitions))
+        except Exception as e:
+            logger.warning(f"⚠️ Could not probe partition bounds, not pruning: {e}")
+            return None
+        _partition_bounds.clear()
+        _partition_bounds[key] = bounds
+        logger.info(f"✅ Partition bounds: {partition_pruning.RECENT} from {bounds[0]}, "
+                    f"{partition_pruning.OLDER} to {bounds[1]}")
+    return bounds
+
+
+async def prune_partitions(sql_query: str) -> str:
+    bounds = await partition_bounds() if PARTITION_PRUNING else None
+    if bounds is None:
+        return sql_query
+    with span("partition_prune") as s:
+        sql_query, dropped = partition_pruning.prune(sql_query, *bounds)
+        s["dropped"] = dropped
+    return sql_query
+
+
+async def until_disconnected(request: Request):
+    """Returns once the client has gone. The body is already read, so the next message is the disconnect."""
+    # Awaiting it wakes us as soon as it arrives; request.is_disconnected() would have to be polled
+    while (await request.receive())["type"] != "http.disconnect":
+        pass
+
+
+# Existing stats, exposed on /metrics at scrape time
+metrics.register_collector("sql_cache", sql_cache.stats)
+metrics.register_collector("result_cache", result_cache.stats)
+metrics.register_collector("sql_templates", lambda: sql_templates.stats)
+metrics.register_collector("sql_prompt", sql_prompt.get_stats)
+metrics.register_collector("summary", lambda: local_summary.stats)
+metrics.register_collector("db_pool", lambda: get_pool().stats())
+metrics.register_collector("tokens", lambda: get_broker().stats())
+metrics.register_collector("log_writer", lambda: get_log_writer().stats())
+metrics.register_collector("rollup", rollup_store.stats)
+if shared_store:
+    metrics.register_collector("shared_cache", shared_store.stats)
+metrics.register_collector("sql_governor", lambda: sql_governor.stats)
+metrics.register_collector("partition_pruning", lambda: partition_pruning.stats)
+metrics.register_collector("single_flight", lambda: {f.name: f.stats() for f in (answer_flight, sql_flight, db_flight)})
+metrics.register_collector("warmup", warmup.stats)
+metrics.register_collector("admission", lambda: admission.stats)
+metrics.register_collector("breakers", resilience.stats)
+
+
+# --- Warm-up steps (run by lifespan, see warmup.py) ---
+async def _warm_openai_token():
+    await asyncio.to_thread(get_broker().get_token, OPENAI_SCOPE)
+
+
+async def _warm_openai_connection():
+    get_openai_client()
+    # Any response will do: the TLS connection stays in http_client's pool
+    await http_client.get(os.getenv("AZURE_OPENAI_ENDPOINT"))
+
+
+async def _warm_partition_bounds():
+    if await partition_bounds() is None:
+        raise RuntimeError("partition bounds probe failed")
+
+
+async def _warm_rollup():
+    rollup_store.refresh()  # builds (or maps ROLLUP_DIR) in the background; not waited for
+
+
+if WARMUP:
+    if not os.getenv("AZURE_OPENAI_API_KEY"):
+        warmup.add("openai_token", _warm_openai_token)
+    warmup.add("sql_pool", lambda: run_db(get_pool().warm))  # opening a connection fetches the SQL token
+    warmup.add("openai_connection", _warm_openai_connection)
+    if PARTITION_PRUNING:
+        warmup.add("partition_bounds", _warm_partition_bounds, required=False)
+    if ROLLUP:
+        warmup.add("rollup", _warm_rollup, required=False)
+
+
+async def answer_query(user_query: str, filters: dict) -> tuple:
+    """Steps 1–3 of /ai_query. Returns (response, rows_returned); rows_returned is None if the SQL failed."""
+    # --- Step 1: Ask Azure OpenAI to generate SQL (unless we already have it) ---
+    sql_query, cache_key, plan = await get_sql(user_query, filters)
+
+    # --- Step 2: Run SQL (safely) ---
     try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO Tableau_AI_QueryLog (user_query, sql_generated, rows_returned, summary, tableau_user)
-            VALUES (?, ?, ?, ?, ?)
-        """, (user_query, sql_query, len(results), summary[:4000], client_id))  
-        conn.commit()
-    except Exception as log_err:
-        print("Logging failed:", log_err)
-    
-    # --- Step 5: create Tableau filters ---
-    filters = extract_filters_from_query(user_query)
+        results = await execute_sql(sql_query, plan)
+    except resilience.CircuitOpen:
+        raise  # a 503, see circuit_open
+    except Exception as e:
+        if cache_key and not db_pool.is_transient(e):
+            await off_loop(sql_cache.pop, cache_key)  # don't keep serving SQL that fails
+        return {
+            "query": user_query,
+            "sql": sql_query,
+            "error": str(e)[:300],  # truncate long ODBC errors
+            "summary": "The query could not be executed. Please rephrase or simplify."
+        }, None
+
+    # --- Step 3: Summarize results ---
+    summary = await summarize_results(user_query, results)
 
     return {
         "query": user_query,
         "sql": sql_query,
         "summary": summary,
-        "rows": results[:25],  # show only top rows
+        "rows": results.head(RESPONSE_ROWS),  # shaped per caller by shape_rows
         "filters": filters
-    }
\ No newline at end of file
+    }, len(results)
+
+
+@app.post("/ai_query")
+async def ai_query(payload: AIQueryRequest, request: Request):
+
+    user_query = normalize_journey_phases(sanitize_user_query(payload.query))
+
+    client_id = payload.client_id or "unknown"  #uuid retreived from index.html based on client browser
+
+    # --- Tableau filters (also feed the template fast path) ---
+    with span("extract_filters"):
+        filters = extract_filters_from_query(user_query)
+
+    # --- Steps 1–3, shared with identical questions already in flight ---
+    # Stop waiting (and cancel whatever only this caller needed) if the client goes away
+    work = asyncio.ensure_future(answer_flight.do(
+        sql_cache_key(user_query, filters), lambda: answer_query(user_query, filters)))
+    watch = asyncio.ensure_future(until_disconnected(request))
+    await asyncio.wait({work, watch}, return_when=asyncio.FIRST_COMPLETED)
+    watch.cancel()
+    if not work.done():
+        work.cancel()
+        annotate(disconnected=True)
+        logger.info(f"⚠️ Client disconnected, cancelled: {user_query[:100]}")
+        return PlainTextResponse("Client disconnected", status_code=499)
+    (response, rows_returned), shared = work.result()
+    if shared:
+        annotate(sql=response["sql"], coalesced=True)
+        response = {**response, "query": user_query}
+
+    # --- Step 4: log to table ---
+    if rows_returned is not None:
+        log_query(user_query, response["sql"], rows_returned, response["summary"], client_id)
+
+    return FastJSONResponse(shape_rows(response, payload.columnar))
+
+
+# --- Batch variant ---
+# A dashboard opening fires several starter questions; sent together they
+# take as long as the slowest one instead of the sum. Items run concurrently,
+# BATCH_PARALLELISM at a time, identical questions within a batch run once,
+# and the answer/SQL/DB flights still coalesce with other requests. The
+# response lists one result per item, in order, each with its own "index"
+# and, if it failed, "error". With "stream": true it is Server-Sent Events:
+#   event: result  {"index", ...}   (one per item, as each finishes)
+#   event: done    {"count", "errors"}
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "20"))
+BATCH_PARALLELISM = int(os.getenv("BATCH_PARALLELISM", "4"))
+
+
+class AIBatchRequest(BaseModel):
+    items: List[AIQueryRequest]
+    stream: bool = False
+
+
+def _batch_result(index: int, user_query: str, client_id: str, columnar: bool, task: asyncio.Future) -> dict:
+    try:
+        (response, rows_returned), _ = task.result()
+    except Exception as e:
+        logger.warning(f"⚠️ Batch item failed: {user_query[:100]}: {e}")
+        return {"index": index, "query": user_query, "error": str(e)[:300],
+                "summary": "The question could not be answered. Please try again."}
+    if rows_returned is not None:
+        log_query(user_query, response["sql"], rows_returned, response["summary"], client_id)
+    return {"index": index, **shape_rows(response, columnar), "query": user_query}
+
+
+@app.post("/ai_query/batch")
+async def ai_query_batch(payload: AIBatchRequest, request: Request):
+    if not payload.items:
+        raise HTTPException(status_code=400, detail="items must not be empty")
+    if len(payload.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"at most {BATCH_MAX_ITEMS} items per batch")
+
+    items = []
+    with span("extract_filters"):
+        for item in payload.items:
+            user_query = normalize_journey_phases(sanitize_user_query(item.query))
+            items.append((user_query, extract_filters_from_query(user_query), item.client_id or "unknown", item.columnar))
+
+    limit = asyncio.Semaphore(max(BATCH_PARALLELISM, 1))
+
+    async def run(user_query: str, filters: dict, key: tuple):
+        async with limit:
+            return await answer_flight.do(key, lambda: answer_query(user_query, filters))
+
+    tasks = {}  # cache key -> task, so repeats within the batch run once
+    item_tasks = []
+    for user_query, filters, _, _ in items:
+        key = sql_cache_key(user_query, filters)
+        if key not in tasks:
+            tasks[key] = asyncio.ensure_future(run(user_query, filters, key))
+        item_tasks.append(tasks[key])
+    annotate(batch=len(items), unique=len(tasks))
+
+    if not payload.stream:
+        finished = asyncio.ensure_future(asyncio.wait(tasks.values()))
+        watch = asyncio.ensure_future(until_disconnected(request))
+        await asyncio.wait({finished, watch}, return_when=asyncio.FIRST_COMPLETED)
+        watch.cancel()
+        if not finished.done():
+            finished.cancel()
+            for task in tasks.values():
+                task.cancel()
+            annotate(disconnected=True)
+            logger.info(f"⚠️ Client disconnected, cancelled a batch of {len(items)}")
+            return PlainTextResponse("Client disconnected", status_code=499)
+        return FastJSONResponse({"results": [
+            _batch_result(index, user_query, client_id, columnar, task)
+            for index, ((user_query, _, client_id, columnar), task) in enumerate(zip(items, item_tasks))]})
+
+    # The response starts before the batch finishes; events() closes the trace
+    trace = metrics.current_trace()
+    if trace is not None:
+        trace.deferred = True
+
+    indexes = {}  # task -> the items it answers
+    for index, task in enumerate(item_tasks):
+        indexes.setdefault(task, []).append(index)
+
+    async def events():
+        pending = set(indexes)
+        errors = 0
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    for index in indexes[task]:
+                        user_query, _, client_id, columnar = items[index]
+                        result = _batch_result(index, user_query, client_id, columnar, task)
+                        errors += "error" in result
+                        yield _sse("result", result)
+            yield _sse("done", {"count": len(items), "errors": errors})
+        finally:
+            for task in pending:  # the client went away mid-stream
+                task.cancel()
+            if trace is not None:
+                metrics.finish_trace(trace, 200)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# --- Streaming variant (Server-Sent Events) ---
+# Emits each stage as soon as it is ready so the extension can apply filters
+# and render rows while the summary is still being written:
+#   event: sql      {"query", "sql"}
+#   event: rows     {"rows", "filters"}
+#   event: summary  {"text"}   (one per completion chunk)
+#   event: done     {"summary"}
+#   event: error    {"error", "summary"}
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {dumps(data).decode()}\n\n"
+
+
+@app.post("/ai_query/stream")
+async def ai_query_stream(payload: AIQueryRequest):
+
+    user_query = normalize_journey_phases(sanitize_user_query(payload.query))
+
+    client_id = payload.client_id or "unknown"
+
+    # The response starts before the pipeline finishes; events() closes the trace
+    trace = metrics.current_trace()
+    if trace is not None:
+        trace.deferred = True
+
+    async def events():
+        try:
+            async for event in _stream_events():
+                yield event
+        finally:
+            if trace is not None:
+                metrics.finish_trace(trace, 200)
+
+    async def _stream_events():
+        with span("extract_filters"):
+            filters = extract_filters_from_query(user_query)
+        # Headers are already sent once streaming starts, so failures have to
+        # be reported as events rather than status codes.
+        try:
+            sql_query, cache_key, plan = await get_sql(user_query, filters)
+        except Exception as e:
+            yield _sse("error", {"error": str(e)[:300], "summary": "The question could not be converted to SQL. Please try again."})
+            return
+        yield _sse("sql", {"query": user_query, "sql": sql_query})
+
+        try:
+            results = await execute_sql(sql_query, plan)
+        except Exception as e:
+            if cache_key and not isinstance(e, resilience.CircuitOpen) and not db_pool.is_transient(e):
+                await off_loop(sql_cache.pop, cache_key)
+            yield _sse("error", {
+                "error": str(e)[:300],
+                "summary": "The query could not be executed. Please rephrase or simplify."
+            })
+            return
+
+        yield _sse("rows", {**shape_rows({"rows": results.head(RESPONSE_ROWS)}, payload.columnar), "filters": filters})
+
+        summary = local_summary_for(user_query, results)
+        if summary is not None:
+            yield _sse("summary", {"text": summary})
+            yield _sse("done", {"summary": summary})
+            log_query(user_query, sql_query, len(results), summary, client_id)
+            return
+
+        parts = []
+        try:
+            with span("llm_summary"):
+                async for text in stream_summary(user_query, results):
+                    parts.append(text)
+                    yield _sse("summary", {"text": text})
+        except Exception as e:
+            if parts or not openai_unavailable(e):
+                yield _sse("error", {"error": str(e)[:300], "summary": "".join(parts)})
+                return
+            parts = [fallback_summary(user_query, results, e)]
+            yield _sse("summary", {"text": parts[0]})
+        summary = "".join(parts)
+        yield _sse("done", {"summary": summary})
+
+        log_query(user_query, sql_query, len(results), summary, client_id)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
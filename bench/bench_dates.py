@@ -0,0 +1,325 @@
+"""
+Correctness corpus and benchmark for date_parser.parse_date_from_query.
+
+    python bench/bench_dates.py              # verify against the golden corpus, then time it
+    python bench/bench_dates.py --regenerate # rebuild dates_golden.json from the legacy parser
+
+Each corpus case pins "today", so results are reproducible. The expected
+values come from the original sequential-regex parser, kept below as
+legacy_parse (unchanged apart from taking "today" as an argument).
+"""
+import calendar
+import itertools
+import json
+import os
+import re
+import sys
+import time
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from date_parser import parse_date_from_query  # noqa: E402
+
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dates_golden.json")
+
+# January/February/April/October/December exercise last-month and
+# last-quarter rollover and the bare-month "this year vs last year" rule.
+TODAYS = [date(2026, 1, 15), date(2026, 2, 28), date(2026, 4, 1), date(2025, 10, 18), date(2024, 12, 31)]
+
+MONTH_NAMES = list(calendar.month_name)[1:]
+
+FORMS = [
+    # numeric ranges
+    "CPM from 1/6/26 - 2/14/26", "clicks 01/06/2026-02/14/2026", "spend 12/1/25 – 1/31/26",
+    "impressions 3/1/2026 — 3/31/2026 by platform", "ctr 1/1/26--1/7/26",
+    # week ranges
+    "Mar 16-22, 2026", "March 16-22, 2026", "march 16 - 22 2026", "clicks December 1-7, 2025",
+    "february 28-30, 2026",
+    # cross-month
+    "April 8 - June 2, 2025", "January 6, 2026 - February 14, 2026", "may 3 2026 - june 5, 2026",
+    "november 20 – december 5, 2025 spend", "august 1 -- september 30 2025",
+    # month-to-month
+    "March 2026 and April 2026", "January and April 2026", "in 2026 between January and April",
+    "october 2025 through march 2026", "june to august", "march - may", "january and march, 2025",
+    "CPM for march and april", "may to june 2024 vs 2025",
+    # month + year
+    "March 2026", "CTR in december 2025 by channel", "spend for may 2025",
+    # quarters
+    "Q1 2026", "q4 2025 impressions", "quarter 2 2026", "Quarter  3 2025", "q1 and q2 2026", "q5 2026",
+    # relative
+    "last month", "CPM last month by platform", "last quarter", "leads last quarter for Pinterest",
+    "ytd", "spend YTD", "year to date clicks", "last months", "cytd",
+    # bare months / years
+    "January", "CPM in march", "december spend", "may", "how did we do in november?",
+    "2025", "clicks in 2024 and 2025", "CPM for 2026", "2019", "21000",
+    # mixtures and precedence
+    "march 2026 vs last month", "Q1 2026 and March 2026", "last month ytd", "ytd 2025",
+    "march 16-22, 2026 and Q1 2026", "1/6/26 - 2/14/26 and march 2026", "june 2025 last quarter",
+    "january vs february", "march 5", "march 5 2026", "between march 1 and march 31 2026",
+    # nothing
+    "", "CPM by platform", "top 3 publishers by clicks", "month over month", "this month", "since January 2026",
+]
+
+
+def build_corpus() -> list:
+    queries = list(FORMS)
+    for month in MONTH_NAMES:
+        queries += [month, f"{month} 2025", f"{month.lower()} 16-22, 2026", f"{month} and December 2025",
+                    f"{month} 1 - {MONTH_NAMES[(MONTH_NAMES.index(month) + 1) % 12]} 2, 2026"]
+    for quarter, year in itertools.product(range(1, 5), (2024, 2025, 2026)):
+        queries += [f"Q{quarter} {year}", f"quarter {quarter} {year} CPM"]
+    return [{"query": q, "today": str(t)} for q in queries for t in TODAYS]
+
+
+def regenerate():
+    corpus = []
+    for case in build_corpus():
+        try:
+            expected = legacy_parse(case["query"], date.fromisoformat(case["today"]))
+        except ValueError as e:
+            expected = {"error": type(e).__name__}
+        corpus.append({**case, "expected": expected})
+    with open(GOLDEN, "w", encoding="utf-8") as f:
+        json.dump(corpus, f, indent=1, ensure_ascii=False)
+    print(f"Wrote {len(corpus)} cases to {GOLDEN}")
+
+
+def verify() -> bool:
+    with open(GOLDEN, encoding="utf-8") as f:
+        corpus = json.load(f)
+    failures = 0
+    for case in corpus:
+        try:
+            got = parse_date_from_query(case["query"], today=date.fromisoformat(case["today"]))
+        except ValueError as e:
+            got = {"error": type(e).__name__}
+        if got != case["expected"]:
+            failures += 1
+            print(f"❌ {case['query']!r} (today={case['today']})\n   expected {case['expected']}\n   got      {got}")
+    print(f"Golden corpus: {len(corpus) - failures}/{len(corpus)} identical")
+    return failures == 0
+
+
+def benchmark():
+    today = date(2026, 4, 1)
+    queries = [q for q in FORMS if q] + [
+        "What was the CPM by platform for Paid Social and Display, excluding Hulu DSE, over the period?",
+        "Show me site visits and engaged visits by journey phase for the Investor campaign on YouTube " * 3,
+    ]
+    queries = [q for q in queries if "/" not in q or "-" in q]
+
+    def run(fn):
+        best = float("inf")
+        for _ in range(5):
+            start = time.perf_counter()
+            for _ in range(20):
+                for q in queries:
+                    try:
+                        fn(q, today)
+                    except ValueError:
+                        pass
+            best = min(best, time.perf_counter() - start)
+        return best / (20 * len(queries)) * 1e6
+
+    legacy_us = run(legacy_parse)
+    new_us = run(lambda q, t: parse_date_from_query(q, today=t))
+    print(f"legacy {legacy_us:6.1f} µs/query   compiled {new_us:6.1f} µs/query   ({legacy_us / new_us:.1f}x)")
+
+
+def legacy_parse(query: str, today: date):
+    """The original parse_date_from_query from app.py (with today injected)."""
+    query_lower = query.lower()
+    
+    # ==== MONTH DETECTION (most specific) ====
+    month_names = {
+        'january': 1, 'february': 2, 'march': 3, 'april': 4,
+        'may': 5, 'june': 6, 'july': 7, 'august': 8,
+        'september': 9, 'october': 10, 'november': 11, 'december': 12
+    }
+
+    # Normalize Unicode en/em dashes to ASCII hyphen for date range matching
+    query_for_dates = re.sub(r'[–—]', '-', query_lower)
+
+    # ==== NUMERIC DATE RANGE (most specific) e.g. "1/6/26 - 2/14/26" ====
+    numeric_range = re.search(
+        r'\b(\d{1,2})/(\d{1,2})/(\d{2,4})\s*-+\s*(\d{1,2})/(\d{1,2})/(\d{2,4})\b',
+        query_for_dates
+    )
+    if numeric_range:
+        def _y(s): y = int(s); return 2000 + y if y < 100 else y
+        return {"field": "date", "values": [
+            str(date(_y(numeric_range.group(3)), int(numeric_range.group(1)), int(numeric_range.group(2)))),
+            str(date(_y(numeric_range.group(6)), int(numeric_range.group(4)), int(numeric_range.group(5))))
+        ]}
+
+    # ==== WEEK RANGE same month e.g. "Mar 16-22, 2026" ====
+    week_range = re.search(
+        r'\b(january|february|march|april|may|june|july|august|september|october|november|december)'
+        r'\s+(\d{1,2})\s*-+\s*(\d{1,2}),?\s+(20\d{2})\b',
+        query_for_dates
+    )
+    if week_range:
+        m = month_names[week_range.group(1)]
+        y = int(week_range.group(4))
+        return {"field": "date", "values": [
+            f"{y}-{m:02d}-{int(week_range.group(2)):02d}",
+            f"{y}-{m:02d}-{int(week_range.group(3)):02d}"
+        ]}
+
+    # ==== CROSS-MONTH DATE RANGE e.g. "Apr 8 - Jun 2, 2025" or "Jan 6, 2026 - Feb 14, 2026" ====
+    cross_month_range = re.search(
+        r'\b(january|february|march|april|may|june|july|august|september|october|november|december)'
+        r'\s+(\d{1,2})(?:,?\s+(20\d{2}))?\s*-+\s*'
+        r'(january|february|march|april|may|june|july|august|september|october|november|december)'
+        r'\s+(\d{1,2}),?\s+(20\d{2})\b',
+        query_for_dates
+    )
+    if cross_month_range:
+        end_year = int(cross_month_range.group(6))
+        start_year = int(cross_month_range.group(3)) if cross_month_range.group(3) else end_year
+        s_m = month_names[cross_month_range.group(1)]
+        e_m = month_names[cross_month_range.group(4)]
+        return {"field": "date", "values": [
+            f"{start_year}-{s_m:02d}-{int(cross_month_range.group(2)):02d}",
+            f"{end_year}-{e_m:02d}-{int(cross_month_range.group(5)):02d}"
+        ]}
+
+    # ==== MONTH-TO-MONTH RANGE e.g. "March 2026 and April 2026", "January and April 2026", "in 2026 between January and April" ====
+    month_range = re.search(
+        r'\b(january|february|march|april|may|june|july|august|september|october|november|december)'
+        r'(?:\s+(20\d{2}))?\s+(?:and|through|to|-)\s+'
+        r'(january|february|march|april|may|june|july|august|september|october|november|december)'
+        r'(?:\s+(20\d{2}))?\b',
+        query_for_dates
+    )
+    if month_range:
+        s_m = month_names[month_range.group(1)]
+        e_m = month_names[month_range.group(3)]
+        year_str = month_range.group(4) or month_range.group(2)
+        if not year_str:
+            y_match = re.search(r'\b(20\d{2})\b', query_for_dates)
+            year_str = y_match.group(1) if y_match else None
+        if year_str:
+            end_year = int(year_str)
+            start_year = int(month_range.group(2)) if month_range.group(2) else end_year
+            last_day = calendar.monthrange(end_year, e_m)[1]
+            return {"field": "date", "values": [
+                f"{start_year}-{s_m:02d}-01",
+                f"{end_year}-{e_m:02d}-{last_day:02d}"
+            ]}
+
+    # ==== MONTH DETECTION (month + year) ====
+    month_match = re.search(r'\b(january|february|march|april|may|june|july|august|september|october|november|december)\s+(20\d{2})\b', query_lower)
+    if month_match:
+        month_name = month_match.group(1)
+        month_num = month_names[month_name]
+        year = int(month_match.group(2))
+        
+        start_date = f"{year}-{month_num:02d}-01"
+        last_day = calendar.monthrange(year, month_num)[1]
+        end_date = f"{year}-{month_num:02d}-{last_day:02d}"
+        
+        return {
+            "field": "date",
+            "values": [start_date, end_date]
+        }
+    
+    # ==== QUARTER DETECTION ====
+    quarter_match = re.search(r'\b(q[1-4]|quarter\s+[1-4])\s+(20\d{2})\b', query_lower)
+    if quarter_match:
+        quarter = int(re.search(r'[1-4]', quarter_match.group(1)).group())
+        year = int(quarter_match.group(2))
+        
+        month_map = {1: 1, 2: 4, 3: 7, 4: 10}
+        start_month = month_map[quarter]
+        end_month = start_month + 2
+        
+        start_date = f"{year}-{start_month:02d}-01"
+        last_day = calendar.monthrange(year, end_month)[1]
+        end_date = f"{year}-{end_month:02d}-{last_day:02d}"
+        
+        return {
+            "field": "date",
+            "values": [start_date, end_date]
+        }
+    
+    # ==== RELATIVE DATES ====
+    if "last month" in query_lower:
+        if today.month == 1:
+            start_date = date(today.year - 1, 12, 1)
+        else:
+            start_date = date(today.year, today.month - 1, 1)
+        
+        end_date = date(today.year, today.month, 1) - timedelta(days=1)
+        
+        return {
+            "field": "date",
+            "values": [str(start_date), str(end_date)]
+        }
+    
+    if "last quarter" in query_lower:
+        current_quarter = (today.month - 1) // 3 + 1
+        if current_quarter == 1:
+            quarter = 4
+            year = today.year - 1
+        else:
+            quarter = current_quarter - 1
+            year = today.year
+        
+        month_map = {1: 1, 2: 4, 3: 7, 4: 10}
+        start_month = month_map[quarter]
+        end_month = start_month + 2
+        
+        start_date = f"{year}-{start_month:02d}-01"
+        last_day = calendar.monthrange(year, end_month)[1]
+        end_date = f"{year}-{end_month:02d}-{last_day:02d}"
+        
+        return {
+            "field": "date",
+            "values": [start_date, end_date]
+        }
+    
+    # ==== YEAR-TO-DATE ====
+    if "ytd" in query_lower or "year to date" in query_lower:
+        start_date = f"{today.year}-01-01"
+        end_date = str(today)
+        return {
+            "field": "date",
+            "values": [start_date, end_date]
+        }
+    
+    # ==== BARE MONTH (no year specified - default to most recent occurrence) ====
+    bare_month_match = re.search(r'\b(january|february|march|april|may|june|july|august|september|october|november|december)\b', query_lower)
+    if bare_month_match and not re.search(r'\b(20\d{2})\b', query_lower):
+        month_name = bare_month_match.group(1)
+        month_num = month_names[month_name]
+        # If the month has already passed or is current this year, use this year; otherwise last year
+        year = today.year if month_num <= today.month else today.year - 1
+        start_date = f"{year}-{month_num:02d}-01"
+        last_day = calendar.monthrange(year, month_num)[1]
+        end_date = f"{year}-{month_num:02d}-{last_day:02d}"
+        return {"field": "date", "values": [start_date, end_date]}
+
+    # ==== YEAR DETECTION (least specific - run last) ====
+    year_match = re.search(r'\b(20\d{2})\b', query_lower)
+    if year_match:
+        year = int(year_match.group(1))
+        start_date = f"{year}-01-01"
+        end_date = f"{year}-12-31"
+        return {
+            "field": "date",
+            "values": [start_date, end_date]
+        }
+    
+    return None
+
+
+if __name__ == "__main__":
+    if "--regenerate" in sys.argv:
+        regenerate()
+        sys.exit(0)
+    ok = verify()
+    benchmark()
+    sys.exit(0 if ok else 1)
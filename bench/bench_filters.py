@@ -0,0 +1,175 @@
+"""
+Golden-output check and microbenchmark for filter_matcher.ValueMatcher.
+
+    python bench/bench_filters.py              # verify against the golden corpus, then time it
+    python bench/bench_filters.py --regenerate # rebuild filters_golden.json from the legacy matcher
+
+The golden corpus (filters_golden.json) was produced by the original
+per-value regex loop from extract_filters_from_query, kept below as
+legacy_match. Any difference in output is reported and fails the run.
+"""
+import json
+import os
+import random
+import re
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("AZURE_OPENAI_ENDPOINT", "http://localhost")
+
+from app import FILTER_MAP  # noqa: E402
+from filter_matcher import ValueMatcher, expand_abbreviations  # noqa: E402
+
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "filters_golden.json")
+
+
+def legacy_match(query_lower: str, filter_map: dict) -> dict:
+    """The original categorical matching loop from extract_filters_from_query."""
+    query_normalized = re.sub(r'\bprea\b', 'pre-explore awareness', query_lower)
+    query_normalized = re.sub(r'\bpref\b', 'pre-explore familiarity', query_normalized)
+    query_normalized = re.sub(r'\bpre-a\b', 'pre-explore awareness', query_normalized)
+    query_normalized = re.sub(r'\bpre-f\b', 'pre-explore familiarity', query_normalized)
+    query_normalized = re.sub(r'\bexp\b', 'explore', query_normalized)
+    query_normalized = re.sub(r'\beva\b', 'evaluate', query_normalized)
+
+    filters = {}
+    for field, values in filter_map.items():
+        if values == "RANGE":
+            continue
+        sorted_values = sorted(values, key=lambda v: len(v or ""), reverse=True)
+        matched_values = []
+        matched_text = set()
+        for value in sorted_values:
+            if not value or value.lower() == "none":
+                continue
+            val_lower = value.lower()
+            pattern = r"\b" + re.escape(val_lower) + r"\b"
+            if re.search(pattern, query_normalized):
+                if any(val_lower in m for m in matched_text):
+                    continue
+                matched_values.append(value)
+                matched_text.add(val_lower)
+        if matched_values:
+            filters[field] = matched_values
+    return filters
+
+
+def new_match(matcher: ValueMatcher, query_lower: str) -> dict:
+    return matcher.match(expand_abbreviations(query_lower))
+
+
+HANDWRITTEN = [
+    "CPM by platform last month",
+    "top 3 publishers by clicks in Q1 2026",
+    "What was CTR for Hulu, Hulu DSE and Hulu Slate in March 2026?",
+    "impressions for USA Today vs USA last quarter",
+    "CPSV for PREA and PREF on Paid Social",
+    "site visits for pre-a, pre-f, exp and eva phases",
+    "video views on YouTube and the Video - Pre-Roll channel",
+    "Video completion rate for Connected TV",
+    "spend on The Trade Desk and Trade Desk",
+    "clicks for ESPN DSE vs ESPN vs ESPN2",
+    "brand vs non-brand CPC on Google and Bing",
+    "CPEV for the 250K campaign in Dallas and Seattle",
+    "National geography leads from Pinterest",
+    "performance for Mindset - Career Changer and Mindset - Golden Years",
+    "Website Retargeting vs Video Retargeting CTR",
+    "Run of Network Targeting and Run of Site Targeting impressions",
+    "$250K - Adults 25-64, $250K+ IA audience",
+    "what about null and none values",
+    "investing.com vs wall street journal vs WSJ",
+    "SiriusXM vs Sirius XM vs sirius",
+    "The Street Editorial vs the street",
+    "Disney Plus, Disney DSE, Discovery Plus and Discovery",
+    "CTR_by_platform: google_ads, _google_",
+    "Évaluer — Pre-Explore Awareness… EXP? EVA!",
+    "",
+    "   ",
+    "fox fs1 fbn foxsports",
+    "Quarter 2 FunnelStrategy and Performance",
+    "Skimms IG vs TheSkimm vs She Media",
+    "week by week day by day month year quarter",
+]
+
+TEMPLATES = [
+    "CPM for {} last month",
+    "{} impressions",
+    "clicks on {}, by platform",
+    "how did {} perform in 2025?",
+    "compare {} and {}",
+    "{} vs {} vs {} CTR",
+]
+
+
+def build_corpus(filter_map: dict) -> list:
+    values = sorted({v for vs in filter_map.values() if vs != "RANGE" for v in vs if v})
+    rng = random.Random(20260101)
+    queries = list(HANDWRITTEN)
+    for value in values:
+        queries.append(TEMPLATES[0].format(value))
+        queries.append(TEMPLATES[1].format(value.upper()))
+        queries.append(TEMPLATES[3].format(value.lower()))
+    for _ in range(300):
+        template = rng.choice(TEMPLATES[2:])
+        picks = [rng.choice(values) for _ in range(template.count("{}"))]
+        queries.append(template.format(*picks))
+    return queries
+
+
+def regenerate():
+    corpus = [{"query": q, "expected": legacy_match(q.lower(), FILTER_MAP)} for q in build_corpus(FILTER_MAP)]
+    with open(GOLDEN, "w", encoding="utf-8") as f:
+        json.dump(corpus, f, indent=1, ensure_ascii=False)
+    print(f"Wrote {len(corpus)} cases to {GOLDEN}")
+
+
+def verify(matcher: ValueMatcher) -> bool:
+    with open(GOLDEN, encoding="utf-8") as f:
+        corpus = json.load(f)
+    failures = 0
+    for case in corpus:
+        got = new_match(matcher, case["query"].lower())
+        if got != case["expected"]:
+            failures += 1
+            print(f"❌ {case['query']!r}\n   expected {case['expected']}\n   got      {got}")
+    print(f"Golden corpus: {len(corpus) - failures}/{len(corpus)} identical")
+    return failures == 0
+
+
+def timeit(fn, queries, repeat: int = 5) -> float:
+    """Best-of-``repeat`` microseconds per query."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for q in queries:
+            fn(q)
+        best = min(best, time.perf_counter() - start)
+    return best / len(queries) * 1e6
+
+
+def benchmark(matcher: ValueMatcher):
+    queries = [q.lower() for q in build_corpus(FILTER_MAP)]
+    legacy_us = timeit(lambda q: legacy_match(q, FILTER_MAP), queries)
+    new_us = timeit(lambda q: new_match(matcher, q), queries)
+    print(f"FILTER_MAP ({sum(len(v) for v in FILTER_MAP.values() if v != 'RANGE')} values): "
+          f"legacy {legacy_us:8.1f} µs/query   matcher {new_us:6.1f} µs/query   ({legacy_us / new_us:.1f}x)")
+
+    # Simulate the full publisher/placement lists the dashboard is about to get
+    big_map = dict(FILTER_MAP)
+    big_map["Placement"] = [f"Placement {i:05d} Site{i % 97}" for i in range(5000)]
+    big_matcher = ValueMatcher(big_map)
+    legacy_us = timeit(lambda q: legacy_match(q, big_map), queries[:100], repeat=2)
+    new_us = timeit(lambda q: new_match(big_matcher, q), queries[:100])
+    print(f"+5000 placements:            legacy {legacy_us:8.1f} µs/query   matcher {new_us:6.1f} µs/query   ({legacy_us / new_us:.1f}x)")
+
+
+if __name__ == "__main__":
+    if "--regenerate" in sys.argv:
+        regenerate()
+        sys.exit(0)
+    matcher = ValueMatcher(FILTER_MAP)
+    ok = verify(matcher)
+    benchmark(matcher)
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,97 @@
+"""
+Equivalence check and benchmark for partition_pruning against the fake DB.
+
+    python bench/bench_pruning.py
+
+Runs every templated question from bench_rollup's corpus, every date range
+that starts and ends within a few days of the 30/31-day boundary, and the
+fake OpenAI server's canned SQL, plus date predicates that only look like
+bounds (inside CASE, IIF or arithmetic), each with and without pruning on
+bench/fake_db.py. Any result that differs fails the run; the report shows
+how many statements lost a branch and the time per statement each way.
+Results are compared without the outer TOP, which picks arbitrarily among
+tied rows.
+"""
+import io
+import os
+import re
+import sys
+import time
+from contextlib import redirect_stdout
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("AZURE_OPENAI_ENDPOINT", "http://localhost")
+
+from bench import fake_db, fake_openai  # noqa: E402
+from bench.bench_rollup import corpus  # noqa: E402
+import partition_pruning  # noqa: E402
+import sql_templates  # noqa: E402
+
+
+def boundary_plans(recent_min: date) -> list:
+    days = [recent_min + timedelta(days=d) for d in range(-3, 4)]
+    base = sql_templates.plan_question("clicks by channel", {})
+    return [dict(base, date=[start.isoformat(), end.isoformat()]) for start in days for end in days if start <= end]
+
+
+def decoy_statements(recent_min: date) -> list:
+    """Date comparisons that are not conjuncts of the WHERE; none of them may prune a branch."""
+    wheres = (
+        f"CASE WHEN date >= '{recent_min}' THEN 1 ELSE 0 END = 0",
+        f"clicks > 0 AND CASE WHEN clicks > 0 AND date >= '{recent_min}' AND impressions > 0 THEN 1 ELSE 0 END = 0",
+        f"IIF(date >= '{recent_min}', 1, 0) = 0",
+        f"NOT date >= '{recent_min}'",
+        f"date >= '{recent_min}' OR clicks > 0",
+    )
+    return [f"SELECT SUM(clicks) AS Clicks FROM (SELECT clicks FROM {partition_pruning.RECENT} WHERE {where} "
+            f"UNION ALL SELECT clicks FROM {partition_pruning.OLDER} WHERE {where}) AS t" for where in wheres]
+
+
+def _rows(cursor, sql: str) -> tuple:
+    sql = re.sub(r"^SELECT\s+TOP\s*\(?\d+\)?\s+", "SELECT ", sql)
+    start = time.perf_counter()
+    cursor.execute(sql)
+    rows = sorted(tuple(r) for r in cursor.fetchall())
+    return rows, time.perf_counter() - start
+
+
+def main():
+    conn, _ = fake_db.connect()
+    recent_min, older_max = partition_pruning.probe(conn)
+    print(f"{partition_pruning.RECENT} from {recent_min}, {partition_pruning.OLDER} to {older_max}")
+
+    with redirect_stdout(io.StringIO()):
+        statements = [sql_templates.render(plan) for _, plan in corpus()]
+    statements += [sql_templates.render(plan) for plan in boundary_plans(recent_min)]
+    statements += [sql for _, sql in fake_openai.CANNED_SQL] + [fake_openai.DEFAULT_SQL]
+    statements += decoy_statements(recent_min)
+
+    mismatches = pruned = 0
+    full_seconds = pruned_seconds = 0.0
+    cursor = conn.cursor()
+    for sql in statements:
+        new_sql, dropped = partition_pruning.prune(sql, recent_min, older_max)
+        expected, t_full = _rows(cursor, sql)
+        full_seconds += t_full
+        if not dropped:
+            pruned_seconds += t_full
+            continue
+        pruned += 1
+        actual, t_pruned = _rows(cursor, new_sql)
+        pruned_seconds += t_pruned
+        if actual != expected:
+            mismatches += 1
+            if mismatches <= 5:
+                print(f"MISMATCH (dropped {dropped})\n{sql}\n  full:   {expected[:3]}\n  pruned: {actual[:3]}")
+
+    n = len(statements)
+    print(f"{n} statements, {pruned} pruned, {mismatches} mismatches")
+    print(f"unpruned: {full_seconds / n * 1000:8.2f} ms/statement")
+    print(f"pruned:   {pruned_seconds / n * 1000:8.2f} ms/statement")
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Equivalence check and benchmark for rollup.RollupStore against SQL.
+
+    python bench/bench_rollup.py                # all template shapes in the corpus
+    python bench/bench_rollup.py --days-rows 200
+
+Builds the bench/fake_db.py SQLite database, compiles a corpus of templated
+questions, runs each plan both as SQL (sql_templates.render, on SQLite) and
+through the rollup, and reports any result that differs, then the time per
+question each way. Rows are compared as sets unless the plan orders by a
+metric, where the metric sequence must match too.
+"""
+import argparse
+import io
+import itertools
+import math
+import os
+import sys
+import time
+from contextlib import contextmanager, redirect_stdout
+from datetime import date
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("AZURE_OPENAI_ENDPOINT", "http://localhost")
+
+METRICS = ("clicks", "CPM", "ctr", "site visits", "video views", "vcr", "cost per click", "spend",
+           "impressions and clicks", "cpsv", "viewability", "engaged visits", "leads", "cpcv")
+DIMENSIONS = ("", " by platform", " by channel", " by journey phase", " by month", " daily", " by campaign",
+              " by publisher", " by platform by month")
+DATES = ("", " last month", " in Q1 2026", " in 2025", " march 2026", " ytd")
+FILTERS = ("", " for paid social", " for the investor campaign", " for explore phase")
+PREFIXES = ("", "top 3 ", "which platform had the highest ", "lowest ", "bottom 2 ")
+
+
+def corpus() -> list:
+    from app import extract_filters_from_query, normalize_journey_phases, sanitize_user_query
+    import sql_templates
+    plans = []
+    for parts in itertools.product(PREFIXES, METRICS, DIMENSIONS, FILTERS, DATES):
+        question = normalize_journey_phases(sanitize_user_query("".join(parts)))
+        plan = sql_templates.plan_question(question, extract_filters_from_query(question))
+        if plan is not None:
+            plans.append((question, plan))
+    return plans
+
+
+def _same(a, b) -> bool:
+    if a is None or b is None:
+        return a is None and b is None
+    if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+        return math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-9)
+    return str(a)[:10] == str(b)[:10]
+
+
+def _key(row) -> tuple:
+    return tuple("" if v is None else (round(v, 6) if isinstance(v, float) else str(v)[:10]) for v in row)
+
+
+def equivalent(plan: dict, expected: list, actual: list) -> bool:
+    if len(expected) != len(actual):
+        return False
+    if plan["order"]:
+        position = len(plan["dimensions"]) + plan["metrics"].index(plan["order"][0])
+        if not all(_same(e[position], a[position]) for e, a in zip(expected, actual)):
+            return False
+        if plan["limit"]:
+            return True  # ties at the cut-off may pick different rows
+    return all(all(_same(x, y) for x, y in zip(e, a))
+               for e, a in zip(sorted(expected, key=_key), sorted(actual, key=_key)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--days-rows", type=int, default=60, help="synthetic rows per day")
+    args = parser.parse_args()
+    os.environ["FAKE_DB_DAYS_ROWS"] = str(args.days_rows)
+
+    from bench import fake_db
+    import rollup
+    import sql_templates
+
+    @contextmanager
+    def connection():
+        conn, _ = fake_db.connect()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    store = rollup.RollupStore(connection, epoch=date.today)
+    start = time.perf_counter()
+    store.refresh(wait=True)
+    print(f"rollup: {store.stats()['rows']} rows, {store.stats()['bytes'] / 1e6:.1f} MB, "
+          f"built in {time.perf_counter() - start:.2f}s")
+
+    with redirect_stdout(io.StringIO()):  # extract_filters_from_query prints every date it detects
+        plans = corpus()
+    sql_seconds = rollup_seconds = 0.0
+    mismatches = 0
+    with connection() as conn:
+        for question, plan in plans:
+            cursor = conn.cursor()
+            t0 = time.perf_counter()
+            cursor.execute(sql_templates.render(plan))
+            expected = [tuple(r) for r in cursor.fetchall()]
+            t1 = time.perf_counter()
+            result = store.answer(plan)
+            t2 = time.perf_counter()
+            sql_seconds += t1 - t0
+            rollup_seconds += t2 - t1
+            actual = result.rows() if result is not None else None
+            if actual is None or not equivalent(plan, expected, actual):
+                mismatches += 1
+                if mismatches <= 5:
+                    print(f"MISMATCH {question!r}\n  sql:    {expected[:3]}\n  rollup: {(actual or [])[:3]}")
+
+    n = len(plans)
+    print(f"{n} plans, {mismatches} mismatches")
+    print(f"SQL (SQLite):  {sql_seconds / n * 1000:8.2f} ms/question")
+    print(f"rollup:        {rollup_seconds / n * 1000:8.2f} ms/question")
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
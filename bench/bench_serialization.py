@@ -0,0 +1,82 @@
+"""
+Benchmark for responses.py: encoding and payload size of query results.
+
+    python bench/bench_serialization.py
+    python bench/bench_serialization.py --rows 5000
+
+Builds a result shaped like the pyodbc rows behind /ai_query (Decimal
+metrics, date and datetime columns, strings) and compares the old path
+(records through jsonable_encoder, then json.dumps) with responses.dumps
+for records and for the columnar payload, plus gzip/brotli sizes. Fails if
+responses.dumps decodes to anything other than what jsonable_encoder gives.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+
+import responses  # noqa: E402
+from result_set import ResultSet  # noqa: E402
+
+COLUMNS = ["date", "loaded_at", "channel", "Platform", "impressions", "clicks", "spend", "CPM", "CTR"]
+
+
+def result(rows: int) -> ResultSet:
+    rng = random.Random(7)
+    data = [[] for _ in COLUMNS]
+    for i in range(rows):
+        impressions = rng.randint(1000, 2_000_000)
+        clicks = rng.randint(0, impressions // 50)
+        spend = Decimal(rng.randint(100, 5_000_000)) / 100
+        row = [date(2026, 1, 1) + timedelta(days=i % 365), datetime(2026, 10, 1, 6, 30, 15),
+               rng.choice(["Paid Social", "Display", "Video", "Search"]), rng.choice(["Meta", "YouTube", "Hulu", "ESPN"]),
+               Decimal(impressions), Decimal(clicks), spend, (spend * 1000 / impressions).quantize(Decimal("0.0001")),
+               Decimal(clicks) / Decimal(impressions)]
+        for values, value in zip(data, row):
+            values.append(value)
+    return ResultSet(COLUMNS, data)
+
+
+def timed(fn, repeat: int) -> tuple:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        out = fn()
+    return out, (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    results = result(args.rows)
+    records = results.records()
+    table = {"columns": results.columns, "rows": results.rows()}
+
+    old, t_old = timed(lambda: json.dumps(jsonable_encoder({"rows": records})).encode(), args.repeat)
+    new, t_new = timed(lambda: responses.dumps({"rows": records}), args.repeat)
+    columnar, t_columnar = timed(lambda: responses.dumps(table), args.repeat)
+
+    ok = json.loads(new) == json.loads(old)
+    ok = ok and json.loads(columnar)["rows"] == [list(r.values()) for r in json.loads(old)["rows"]]
+    print(f"{args.rows} rows, encoder: {'orjson' if responses.orjson else 'json'}, equivalent: {ok}")
+    print(f"{'payload':28} {'ms':>8} {'bytes':>10} {'gzip':>9} {'br':>9}")
+    for name, body, seconds in (("records, jsonable_encoder", old, t_old), ("records, responses.dumps", new, t_new),
+                                ("columnar, responses.dumps", columnar, t_columnar)):
+        br = len(responses.compress(body, "br")) if responses.brotli else float("nan")
+        print(f"{name:28} {seconds * 1000:8.2f} {len(body):10d} {len(responses.compress(body, 'gzip')):9d} {br:9.0f}")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
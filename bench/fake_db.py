@@ -0,0 +1,211 @@
+"""
+SQLite stand-in for Azure SQL, for offline load tests.
+
+    SQL_CONNECT_FACTORY=bench.fake_db:connect uvicorn app:app
+
+Builds a shared in-memory database with v_TableauData_30Days (last 31 days)
+and Tableau_31DaysandOlder (older, up to 25 months) filled with synthetic
+campaign rows using the documented columns, plus the two audit tables.
+Connections wrap sqlite3 in the small slice of the pyodbc API the app uses,
+and rewrite the T-SQL the app generates into SQLite (TOP n → LIMIT n,
+ISNULL → IFNULL, FORMAT(date, 'yyyy-MM') as a function).
+
+    FAKE_DB_DAYS_ROWS   rows per day (default 60)
+    FAKE_DB_LATENCY_MS  added to every execute, to mimic the network (default 0)
+
+Like pyodbc, a cursor takes the connection's ``timeout`` when it is created
+and an execute that runs past it fails with SQLSTATE HYT00.
+"""
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from datetime import date, timedelta
+
+URI = "file:tableau_bench?mode=memory&cache=shared"
+TABLES = ("v_TableauData_30Days", "Tableau_31DaysandOlder")
+
+COLUMNS = (
+    ("date", "TEXT"), ("Campaign", "TEXT"), ("channel", "TEXT"), ("FunnelStrategy", "TEXT"),
+    ("journeyPhase", "TEXT"), ("Platform", "TEXT"), ("Publisher", "TEXT"), ("Geography", "TEXT"),
+    ("[Targeting Strategy]", "TEXT"), ("[Target Audience]", "TEXT"), ("callcount", "INTEGER"),
+    ("clicks", "INTEGER"), ("impressions", "INTEGER"), ("mediaCost", "REAL"), ("siteVisits", "INTEGER"),
+    ("TotalConversions", "INTEGER"), ("ConversionTagName", "TEXT"), ("videoFullyPlayed", "INTEGER"),
+    ("videoViews", "INTEGER"), ("VideoPlays", "INTEGER"), ("tablename", "TEXT"), ("mediaBuyName", "TEXT"),
+    ("[Viewable Impressions]", "INTEGER"), ("[Measured Impressions]", "INTEGER"),
+    ("[Engaged Visits]", "INTEGER"), ("Leads", "INTEGER"),
+)
+
+CAMPAIGNS = ("250K", "EdWoW", "GenNext", "Investor", "PIC", "PII")
+CHANNELS = ("Connected TV", "Paid Search", "Display", "Paid Social", "YouTube", "Native", "Video", "Audio", "Podcast")
+PHASES = ("Pre-Explore Awareness", "Pre-Explore Familiarity", "Explore", "Evaluate", "None")
+PLATFORMS = ("ABC", "Amazon", "Bing", "CNBC", "DV360", "ESPN", "Facebook", "Google", "Hulu", "Instagram",
+             "LinkedIn", "Netflix", "Pandora", "Pinterest", "Spotify", "The Trade Desk", "WSJ")
+PUBLISHERS = ("Conde Nast", "Discovery", "Nasdaq", "Nativo", "NBC", "Roku", "Sirius XM", "USA Today", "YouTube")
+GEOGRAPHIES = ("Designated Market Areas", "National", "High Net Worth", "Local")
+TARGETING = ("Contextual Targeting", "Lookalike Modeling", "Website Retargeting", "Run of Site Targeting")
+FLOODLIGHTS = ("Floodlight - ACC - EJ Investor All Pages", "Floodlight - ACC - Match Tool - Landing Page", None)
+SOURCES = ("v_GoogleAds", "v_YouTubePaidMedia", "v_LinkedInCampaign", "v_TTD")
+
+_ISNULL = re.compile(r"\bISNULL\s*\(", re.IGNORECASE)  # ISNULL is an operator keyword in SQLite
+_TOP = re.compile(r"^(\s*(?:WITH\b.*?\)\s*)?SELECT\s+)TOP\s*\(?\s*(\d+)\s*\)?\s+", re.IGNORECASE | re.DOTALL)
+_keeper = None  # the shared in-memory DB lives as long as one connection to it does
+_lock = threading.Lock()
+
+
+def _format(value, fmt):
+    """FORMAT(date, 'yyyy-MM') and friends, for ISO date strings."""
+    if value is None:
+        return None
+    value = str(value)
+    return {"yyyy-MM": value[:7], "yyyy": value[:4], "yyyy-MM-dd": value[:10]}.get(fmt, value)
+
+
+def to_sqlite(sql: str) -> str:
+    """Rewrite the T-SQL shapes the app generates into SQLite."""
+    sql = _ISNULL.sub("IFNULL(", sql.strip().rstrip(";"))
+    match = _TOP.match(sql)
+    if match:
+        sql = match.group(1) + sql[match.end():] + f"\nLIMIT {match.group(2)}"
+    return sql
+
+
+def _rows(day: date, per_day: int, rng: random.Random):
+    for _ in range(per_day):
+        channel = rng.choice(CHANNELS)
+        impressions = rng.randint(0, 200000) if channel not in ("Paid Search", "Audio", "Podcast") else 0
+        clicks = rng.randint(0, max(1, impressions // 200)) if impressions else rng.randint(0, 800)
+        video = channel in ("Connected TV", "YouTube", "Video")
+        views = rng.randint(0, impressions // 2) if video and impressions else 0
+        yield (
+            day.isoformat(), rng.choice(CAMPAIGNS), channel, rng.choice(("Brand", "Performance", "Brand", "NA")),
+            rng.choice(PHASES), rng.choice(PLATFORMS), rng.choice(PUBLISHERS), rng.choice(GEOGRAPHIES),
+            rng.choice(TARGETING), "Adults 25-64", rng.randint(0, 5),
+            clicks, impressions, round(rng.uniform(5, 5000), 2), rng.randint(0, 300),
+            rng.randint(0, 50), rng.choice(FLOODLIGHTS), views // 2 if views else 0,
+            views, rng.randint(0, views) if views else 0, rng.choice(SOURCES),
+            rng.choice(("Prospecting_NonSkippable", "Bumper_6s", "Standard_Display", "Retargeting")),
+            int(impressions * 0.7), int(impressions * 0.9), rng.randint(0, 120), rng.randint(0, 15),
+        )
+
+
+def build(conn: sqlite3.Connection, per_day: int = 60, months: int = 25, today: date = None):
+    today = today or date.today()
+    rng = random.Random(20260101)
+    ddl = ", ".join(f"{name} {kind}" for name, kind in COLUMNS)
+    placeholders = ", ".join("?" for _ in COLUMNS)
+    for table in TABLES:
+        conn.execute(f"CREATE TABLE {table} ({ddl})")
+        conn.execute(f"CREATE INDEX ix_{table}_date ON {table} (date)")
+    conn.execute("CREATE TABLE tableau_ai_test (id INTEGER PRIMARY KEY, question TEXT)")
+    conn.execute("CREATE TABLE Tableau_AI_QueryLog (id INTEGER PRIMARY KEY, user_query TEXT, sql_generated TEXT, "
+                 "rows_returned INTEGER, summary TEXT, tableau_user TEXT)")
+    for offset in range(1, months * 31):
+        day = today - timedelta(days=offset)
+        table = TABLES[0] if offset <= 31 else TABLES[1]
+        conn.executemany(f"INSERT INTO {table} VALUES ({placeholders})", _rows(day, per_day, rng))
+    conn.commit()
+
+
+def _timeout_error() -> sqlite3.OperationalError:
+    """What pyodbc raises when SQL_ATTR_QUERY_TIMEOUT expires."""
+    return sqlite3.OperationalError("HYT00", "[HYT00] [Fake DB] Query timeout expired (0) (SQLExecDirectW)")
+
+
+class Cursor:
+    """The part of the pyodbc cursor API the app uses."""
+
+    def __init__(self, cursor: sqlite3.Cursor, latency: float, timeout: int = 0):
+        self._cursor = cursor
+        self._latency = latency
+        self.timeout = timeout
+        self.fast_executemany = False
+
+    def cancel(self):
+        self._cursor.connection.interrupt()
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    def execute(self, sql: str, *params):
+        if len(params) == 1 and isinstance(params[0], (tuple, list)):
+            params = tuple(params[0])
+        if not self.timeout:
+            if self._latency:
+                time.sleep(self._latency)
+            self._cursor.execute(to_sqlite(sql), params)
+            return self
+        deadline = time.monotonic() + self.timeout
+        if self._latency:
+            time.sleep(min(self._latency, self.timeout))
+            if self._latency >= self.timeout:
+                raise _timeout_error()
+        conn = self._cursor.connection
+        conn.set_progress_handler(lambda: time.monotonic() > deadline, 1000)
+        try:
+            self._cursor.execute(to_sqlite(sql), params)
+        except sqlite3.OperationalError as e:
+            if time.monotonic() > deadline:
+                raise _timeout_error() from e
+            raise
+        finally:
+            conn.set_progress_handler(None, 0)
+        return self
+
+    def executemany(self, sql: str, rows):
+        if self._latency:
+            time.sleep(self._latency)
+        self._cursor.executemany(to_sqlite(sql), rows)
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchmany(self, size: int):
+        return self._cursor.fetchmany(size)
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def close(self):
+        self._cursor.close()
+
+
+class Connection:
+    def __init__(self, conn: sqlite3.Connection, latency: float):
+        self._conn = conn
+        self._latency = latency
+        self.timeout = 0  # seconds, 0 = none; read by cursor() like pyodbc's
+
+    def cursor(self) -> Cursor:
+        return Cursor(self._conn.cursor(), self._latency, self.timeout)
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def close(self):
+        self._conn.close()
+
+
+def _open() -> sqlite3.Connection:
+    conn = sqlite3.connect(URI, uri=True, check_same_thread=False)
+    conn.create_function("FORMAT", 2, _format, deterministic=True)
+    return conn
+
+
+def connect():
+    """SQL_CONNECT_FACTORY entry point: (connection, expires_on) like db_pool.open_connection."""
+    global _keeper
+    with _lock:
+        if _keeper is None:
+            _keeper = _open()
+            start = time.perf_counter()
+            build(_keeper, per_day=int(os.getenv("FAKE_DB_DAYS_ROWS", "60")))
+            print(f"Fake DB ready in {time.perf_counter() - start:.1f}s")
+    latency = float(os.getenv("FAKE_DB_LATENCY_MS", "0")) / 1000
+    return Connection(_open(), latency), time.time() + 3600
@@ -0,0 +1,131 @@
+"""
+Local stand-in for the Azure OpenAI chat completions endpoint.
+
+    python bench/fake_openai.py --port 8100 --latency 0.8 --summary-latency 1.2
+
+Point the app at it with AZURE_OPENAI_ENDPOINT=http://127.0.0.1:8100 and any
+AZURE_OPENAI_API_KEY. SQL-generation calls (system prompt "You are a helpful
+SQL assistant.") get canned SQL chosen by keywords in the question — written
+in the T-SQL subset bench/fake_db.py understands — and everything else gets
+a canned summary. Streaming requests are answered as SSE chunks. Usage
+reports prompt tokens (~4 characters each) and, once a prompt prefix has been
+seen, the cached part of it in 128-token steps like the real service.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+FUNNEL = "FunnelStrategy NOT IN ('Null', 'NA', 'Quarter 2')"
+
+
+def _union(columns: str, where: str = "1 = 1") -> str:
+    return (f"FROM (SELECT {columns} FROM v_TableauData_30Days WHERE {where} AND {FUNNEL} "
+            f"UNION ALL SELECT {columns} FROM Tableau_31DaysandOlder WHERE {where} AND {FUNNEL}) AS CombinedData")
+
+
+# (keyword, SQL), first match wins
+CANNED_SQL = (
+    ("cpm", "SELECT TOP 5 Platform, SUM(mediaCost) * 1000.0 / NULLIF(SUM(impressions), 0) AS CPM "
+            + _union("Platform, mediaCost, impressions", "date >= date('now', '-90 day')")
+            + " GROUP BY Platform ORDER BY CPM ASC"),
+    ("site visit", "SELECT journeyPhase, ISNULL(SUM(siteVisits), 0) + ISNULL(SUM(CASE WHEN tablename = 'v_LinkedInCampaign' "
+                   "THEN TotalConversions ELSE 0 END), 0) AS SiteVisits "
+                   + _union("journeyPhase, siteVisits, tablename, TotalConversions", "journeyPhase <> 'None'")
+                   + " GROUP BY journeyPhase"),
+    ("month", "SELECT FORMAT(date, 'yyyy-MM') AS Month, SUM(clicks) AS Clicks, SUM(impressions) AS Impressions "
+              + _union("date, clicks, impressions") + " GROUP BY FORMAT(date, 'yyyy-MM') ORDER BY Month"),
+    ("video", "SELECT channel, SUM(videoFullyPlayed) * 1.0 / NULLIF(COALESCE(SUM(videoViews), 0) + COALESCE(SUM(VideoPlays), 0), 0) AS VCR "
+              + _union("channel, videoFullyPlayed, videoViews, VideoPlays") + " GROUP BY channel"),
+)
+DEFAULT_SQL = ("SELECT channel, SUM(clicks) AS Clicks, SUM(mediaCost) AS Spend "
+               + _union("channel, clicks, mediaCost", "date >= date('now', '-31 day')") + " GROUP BY channel ORDER BY Clicks DESC")
+
+SUMMARY = ("Paid Social delivered the most clicks over the period at a lower cost per click than Display, "
+           "while Connected TV carried most of the impressions. Spend was concentrated in the top three channels.")
+
+app = FastAPI()
+settings = argparse.Namespace(latency=0.5, summary_latency=0.8, jitter=0.2, chunk_delay=0.02)
+_seen_prefixes = set()
+
+
+def _delay(base: float) -> float:
+    return max(0.0, base * (1 + random.uniform(-settings.jitter, settings.jitter)))
+
+
+def _usage(prompt: str, completion: str) -> dict:
+    prompt_tokens = max(1, len(prompt) // 4)
+    prefix = prompt[:4096]
+    cached = 0
+    if prompt_tokens >= 1024 and prefix in _seen_prefixes:
+        cached = (min(prompt_tokens, 1024) // 128) * 128
+    _seen_prefixes.add(prefix)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": max(1, len(completion) // 4),
+        "total_tokens": prompt_tokens + max(1, len(completion) // 4),
+        "prompt_tokens_details": {"cached_tokens": cached},
+    }
+
+
+def _answer(messages: list) -> tuple:
+    is_sql = any(m.get("role") == "system" and "SQL assistant" in m.get("content", "") for m in messages)
+    prompt = "\n".join(m.get("content", "") for m in messages)
+    if not is_sql:
+        return SUMMARY, prompt, settings.summary_latency
+    question = prompt.rsplit("User question:", 1)[-1].lower()
+    sql = next((sql for keyword, sql in CANNED_SQL if keyword in question), DEFAULT_SQL)
+    return sql, prompt, settings.latency
+
+
+@app.post("/openai/deployments/{deployment}/chat/completions")
+async def chat_completions(deployment: str, request: Request):
+    body = await request.json()
+    content, prompt, latency = _answer(body.get("messages", []))
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+    created = int(time.time())
+
+    if not body.get("stream"):
+        await asyncio.sleep(_delay(latency))
+        return JSONResponse({
+            "id": completion_id, "object": "chat.completion", "created": created, "model": deployment,
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+            "usage": _usage(prompt, content),
+        })
+
+    async def chunks():
+        await asyncio.sleep(_delay(latency) / 2)  # time to first token
+        words = content.split(" ")
+        for i, word in enumerate(words):
+            delta = {"content": word if i == 0 else " " + word}
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": deployment,
+                     "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+            yield f"data: {json.dumps(chunk)}\n\n"
+            await asyncio.sleep(settings.chunk_delay)
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(chunks(), media_type="text/event-stream")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency", type=float, default=settings.latency, help="seconds per SQL completion")
+    parser.add_argument("--summary-latency", type=float, default=settings.summary_latency, help="seconds per summary")
+    parser.add_argument("--jitter", type=float, default=settings.jitter, help="± fraction applied to latencies")
+    parser.add_argument("--chunk-delay", type=float, default=settings.chunk_delay, help="seconds between stream chunks")
+    args = parser.parse_args()
+    for key in ("latency", "summary_latency", "jitter", "chunk_delay"):
+        setattr(settings, key, getattr(args, key))
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
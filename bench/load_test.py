@@ -0,0 +1,226 @@
+"""
+Offline end-to-end load test for /ai_query.
+
+    python bench/load_test.py                                  # defaults: 1, 4, 16 concurrent clients
+    python bench/load_test.py --concurrency 8,32 --requests 400 --cold
+    python bench/load_test.py --endpoint /ai_query/stream --openai-latency 0.2
+    python bench/load_test.py --url http://127.0.0.1:8000       # an app you started yourself
+
+Unless --url is given this starts, as subprocesses:
+  - bench/fake_openai.py — the Azure OpenAI stand-in (canned SQL/summaries, configurable latency)
+  - the app under uvicorn, with SQL_CONNECT_FACTORY=bench.fake_db:connect (SQLite with
+    synthetic campaign rows) and AZURE_OPENAI_API_KEY pointing it at the stand-in
+so no network or Azure credentials are needed. For each concurrency level it
+reports throughput and p50/p95/p99 latency, then the mean time per pipeline
+stage taken from the app's /metrics (with --workers > 1, from whichever
+worker answers the scrape; the workers share a temporary SHARED_CACHE_PATH).
+"""
+import argparse
+import asyncio
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEADERS = {"X-Tableau-Extension": "true"}
+
+# A mix of template-path questions, LLM-path questions and repeats
+QUESTIONS = (
+    "clicks by channel last month",
+    "CPM by platform last quarter",
+    "top 3 platforms by CPM in 2025",
+    "site visits by journey phase in Q1 2026",
+    "impressions and clicks by month in 2025",
+    "What was the video completion rate for Connected TV vs YouTube?",
+    "Which publisher drove the most engaged visits for the Investor campaign?",
+    "How did ESPN do compared to Hulu last month?",
+    "CPSV for Paid Social year to date",
+    "spend by campaign category for march 2026",
+    "clicks by channel last month",
+    "CPM by platform last quarter",
+)
+
+_STAGE_LINE = re.compile(r'^tableau_ai_stage_seconds_(sum|count)\{stage="([^"]+)"\} ([0-9.e+-]+)$', re.MULTILINE)
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return float("nan")
+    rank = max(1, int(round(pct / 100 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+async def stage_totals(client: httpx.AsyncClient) -> dict:
+    """{stage: [sum seconds, count]} from /metrics."""
+    try:
+        text = (await client.get("/metrics")).text
+    except httpx.HTTPError:
+        return {}
+    totals = {}
+    for kind, stage, value in _STAGE_LINE.findall(text):
+        entry = totals.setdefault(stage, [0.0, 0])
+        if kind == "sum":
+            entry[0] = float(value)
+        else:
+            entry[1] = int(float(value))
+    return totals
+
+
+async def one_request(client: httpx.AsyncClient, endpoint: str, question: str, client_id: str) -> tuple:
+    start = time.perf_counter()
+    try:
+        if endpoint.endswith("/stream"):
+            async with client.stream("POST", endpoint, json={"query": question, "client_id": client_id}, headers=HEADERS) as r:
+                body = (await r.aread()).decode()
+                ok = r.status_code == 200 and "event: done" in body
+        else:
+            r = await client.post(endpoint, json={"query": question, "client_id": client_id}, headers=HEADERS)
+            ok = r.status_code == 200 and "error" not in r.json()
+    except httpx.HTTPError:
+        ok = False
+    return time.perf_counter() - start, ok
+
+
+async def run_level(client: httpx.AsyncClient, endpoint: str, concurrency: int, total: int) -> dict:
+    latencies, errors = [], 0
+    next_index = 0
+
+    async def worker(worker_id: int):
+        nonlocal next_index, errors
+        while next_index < total:
+            i = next_index
+            next_index += 1
+            elapsed, ok = await one_request(client, endpoint, QUESTIONS[i % len(QUESTIONS)], f"load-{worker_id}")
+            latencies.append(elapsed)
+            errors += not ok
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(w) for w in range(concurrency)))
+    wall = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "concurrency": concurrency, "requests": len(latencies), "errors": errors, "rps": len(latencies) / wall,
+        "p50": percentile(latencies, 50), "p95": percentile(latencies, 95), "p99": percentile(latencies, 99),
+        "max": latencies[-1] if latencies else float("nan"),
+    }
+
+
+async def drive(args) -> int:
+    levels = [int(c) for c in args.concurrency.split(",")]
+    limits = httpx.Limits(max_connections=max(levels) + 4, max_keepalive_connections=max(levels) + 4)
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+        for _ in range(args.warmup):
+            await one_request(client, args.endpoint, QUESTIONS[0], "warmup")
+        before = await stage_totals(client)
+
+        print(f"\n{args.endpoint} — {args.requests} requests per level")
+        print(f"{'conc':>5} {'reqs':>6} {'errors':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+        failures = 0
+        for level in levels:
+            r = await run_level(client, args.endpoint, level, args.requests)
+            failures += r["errors"]
+            print(f"{r['concurrency']:>5} {r['requests']:>6} {r['errors']:>6} {r['rps']:>8.1f} "
+                  f"{r['p50'] * 1000:>8.0f} {r['p95'] * 1000:>8.0f} {r['p99'] * 1000:>8.0f} {r['max'] * 1000:>8.0f}")
+
+        after = await stage_totals(client)
+        if after:
+            print(f"\n{'stage':<16} {'calls':>7} {'mean ms':>9}")
+            for stage, (total, count) in sorted(after.items()):
+                prev_total, prev_count = before.get(stage, [0.0, 0])
+                calls = count - prev_count
+                if calls:
+                    print(f"{stage:<16} {calls:>7} {(total - prev_total) / calls * 1000:>9.1f}")
+    return 1 if failures else 0
+
+
+def wait_ready(url: str, timeout: float = 60.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout:.0f}s")
+
+
+def start_stack(args) -> list:
+    procs = []
+    openai_url = args.openai_url
+    if not openai_url:
+        openai_url = f"http://127.0.0.1:{args.openai_port}"
+        procs.append(subprocess.Popen([
+            sys.executable, os.path.join(ROOT, "bench", "fake_openai.py"), "--port", str(args.openai_port),
+            "--latency", str(args.openai_latency), "--summary-latency", str(args.summary_latency),
+        ]))
+        wait_ready(f"{openai_url}/docs")
+
+    env = dict(os.environ)
+    env.update({
+        "AZURE_OPENAI_ENDPOINT": openai_url,
+        "AZURE_OPENAI_API_KEY": env.get("AZURE_OPENAI_API_KEY", "local"),
+        "SQL_CONNECT_FACTORY": env.get("SQL_CONNECT_FACTORY", "bench.fake_db:connect"),
+        "PYTHONPATH": os.pathsep.join(p for p in (ROOT, env.get("PYTHONPATH")) if p),
+    })
+    # Measure the pipeline, not the per-client limits (see admission.py): every
+    # simulated client comes from this one address
+    env.setdefault("ADMISSION_CLIENT_RATE", "0")
+    env.setdefault("ADMISSION_CLIENT_CONCURRENT", "0")
+    env.setdefault("ADMISSION_MAX_CONCURRENT", "0")
+    if args.cold:
+        env.update({"SQL_CACHE_SIZE": "0", "RESULT_CACHE_MAX_MB": "0"})
+    if args.no_templates:
+        env["SQL_TEMPLATES"] = "0"
+    if args.workers > 1 and "SHARED_CACHE_PATH" not in env:
+        env["SHARED_CACHE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="tableau-ai-"), "shared-cache.sqlite")
+    procs.append(subprocess.Popen([
+        sys.executable, "-m", "uvicorn", "app:app", "--port", str(args.app_port),
+        "--workers", str(args.workers), "--log-level", "warning",
+    ], cwd=ROOT, env=env))
+    wait_ready(f"http://127.0.0.1:{args.app_port}/")
+    return procs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="test an already running app instead of starting one")
+    parser.add_argument("--endpoint", default="/ai_query", help="/ai_query or /ai_query/stream")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=100, help="requests per concurrency level")
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--app-port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--openai-url", help="use this OpenAI-compatible server instead of starting the stand-in")
+    parser.add_argument("--openai-port", type=int, default=8100)
+    parser.add_argument("--openai-latency", type=float, default=0.5, help="seconds per SQL completion")
+    parser.add_argument("--summary-latency", type=float, default=0.8, help="seconds per summary completion")
+    parser.add_argument("--cold", action="store_true", help="disable the SQL and result caches")
+    parser.add_argument("--no-templates", action="store_true", help="send every question to the LLM")
+    args = parser.parse_args()
+
+    procs = []
+    try:
+        if not args.url:
+            procs = start_stack(args)
+            args.url = f"http://127.0.0.1:{args.app_port}"
+        sys.exit(asyncio.run(drive(args)))
+    finally:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            try:
+                proc.wait(10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+"""
+In-process caches for the /ai_query pipeline, optionally backed by a
+cross-process shared_cache.SharedStore when running several workers.
+"""
+import hashlib
+import os
+import pickle
+import re
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache with per-entry TTL.
+
+    ``epoch`` is an optional zero-arg callable (e.g. ``date.today``); whenever
+    its value changes the whole cache is dropped, so entries never outlive the
+    context they were computed in.
+
+    ``shared`` is an optional shared_cache.SharedStore: local misses are looked
+    up there (under ``name``) and sets are written through, so every worker
+    process sees the same entries; ``clear()`` clears it for all of them.
+    Shared-store reads and writes happen outside the lock.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = None, epoch=None, name: str = "cache", shared=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self.shared = shared if maxsize > 0 else None
+        self._epoch_fn = epoch
+        self._epoch = self._current_epoch()
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "shared_hits": 0, "misses": 0, "evictions": 0, "expirations": 0,
+                       "invalidations": 0}
+
+    def _current_epoch(self):
+        """Read outside the lock: the shared generation is a SQLite query."""
+        return (self._epoch_fn() if self._epoch_fn else None,
+                self.shared.generation(self.name) if self.shared else 0)
+
+    def _check_epoch(self, current):
+        """Under the lock. A thread that read an older shared generation can't roll it back."""
+        current = current[0], max(current[1], self._epoch[1])
+        if current != self._epoch:
+            self._epoch = current
+            if self._data:
+                self._data.clear()
+                self._stats["invalidations"] += 1
+
+    def _insert(self, key, expires_at, value):
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def get(self, key, default=None):
+        current = self._current_epoch()
+        with self._lock:
+            self._check_epoch(current)
+            epoch = self._epoch
+            item = self._data.get(key)
+            if item is not None:
+                expires_at, value = item
+                if expires_at is None or expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self._stats["hits"] += 1
+                    return value
+                del self._data[key]
+                self._stats["expirations"] += 1
+            if self.shared is None:
+                self._stats["misses"] += 1
+                return default
+        shared = self.shared.get(self.name, key, repr(epoch))
+        with self._lock:
+            if shared is None:
+                self._stats["misses"] += 1
+                return default
+            value, expires_at = shared
+            if expires_at is not None:  # wall clock in the store, monotonic here
+                expires_at = time.monotonic() + expires_at - time.time()
+            if self._epoch == epoch:  # not invalidated while we were reading
+                self._insert(key, expires_at, value)
+            self._stats["shared_hits"] += 1
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        current = self._current_epoch()
+        with self._lock:
+            self._check_epoch(current)
+            self._insert(key, expires_at, value)
+            epoch = repr(self._epoch)
+        if self.shared is not None:
+            self.shared.set(self.name, key, value, epoch, time.time() + ttl if ttl else None)
+
+    def pop(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+        if self.shared is not None:
+            self.shared.delete(self.name, key)
+        return item[1] if item else None
+
+    def clear(self):
+        if self.shared is not None:
+            self.shared.clear(self.name)
+        current = self._current_epoch()
+        with self._lock:
+            self._data.clear()
+            self._epoch = current[0], max(current[1], self._epoch[1])
+            self._stats["invalidations"] += 1
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._data), "maxsize": self.maxsize, **self._stats}
+
+
+def normalize_question(question: str) -> str:
+    """Case/whitespace/trailing-punctuation-insensitive form of a question for cache keys."""
+    text = re.sub(r"\s+", " ", question.casefold()).strip()
+    return text.rstrip(" ?.!")
+
+
+def canonicalize_sql(sql: str) -> str:
+    """Collapse whitespace outside string literals and drop trailing semicolons."""
+    parts = re.split(r"('(?:[^']|'')*')", sql.strip())
+    out = []
+    for i, part in enumerate(parts):
+        out.append(part if i % 2 else re.sub(r"\s+", " ", part))
+    return "".join(out).strip().rstrip(";").strip()
+
+
+def sql_fingerprint(sql: str) -> str:
+    return hashlib.sha256(canonicalize_sql(sql).encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    Result sets keyed by a hash of the canonicalized SQL.
+
+    Entries are pickled and kept in memory up to ``max_bytes``; when
+    ``spill_dir`` is set, entries evicted from memory are written there (up to
+    ``spill_max_bytes``) and promoted back on the next hit. ``epoch`` works as
+    in LRUCache: a new value invalidates both tiers. ``invalidate()`` does the
+    same on demand, e.g. when the nightly load finishes. ``shared`` and
+    ``name`` add a cross-process tier below both, as in LRUCache.
+
+    The lock only guards the in-memory index: spill-file reads, writes and deletes,
+    shared-store calls and unpickling all happen outside it.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl: float = None, spill_dir: str = None,
+                 spill_max_bytes: int = 512 * 1024 * 1024, epoch=None, shared=None, name: str = "results"):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.spill_dir = spill_dir
+        self.spill_max_bytes = spill_max_bytes
+        self.shared = shared if max_bytes > 0 else None
+        self.name = name
+        self._epoch_fn = epoch
+        self._generation = 0
+        epoch, shared_generation = self._current_epoch()
+        self._epoch = (epoch, 0, shared_generation)
+        self._data = OrderedDict()  # fingerprint -> (expires_at, blob)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "disk_hits": 0, "shared_hits": 0, "misses": 0, "evictions": 0, "spills": 0,
+                       "invalidations": 0}
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def _current_epoch(self):
+        """(epoch, shared generation); read outside the lock, _check_epoch adds the local generation."""
+        return (self._epoch_fn() if self._epoch_fn else None,
+                self.shared.generation(self.name) if self.shared else 0)
+
+    @staticmethod
+    def _shared_epoch(epoch) -> str:
+        # The local generation only counts invalidate() calls in this process
+        value, _, shared_generation = epoch
+        return repr((value, shared_generation))
+
+    def _check_epoch(self, current) -> list:
+        """
+        Under the lock. A thread that read an older shared generation can't
+        roll it back. Returns the spill files to _unlink once the lock is released.
+        """
+        current = current[0], self._generation, max(current[1], self._epoch[2])
+        if current == self._epoch:
+            return []
+        self._epoch = current
+        return self._drop_all()
+
+    def _drop_all(self) -> list:
+        self._data.clear()
+        self._bytes = 0
+        self._stats["invalidations"] += 1
+        if not self.spill_dir:
+            return []
+        try:
+            return [os.path.join(self.spill_dir, name) for name in os.listdir(self.spill_dir) if name.endswith(".pkl")]
+        except OSError:
+            return []
+
+    @staticmethod
+    def _unlink(paths: list):
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    # --- disk tier ---
+    def _path(self, key: str) -> str:
+        return os.path.join(self.spill_dir, key + ".pkl")
+
+    def _spill(self, spills: list, epoch):
+        """Write entries evicted from memory to disk; called without the lock."""
+        for key, expires_at, blob in spills:
+            if not self.spill_dir or len(blob) > self.spill_max_bytes:
+                continue
+            tmp = f"{self._path(key)}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp, "wb") as f:
+                    pickle.dump((epoch, expires_at, blob), f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp, self._path(key))
+            except OSError:
+                continue
+            with self._lock:
+                self._stats["spills"] += 1
+            self._trim_disk()
+
+    def _trim_disk(self):
+        files = []
+        for name in os.listdir(self.spill_dir):
+            if name.endswith(".pkl"):
+                path = os.path.join(self.spill_dir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.spill_max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    def _load(self, key: str, current_epoch):
+        if not self.spill_dir:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                epoch, expires_at, blob = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+            return None
+        if epoch != current_epoch or (expires_at is not None and expires_at <= time.time()):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return expires_at, blob
+
+    # --- public API ---
+    def get(self, sql: str):
+        key = sql_fingerprint(sql)
+        current = self._current_epoch()
+        with self._lock:
+            stale = self._check_epoch(current)
+            epoch = self._epoch
+            item = self._data.get(key)
+            if item is not None:
+                if item[0] is None or item[0] > time.time():
+                    self._data.move_to_end(key)
+                    self._stats["hits"] += 1
+                else:
+                    self._remove(key)
+                    item = None
+        self._unlink(stale)
+        if item is not None:
+            return pickle.loads(item[1])
+
+        item, source = self._load(key, epoch), "disk_hits"
+        if item is None and self.shared is not None:
+            item, source = self.shared.get(self.name, key, self._shared_epoch(epoch)), "shared_hits"
+            if item is not None:
+                item = item[1], item[0]  # (blob, expires_at) -> (expires_at, blob)
+        spills = []
+        with self._lock:
+            if item is None:
+                self._stats["misses"] += 1
+                return None
+            self._stats[source] += 1
+            if self._epoch == epoch:  # not invalidated while we were reading
+                spills = self._store(key, *item)
+        self._spill(spills, epoch)
+        return pickle.loads(item[1])
+
+    def set(self, sql: str, value):
+        key = sql_fingerprint(sql)
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        expires_at = time.time() + self.ttl if self.ttl else None
+        current = self._current_epoch()
+        with self._lock:
+            stale = self._check_epoch(current)
+            spills = self._store(key, expires_at, blob)
+            epoch = self._epoch
+        self._unlink(stale)
+        self._spill(spills, epoch)
+        if self.shared is not None:
+            self.shared.set(self.name, key, blob, self._shared_epoch(epoch), expires_at)
+
+    def _remove(self, key: str):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self._bytes -= len(item[1])
+
+    def _store(self, key: str, expires_at, blob: bytes) -> list:
+        """Under the lock. Returns the entries to _spill once it is released."""
+        self._remove(key)
+        if len(blob) > self.max_bytes:
+            return [(key, expires_at, blob)]
+        self._data[key] = (expires_at, blob)
+        self._bytes += len(blob)
+        spills = []
+        while self._bytes > self.max_bytes:
+            old_key, (old_expires, old_blob) = self._data.popitem(last=False)
+            self._bytes -= len(old_blob)
+            self._stats["evictions"] += 1
+            spills.append((old_key, old_expires, old_blob))
+        return spills
+
+    def invalidate(self):
+        """Drop everything (memory, disk and shared), e.g. after the nightly data load."""
+        if self.shared is not None:
+            self.shared.clear(self.name)
+        current = self._current_epoch()
+        with self._lock:
+            self._generation += 1
+            stale = self._check_epoch(current)
+        self._unlink(stale)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._data), "bytes": self._bytes, "max_bytes": self.max_bytes, **self._stats}
@@ -0,0 +1,180 @@
+"""
+Date range resolver for natural-language questions.
+
+parse_date_from_query used to run up to a dozen separate regexes over the
+whole query in priority order, some of them twice. Here the query is
+tokenized once by a precompiled lexer that records where the interesting
+tokens start (month names, numbers, "q"/"quarter", and the relative phrases).
+Each date form is then a precompiled rule tried only at the token positions it
+can start from, in the same priority order, leftmost first — so the result is
+the same as the ordered ``re.search`` chain without rescanning the query.
+
+Forms, most specific first:
+    numeric range   "1/6/26 - 2/14/26"
+    week range      "March 16-22, 2026"
+    cross-month     "Apr 8 - Jun 2, 2025", "Jan 6, 2026 - Feb 14, 2026"
+    month range     "March 2026 and April 2026", "January and April 2026"
+    month + year    "March 2026"
+    quarter         "Q1 2026", "quarter 1 2026"
+    relative        "last month", "last quarter", "ytd"/"year to date"
+    bare month      "March" (most recent occurrence; only if no year anywhere)
+    year            "2026"
+"""
+import calendar
+import re
+from datetime import date, timedelta
+from typing import Optional
+
+MONTHS = {
+    'january': 1, 'february': 2, 'march': 3, 'april': 4,
+    'may': 5, 'june': 6, 'july': 7, 'august': 8,
+    'september': 9, 'october': 10, 'november': 11, 'december': 12
+}
+_MONTH = r"(january|february|march|april|may|june|july|august|september|october|november|december)"
+_DASH = r"[-–—]"  # en/em dashes count as hyphens
+
+# One pass over the query. Month/number/quarter tokens must start at a word
+# boundary; the relative phrases are plain substrings, as they always were
+# ("last months" still counts as "last month"), and are matched zero-width so
+# they never swallow a token that follows ("last quarter 2 2026").
+_LEXER = re.compile(
+    r"\b(?:(?P<month>" + _MONTH[1:-1] + r")|(?P<number>\d)|(?P<quarter>q))"
+    r"|(?=(?P<relative>last month|last quarter|ytd|year to date))"
+)
+
+# Rules, matched at a token position (the leading \b is implied by the lexer)
+_NUMERIC_RANGE = re.compile(
+    r"(\d{1,2})/(\d{1,2})/(\d{2,4})\s*" + _DASH + r"+\s*(\d{1,2})/(\d{1,2})/(\d{2,4})\b")
+_WEEK_RANGE = re.compile(_MONTH + r"\s+(\d{1,2})\s*" + _DASH + r"+\s*(\d{1,2}),?\s+(20\d{2})\b")
+_CROSS_MONTH = re.compile(
+    _MONTH + r"\s+(\d{1,2})(?:,?\s+(20\d{2}))?\s*" + _DASH + r"+\s*" + _MONTH + r"\s+(\d{1,2}),?\s+(20\d{2})\b")
+_MONTH_RANGE = re.compile(
+    _MONTH + r"(?:\s+(20\d{2}))?\s+(?:and|through|to|" + _DASH + r")\s+" + _MONTH + r"(?:\s+(20\d{2}))?\b")
+_MONTH_YEAR = re.compile(_MONTH + r"\s+(20\d{2})\b")
+_QUARTER = re.compile(r"(q([1-4])|quarter\s+([1-4]))\s+(20\d{2})\b")
+_BARE_MONTH = re.compile(_MONTH + r"\b")
+_YEAR = re.compile(r"(20\d{2})\b")
+
+
+def _range(start, end) -> dict:
+    return {"field": "date", "values": [start, end]}
+
+
+def _month_span(year: int, month: int):
+    last_day = calendar.monthrange(year, month)[1]
+    return f"{year}-{month:02d}-01", f"{year}-{month:02d}-{last_day:02d}"
+
+
+def _quarter_span(year: int, quarter: int):
+    start_month = (quarter - 1) * 3 + 1
+    end_month = start_month + 2
+    last_day = calendar.monthrange(year, end_month)[1]
+    return f"{year}-{start_month:02d}-01", f"{year}-{end_month:02d}-{last_day:02d}"
+
+
+def _tokenize(text: str):
+    """Start positions of month, number and quarter tokens, and the relative phrases present."""
+    months, numbers, quarters, relative = [], [], [], set()
+    for m in _LEXER.finditer(text):
+        kind = m.lastgroup
+        if kind == "month":
+            months.append(m.start())
+        elif kind == "number":
+            numbers.append(m.start())
+        elif kind == "quarter":
+            quarters.append(m.start())
+        else:
+            relative.add(m.group(kind))
+    return months, numbers, quarters, relative
+
+
+def _first(rule, text: str, positions):
+    """Leftmost match of ``rule`` starting at one of ``positions``."""
+    for pos in positions:
+        m = rule.match(text, pos)
+        if m:
+            return m
+    return None
+
+
+def _y(s: str) -> int:
+    y = int(s)
+    return 2000 + y if y < 100 else y
+
+
+def parse_date_from_query(query: str, today: date = None) -> Optional[dict]:
+    """
+    Extract a date range from a natural-language query.
+
+    Returns ``{"field": "date", "values": [start, end]}`` (ISO dates,
+    inclusive) or None. ``today`` defaults to ``date.today()``; pass it
+    explicitly for reproducible results.
+    """
+    text = query.lower()
+    months, numbers, quarters, relative = _tokenize(text)
+
+    if numbers:
+        m = _first(_NUMERIC_RANGE, text, numbers)
+        if m:
+            return _range(str(date(_y(m.group(3)), int(m.group(1)), int(m.group(2)))),
+                          str(date(_y(m.group(6)), int(m.group(4)), int(m.group(5)))))
+
+    year = _first(_YEAR, text, numbers) if numbers else None
+
+    if months and year:
+        # Week, cross-month and month+year forms all need a year somewhere
+        m = _first(_WEEK_RANGE, text, months)
+        if m:
+            month, y = MONTHS[m.group(1)], int(m.group(4))
+            return _range(f"{y}-{month:02d}-{int(m.group(2)):02d}", f"{y}-{month:02d}-{int(m.group(3)):02d}")
+
+        m = _first(_CROSS_MONTH, text, months)
+        if m:
+            end_year = int(m.group(6))
+            start_year = int(m.group(3)) if m.group(3) else end_year
+            return _range(f"{start_year}-{MONTHS[m.group(1)]:02d}-{int(m.group(2)):02d}",
+                          f"{end_year}-{MONTHS[m.group(4)]:02d}-{int(m.group(5)):02d}")
+
+        # A month range with no year of its own takes the first year in the query
+        m = _first(_MONTH_RANGE, text, months)
+        if m:
+            end_year = int(m.group(4) or m.group(2) or year.group(1))
+            start_year = int(m.group(2)) if m.group(2) else end_year
+            return _range(f"{start_year}-{MONTHS[m.group(1)]:02d}-01",
+                          _month_span(end_year, MONTHS[m.group(3)])[1])
+
+        m = _first(_MONTH_YEAR, text, months)
+        if m:
+            return _range(*_month_span(int(m.group(2)), MONTHS[m.group(1)]))
+
+    if quarters and year:
+        m = _first(_QUARTER, text, quarters)
+        if m:
+            return _range(*_quarter_span(int(m.group(4)), int(m.group(2) or m.group(3))))
+
+    if relative:
+        today = today or date.today()
+        if "last month" in relative:
+            start_date = date(today.year - 1, 12, 1) if today.month == 1 else date(today.year, today.month - 1, 1)
+            end_date = date(today.year, today.month, 1) - timedelta(days=1)
+            return _range(str(start_date), str(end_date))
+        if "last quarter" in relative:
+            current_quarter = (today.month - 1) // 3 + 1
+            if current_quarter == 1:
+                return _range(*_quarter_span(today.year - 1, 4))
+            return _range(*_quarter_span(today.year, current_quarter - 1))
+        return _range(f"{today.year}-01-01", str(today))
+
+    if year:
+        return _range(f"{year.group(1)}-01-01", f"{year.group(1)}-12-31")
+
+    if months:
+        m = _first(_BARE_MONTH, text, months)
+        if m:
+            today = today or date.today()
+            month_num = MONTHS[m.group(1)]
+            # If the month has already passed or is current this year, use this year; otherwise last year
+            y = today.year if month_num <= today.month else today.year - 1
+            return _range(*_month_span(y, month_num))
+
+    return None
@@ -0,0 +1,452 @@
+"""
+Pooled Azure SQL connections.
+
+Opening a connection means fetching an AAD token, packing it into the
+SQL_COPT_SS_ACCESS_TOKEN struct and doing a full TLS + login handshake, so we
+keep a small pool of open connections and only rebuild one when its token is
+about to expire, it fails a health check, or it has sat idle for too long.
+"""
+import asyncio
+import contextvars
+import functools
+import importlib
+import logging
+import os
+import re
+import struct
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+try:
+    import pyodbc
+except ImportError:  # no ODBC driver manager; only usable with SQL_CONNECT_FACTORY
+    pyodbc = None
+
+from metrics import span
+from token_cache import SQL_SCOPE, get_broker
+
+# This pool replaces ODBC driver-manager pooling, which has no idea about
+# access tokens and would hand back connections opened with an expired one.
+if pyodbc is not None:
+    pyodbc.pooling = False
+
+logger = logging.getLogger("app")
+
+SQL_COPT_SS_ACCESS_TOKEN = 1256
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection could be checked out before the deadline."""
+
+
+def _connection_string() -> str:
+    server = os.getenv("SQL_SERVER", "azsqlserverejcampaignmanager.database.windows.net")
+    database = os.getenv("SQL_DATABASE", "devazsqldbejcampaignmanager")
+    return (
+        "Driver={ODBC Driver 17 for SQL Server};"
+        f"Server={server};"
+        f"Database={database};"
+        "Encrypt=yes;TrustServerCertificate=no;"
+    )
+
+
+def pack_access_token(token: str) -> bytes:
+    """Encode an AAD token the way the ODBC driver expects it."""
+    # UTF-16-LE with a =i (little-endian 4-byte int) length prefix.
+    # Without this length prefix, the driver reads memory incorrectly → segfault 139.
+    access_token = token.encode("utf-16-le")
+    return struct.pack("=i", len(access_token)) + access_token
+
+
+def open_connection():
+    """Open a single ODBC connection. Returns (conn, token_expires_on)."""
+    if pyodbc is None:
+        raise RuntimeError("pyodbc could not be imported (is unixODBC installed?)")
+    token = get_broker().get_token(SQL_SCOPE)
+    conn = pyodbc.connect(
+        _connection_string(),
+        attrs_before={SQL_COPT_SS_ACCESS_TOKEN: pack_access_token(token.token)},
+    )
+    return conn, token.expires_on
+
+
+_DB_ERRORS = (pyodbc.Error,) if pyodbc is not None else ()
+
+
+def connect_factory():
+    """
+    The function the pool opens connections with. SQL_CONNECT_FACTORY
+    ("module:function", same contract as open_connection) swaps in another
+    backend, e.g. the SQLite stand-in used by bench/load_test.py.
+    """
+    target = os.getenv("SQL_CONNECT_FACTORY")
+    if not target:
+        return open_connection
+    module, _, name = target.partition(":")
+    logger.warning(f"⚠️ Using SQL_CONNECT_FACTORY={target} instead of Azure SQL")
+    return getattr(importlib.import_module(module), name or "connect")
+
+
+def _is_disconnect(exc: Exception) -> bool:
+    """SQLSTATE class 08 = connection exception; the connection is unusable."""
+    return bool(exc.args) and str(exc.args[0]).startswith("08")
+
+
+# Azure SQL errors that go away on their own: database unavailable / failing
+# over / busy, resource limits, dropped or timed-out connections.
+_TRANSIENT_ERRORS = re.compile(r"\((?:40613|40501|40197|49918|49919|49920|10928|10929|4060|4221|10053|10054|10060|233|64)\)")
+
+
+def is_transient(exc: Exception) -> bool:
+    """True if retrying ``exc`` later may succeed: connection failures and Azure SQL's transient errors."""
+    if _DB_ERRORS and isinstance(exc, _DB_ERRORS):
+        state = str(exc.args[0]) if exc.args else ""
+        return state.startswith("08") or state in ("HYT00", "HYT01") or bool(_TRANSIENT_ERRORS.search(str(exc)))
+    return isinstance(exc, (ConnectionError, TimeoutError))
+
+
+class _Entry:
+    __slots__ = ("conn", "expires_on", "created_at", "last_used")
+
+    def __init__(self, conn, expires_on):
+        now = time.time()
+        self.conn = conn
+        self.expires_on = expires_on
+        self.created_at = now
+        self.last_used = now
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of pyodbc connections.
+
+    Use ``with pool.connection() as conn:`` — the connection is always returned
+    (or discarded if broken) when the block exits, so it cannot leak.
+    """
+
+    def __init__(
+        self,
+        connect=open_connection,
+        min_size: int = 1,
+        max_size: int = 10,
+        idle_timeout: float = 300.0,
+        token_margin: float = 300.0,
+        health_check_after: float = 30.0,
+        acquire_timeout: float = 30.0,
+        retries: int = 3,
+        retry_delay: float = 3.0,
+    ):
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max(max_size, 1)
+        self.idle_timeout = idle_timeout
+        self.token_margin = token_margin
+        self.health_check_after = health_check_after
+        self.acquire_timeout = acquire_timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+        self._idle = deque()
+        self._size = 0  # idle + checked out + being opened
+        self._cond = threading.Condition()
+        self._closed = False
+        self._reaper = None
+        self._stop = threading.Event()
+        self._stats = {"opened": 0, "closed": 0, "checkouts": 0, "waits": 0, "timeouts": 0, "failed_health_checks": 0,
+                       "connect_retries": 0, "connect_failures": 0}
+
+    def _count(self, name: str):
+        with self._cond:  # an RLock, so also fine where it is already held
+            self._stats[name] += 1
+
+    # --- opening / closing ---
+    def _open(self) -> _Entry:
+        for attempt in range(1, self.retries + 1):
+            try:
+                conn, expires_on = self._connect()
+                self._count("opened")
+                logger.info("✅ Connected successfully")
+                return _Entry(conn, expires_on)
+            except Exception as e:
+                logger.warning(f"⚠️ Connection attempt {attempt} failed: {e}")
+                if attempt < self.retries:
+                    self._count("connect_retries")
+                    time.sleep(self.retry_delay)
+                else:
+                    self._count("connect_failures")
+                    logger.error("❌ All connection attempts failed.")
+                    raise
+
+    def _close_entry(self, entry: _Entry):
+        try:
+            entry.conn.close()
+        except Exception:
+            pass
+        self._count("closed")
+
+    def _discard(self, entry: _Entry):
+        self._close_entry(entry)
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    # --- validity ---
+    def _token_expiring(self, entry: _Entry, now: float) -> bool:
+        return entry.expires_on - now <= self.token_margin
+
+    def _healthy(self, entry: _Entry, now: float) -> bool:
+        if now - entry.last_used < self.health_check_after:
+            return True
+        cursor = None
+        try:
+            cursor = entry.conn.cursor()
+            cursor.execute("SELECT 1").fetchone()
+            return True
+        except Exception as e:
+            self._count("failed_health_checks")
+            logger.warning(f"⚠️ Pooled connection failed health check: {e}")
+            return False
+        finally:
+            if cursor is not None:
+                try:
+                    cursor.close()
+                except Exception:
+                    pass
+
+    # --- checkout / return ---
+    def acquire(self) -> _Entry:
+        self._ensure_reaper()
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            entry = None
+            reserve = False
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise PoolTimeout("Connection pool is closed")
+                    if self._idle:
+                        entry = self._idle.pop()  # LIFO keeps the hottest connections in use
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        reserve = True
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolTimeout(f"No SQL connection available within {self.acquire_timeout}s")
+                    self._stats["waits"] += 1
+                    self._cond.wait(remaining)
+
+            if reserve:
+                try:
+                    entry = self._open()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            else:
+                now = time.time()
+                if self._token_expiring(entry, now) or not self._healthy(entry, now):
+                    self._discard(entry)
+                    continue
+
+            self._count("checkouts")
+            return entry
+
+    def release(self, entry: _Entry, discard: bool = False):
+        if not discard:
+            try:
+                # Never hand the next caller someone else's open transaction
+                entry.conn.rollback()
+            except Exception:
+                discard = True
+        if discard or self._closed:
+            self._discard(entry)
+            return
+        entry.last_used = time.time()
+        with self._cond:
+            self._idle.append(entry)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        with span("db_acquire"):
+            entry = self.acquire()
+        discard = False
+        try:
+            yield entry.conn
+        except _DB_ERRORS as e:
+            discard = _is_disconnect(e)
+            raise
+        finally:
+            self.release(entry, discard)
+
+    # --- background maintenance ---
+    def _ensure_reaper(self):
+        if self._reaper is not None:
+            return
+        with self._cond:
+            if self._reaper is None and not self._closed:
+                self._reaper = threading.Thread(target=self._reap_loop, name="sql-pool-reaper", daemon=True)
+                self._reaper.start()
+
+    def _reap_loop(self):
+        interval = max(1.0, min(self.idle_timeout, 30.0))
+        while not self._stop.wait(interval):
+            try:
+                self.prune()
+            except Exception as e:
+                logger.warning(f"⚠️ Pool maintenance failed: {e}")
+
+    def prune(self):
+        """Close idle/expiring connections and top the pool back up to min_size."""
+        now = time.time()
+        stale = []
+        with self._cond:
+            keep = deque()
+            while self._idle:
+                entry = self._idle.popleft()
+                expired_idle = now - entry.last_used > self.idle_timeout and self._size - len(stale) > self.min_size
+                if expired_idle or self._token_expiring(entry, now):
+                    stale.append(entry)
+                else:
+                    keep.append(entry)
+            self._idle = keep
+            self._size -= len(stale)
+            missing = max(0, self.min_size - self._size)
+            self._size += missing
+        for entry in stale:
+            self._close_entry(entry)
+
+        for _ in range(missing):
+            try:
+                entry = self._open()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                continue
+            with self._cond:
+                self._idle.append(entry)
+                self._cond.notify()
+
+    def warm(self) -> int:
+        """Open connections up to min_size now instead of on first checkout; raises if one can't be opened."""
+        self._ensure_reaper()
+        with self._cond:
+            missing = max(0, self.min_size - self._size)
+            self._size += missing
+        for opened in range(missing):
+            try:
+                entry = self._open()
+            except Exception:
+                with self._cond:
+                    self._size -= missing - opened
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._idle.append(entry)
+                self._cond.notify()
+        return missing
+
+    def close(self):
+        self._stop.set()
+        with self._cond:
+            self._closed = True
+            idle, self._idle = list(self._idle), deque()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for entry in idle:
+            self._close_entry(entry)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "max_size": self.max_size,
+                **self._stats,
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(
+                connect=connect_factory(),
+                min_size=int(os.getenv("SQL_POOL_MIN", "1")),
+                max_size=int(os.getenv("SQL_POOL_MAX", "10")),
+                idle_timeout=float(os.getenv("SQL_POOL_IDLE_TIMEOUT", "300")),
+                token_margin=float(os.getenv("SQL_TOKEN_REFRESH_MARGIN", "300")),
+                acquire_timeout=float(os.getenv("SQL_POOL_ACQUIRE_TIMEOUT", "30")),
+                # Requests retry through resilience.call, which waits without holding a thread
+                retries=int(os.getenv("SQL_CONNECT_RETRIES", "1")),
+            )
+        return _pool
+
+
+def get_db_connection():
+    """
+    Check out a pooled connection to Azure SQL Database.
+
+    Usage: ``with get_db_connection() as conn: ...`` — the connection goes back
+    to the pool (not closed) when the block exits.
+    """
+    return get_pool().connection()
+
+
+# --- Off-loop execution ---
+# pyodbc calls block, so async endpoints hand DB work to this bounded executor
+# instead of running it on the event loop. SQL_EXECUTOR_WORKERS caps how many
+# statements run at once; extra work queues here rather than in the loop.
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_db_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            workers = int(os.getenv("SQL_EXECUTOR_WORKERS", os.getenv("SQL_POOL_MAX", "10")))
+            _executor = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="sql")
+        return _executor
+
+
+async def run_db(fn, *args):
+    """Run a blocking DB function on the SQL executor and await its result."""
+    loop = asyncio.get_running_loop()
+    # Carry the caller's context (request trace) into the worker thread
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(get_db_executor(), functools.partial(ctx.run, fn, *args))
+
+
+def _after_fork():
+    # Connections, the reaper thread and executor threads belong to the parent
+    global _pool, _pool_lock, _executor, _executor_lock
+    _pool = _executor = None
+    _pool_lock = threading.Lock()
+    _executor_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def shutdown_db():
+    """Close pooled connections and stop the SQL executor."""
+    global _executor
+    get_pool().close()
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
@@ -0,0 +1,110 @@
+"""
+Single-pass matcher for Tableau filter values.
+
+extract_filters_from_query used to build and run one ``\\b<value>\\b`` regex
+per FILTER_MAP value on every request. ValueMatcher builds a character trie of
+every value once, then walks the query a single time — starting only at word
+boundaries — to find every value that occurs with a word boundary on both
+sides. Per-field selection then applies the same rules as before (longest
+value first; a value is dropped if it is a substring of one already matched
+for that field), so the output is identical.
+"""
+import re
+
+# Journey Phase abbreviations → the full FILTER_MAP values (lower case)
+_ABBREVIATIONS = {
+    "prea": "pre-explore awareness",
+    "pref": "pre-explore familiarity",
+    "pre-a": "pre-explore awareness",
+    "pre-f": "pre-explore familiarity",
+    "exp": "explore",
+    "eva": "evaluate",
+}
+_ABBREVIATION_RE = re.compile(r"\b(prea|pref|pre-a|pre-f|exp|eva)\b")
+
+_END = object()  # trie key marking "a value ends here"
+
+
+def expand_abbreviations(query_lower: str) -> str:
+    """One-pass equivalent of the six sequential journey-phase re.sub calls."""
+    return _ABBREVIATION_RE.sub(lambda m: _ABBREVIATIONS[m.group(1)], query_lower)
+
+
+def _is_word(ch: str) -> bool:
+    # Same definition of a word character as re's \b for str patterns
+    return ch.isalnum() or ch == "_"
+
+
+class ValueMatcher:
+    """Index over a FILTER_MAP-shaped dict ({field: [values]} or {field: "RANGE"})."""
+
+    def __init__(self, filter_map: dict):
+        self._trie = {}
+        # lower-cased value -> [(field, rank, original value)]
+        self._owners = {}
+        self._fields = []
+
+        for field, values in filter_map.items():
+            if values == "RANGE":
+                continue
+            self._fields.append(field)
+            ranked = sorted(values, key=lambda v: len(v or ""), reverse=True)
+            for rank, value in enumerate(ranked):
+                if not value or value.lower() == "none":
+                    continue
+                val_lower = value.lower()
+                self._owners.setdefault(val_lower, []).append((field, rank, value))
+                self._insert(val_lower)
+
+    def _insert(self, text: str):
+        node = self._trie
+        for ch in text:
+            node = node.setdefault(ch, {})
+        node[_END] = text
+
+    def find(self, text: str) -> set:
+        """Every indexed value occurring in ``text`` with \\b on both sides."""
+        found = set()
+        n = len(text)
+        trie = self._trie
+        for start in range(n):
+            # \b at start: word-ness changes between text[start-1] and text[start]
+            before = start > 0 and _is_word(text[start - 1])
+            first = text[start]
+            if before == _is_word(first):
+                continue
+            node = trie.get(first)
+            i = start
+            while node is not None:
+                i += 1
+                value = node.get(_END)
+                if value is not None:
+                    # \b at end: word-ness changes between text[i-1] and text[i]
+                    after = i < n and _is_word(text[i])
+                    if _is_word(text[i - 1]) != after:
+                        found.add(value)
+                if i >= n:
+                    break
+                node = node.get(text[i])
+        return found
+
+    def match(self, query_normalized: str) -> dict:
+        """{field: [matched values]} in FILTER_MAP field order, longest values first."""
+        candidates = {}
+        for val_lower in self.find(query_normalized):
+            for field, rank, value in self._owners[val_lower]:
+                candidates.setdefault(field, []).append((rank, val_lower, value))
+
+        matches = {}
+        for field in self._fields:
+            if field not in candidates:
+                continue
+            matched_values = []
+            matched_text = set()
+            for _, val_lower, value in sorted(candidates[field]):
+                if any(val_lower in m for m in matched_text):
+                    continue
+                matched_values.append(value)
+                matched_text.add(val_lower)
+            matches[field] = matched_values
+        return matches
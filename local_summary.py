@@ -0,0 +1,170 @@
+"""
+Rule-based summaries for simple results.
+
+The summary prompt's formatting rules are mechanical — CTR/VCR/Viewability
+as percentages, cost metrics with $, labelled periods with change and percent
+change — so for single-row results and small one-dimension tables we apply
+them here instead of making a second LLM call. Anything more complex (several
+dimension columns, many rows, truncated results) returns None and the caller
+asks the LLM.
+
+Modes (SUMMARY_MODE): "auto" (default) summarizes locally when it can,
+"llm" always defers to the LLM, "local" never does (complex results are
+listed row by row).
+"""
+import re
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Optional
+
+from result_set import ResultSet
+
+MODES = ("auto", "llm", "local")
+
+_PERCENT = re.compile(r"pct|percent")
+_RATE = re.compile(r"ctr|vcr|viewability|rate")
+_COST = re.compile(r"cp(?:m|c|l|sv|ev|cv|v)|mediacost|spend|cost|budget")
+_CHANGE = re.compile(r"change|diff")
+_PERIOD_COLUMN = re.compile(r"^(?P<metric>.+?)_(?P<period>[A-Za-z0-9]+)$")
+
+stats = {"local": 0, "llm": 0, "fallbacks": {}}
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float, Decimal)) and not isinstance(value, bool)
+
+
+def _kind(column: str) -> str:
+    name = column.lower()
+    if _PERCENT.search(name):
+        return "percent"   # already multiplied by 100 in SQL
+    if _RATE.search(name):
+        return "rate"      # stored as a decimal ratio
+    if _COST.search(name):
+        return "cost"
+    return "count"
+
+
+def format_value(column: str, value) -> str:
+    """One value, formatted the way the summary prompt asks for."""
+    if value is None:
+        return "n/a"
+    if not _is_number(value):
+        return value.isoformat() if isinstance(value, (date, datetime)) else str(value)
+    value = float(value)
+    signed = bool(_CHANGE.search(column.lower()))
+    sign = "+" if signed and value > 0 else ""
+    kind = _kind(column)
+    if kind == "percent":
+        return f"{sign}{value:.2f}%"
+    if kind == "rate":
+        return f"{sign}{value * 100:.2f}%"
+    if kind == "cost":
+        return f"{'-' if value < 0 else sign}${abs(value):,.2f}"
+    if value.is_integer():
+        return f"{sign}{int(value):,}"
+    return f"{sign}{value:,.2f}"
+
+
+def _label(column: str) -> str:
+    return column.replace("_", " ")
+
+
+def _fallback(reason: str) -> None:
+    stats["fallbacks"][reason] = stats["fallbacks"].get(reason, 0) + 1
+    return None
+
+
+def _period_sentence(columns: list, row: tuple) -> Optional[str]:
+    """'CPM went from $10.00 (March) to $12.00 (April), a change of +$2.00 (+20.00%).'"""
+    by_metric = {}
+    for column, value in zip(columns, row):
+        match = _PERIOD_COLUMN.match(column)
+        if not match:
+            return None
+        by_metric.setdefault(match.group("metric"), []).append((match.group("period"), column, value))
+    sentences = []
+    for metric, parts in by_metric.items():
+        periods = [p for p in parts if not _CHANGE.search(p[0].lower())]
+        change = next((p for p in parts if _CHANGE.search(p[0].lower()) and not _PERCENT.search(p[0].lower())), None)
+        pct = next((p for p in parts if _PERCENT.search(p[0].lower())), None)
+        if len(periods) != 2 or not (change or pct):
+            return None
+        (first, first_col, first_value), (second, second_col, second_value) = periods
+        sentence = (f"{metric} went from {format_value(first_col, first_value)} ({first}) "
+                    f"to {format_value(second_col, second_value)} ({second})")
+        deltas = []
+        if change:
+            deltas.append(format_value(change[1], change[2]))
+        if pct:
+            deltas.append(format_value(pct[1], pct[2]))
+        sentence += ", a change of " + (f"{deltas[0]} ({deltas[1]})" if len(deltas) == 2 else deltas[0])
+        sentences.append(sentence + ".")
+    return " ".join(sentences)
+
+
+def _pairs(columns: list, row: tuple) -> str:
+    return ", ".join(f"{_label(c)} {format_value(c, v)}" for c, v in zip(columns, row))
+
+
+def summarize(user_query: str, results: ResultSet, mode: str = "auto", max_rows: int = 10) -> Optional[str]:
+    """A summary of ``results``, or None if the LLM should write it."""
+    if mode == "llm":
+        stats["llm"] += 1
+        return None
+
+    summary = _summarize(results, max_rows, force=mode == "local")
+    stats["local" if summary is not None else "llm"] += 1
+    return summary
+
+
+def _summarize(results: ResultSet, max_rows: int, force: bool) -> Optional[str]:
+    if len(results) == 0:
+        return "No data matched this question for the selected period and filters."
+    if results.truncated and not force:
+        return _fallback("truncated")
+
+    rows = results.rows()
+    columns = results.columns
+    dimensions = [i for i, values in enumerate(results.data) if any(v is not None and not _is_number(v) for v in values)]
+    measures = [i for i in range(len(columns)) if i not in dimensions]
+
+    if not force:
+        if len(dimensions) > 1:
+            return _fallback("multiple_dimensions")
+        if len(rows) > max_rows:
+            return _fallback("too_many_rows")
+        if not measures:
+            return _fallback("no_measures")
+
+    measure_columns = [columns[i] for i in measures]
+
+    # --- one row ---
+    if len(rows) == 1:
+        row = rows[0]
+        values = tuple(row[i] for i in measures)
+        if not dimensions:
+            return _period_sentence(measure_columns, values) or _pairs(measure_columns, values) + "."
+        names = " / ".join(format_value(columns[i], row[i]) for i in dimensions)
+        return f"{names}: {_pairs(measure_columns, values)}." if values else f"{names}."
+
+    # --- small table: one line per row, plus the extremes of the first measure ---
+    lines = []
+    if measures:
+        first = measures[0]
+        ranked = [r for r in rows if r[first] is not None]
+        if len(ranked) > 1:
+            label = " / ".join(columns[i] for i in dimensions) or "row"
+            high = max(ranked, key=lambda r: r[first])
+            low = min(ranked, key=lambda r: r[first])
+            name = lambda r: " / ".join(format_value(columns[i], r[i]) for i in dimensions) or "—"
+            lines.append(f"Highest {_label(columns[first])}: {name(high)} ({format_value(columns[first], high[first])}); "
+                         f"lowest: {name(low)} ({format_value(columns[first], low[first])}) across {len(rows)} {label} values.")
+    shown = rows[:max_rows] if force else rows
+    for row in shown:
+        head = " / ".join(format_value(columns[i], row[i]) for i in dimensions)
+        body = _pairs(measure_columns, tuple(row[i] for i in measures))
+        lines.append(f"- {head}: {body}" if head else f"- {body}")
+    if len(shown) < len(rows) or results.truncated:
+        lines.append(f"(first {len(shown)} of {len(rows)}{'+' if results.truncated else ''} rows)")
+    return "\n".join(lines)
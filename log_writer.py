@@ -0,0 +1,181 @@
+"""
+Batched, off-request-path audit logging.
+
+Request handlers hand rows to ``LogWriter.submit``, which only appends to a
+bounded in-memory queue and never touches the database. A background thread
+drains the queue and writes each statement's rows with one ``executemany``
+(``fast_executemany`` on) when a batch fills up or the flush interval
+passes. If the database is slow or down the queue fills and new rows are
+dropped and counted, so logging can never add latency to a user request.
+Whatever is queued at shutdown is flushed by ``close``.
+"""
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from db_pool import get_db_connection
+from metrics import span
+
+logger = logging.getLogger("app")
+
+QUERY_LOG_SQL = """
+    INSERT INTO Tableau_AI_QueryLog (user_query, sql_generated, rows_returned, summary, tableau_user)
+    VALUES (?, ?, ?, ?, ?)
+"""
+QUESTION_SQL = "INSERT INTO tableau_ai_test (question) VALUES (?)"
+
+
+class LogWriter:
+    """Bounded queue of (statement, params) rows, written in batches by one thread."""
+
+    def __init__(self, connect=get_db_connection, batch_size: int = 100, flush_interval: float = 2.0,
+                 max_queue: int = 10000, retries: int = 1):
+        self._connect = connect
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.retries = retries
+
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()  # one writer at a time (thread or close())
+        self._closed = False
+        self._worker = None
+        self._last_drop_warning = 0.0
+        self._stats = {"queued": 0, "written": 0, "dropped": 0, "failed": 0, "batches": 0, "flush_errors": 0}
+
+    def submit(self, statement: str, params: tuple) -> bool:
+        """Queue one row. Never blocks; returns False if the row was dropped."""
+        warn = False
+        with self._cond:
+            accepted = not self._closed and len(self._queue) < self.max_queue
+            if accepted:
+                self._queue.append((statement, params))
+                self._stats["queued"] += 1
+                if len(self._queue) >= self.batch_size:
+                    self._cond.notify()
+            else:
+                self._stats["dropped"] += 1
+                now = time.monotonic()
+                if now - self._last_drop_warning > 60:
+                    self._last_drop_warning = now
+                    warn = True
+        if warn:
+            logger.warning(f"⚠️ Log queue full ({self.max_queue} rows); dropping audit rows")
+        if accepted:
+            self._ensure_worker()
+        return accepted
+
+    # --- flushing ---
+    def _take(self) -> list:
+        with self._cond:
+            batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+        return batch
+
+    def _write(self, batch: list):
+        """Write one batch, grouped by statement; retried, then dropped and counted."""
+        groups = {}
+        for statement, params in batch:
+            groups.setdefault(statement, []).append(params)
+        for statement, rows in groups.items():
+            for attempt in range(self.retries + 1):
+                try:
+                    with span("log_flush"), self._connect() as conn:
+                        cursor = conn.cursor()
+                        cursor.fast_executemany = True
+                        cursor.executemany(statement, rows)
+                        conn.commit()
+                        cursor.close()
+                    self._count("written", len(rows))
+                    self._count("batches")
+                    break
+                except Exception as e:
+                    self._count("flush_errors")
+                    if attempt == self.retries:
+                        self._count("failed", len(rows))
+                        logger.warning(f"⚠️ Dropped {len(rows)} audit rows after {attempt + 1} attempts: {e}")
+
+    def flush(self):
+        """Write everything queued so far (blocking)."""
+        with self._flush_lock:
+            while True:
+                batch = self._take()
+                if not batch:
+                    return
+                self._write(batch)
+
+    def _count(self, key: str, n: int = 1):
+        with self._cond:
+            self._stats[key] += n
+
+    # --- background thread ---
+    def _ensure_worker(self):
+        if self._worker is not None:
+            return
+        with self._cond:
+            if self._worker is None and not self._closed:
+                self._worker = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                deadline = time.monotonic() + self.flush_interval
+                while not self._closed and len(self._queue) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                closed = self._closed
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning(f"⚠️ Log flush failed: {e}")
+            if closed:
+                return
+
+    def close(self, timeout: float = 10.0):
+        """Stop accepting rows and flush what is queued."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            worker = self._worker
+        if worker is not None:
+            worker.join(timeout)
+            if worker.is_alive():
+                logger.warning(f"⚠️ Log writer still busy after {timeout}s; {len(self._queue)} audit rows not written")
+                return
+        self.flush()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {**self._stats, "pending": len(self._queue), "max_queue": self.max_queue}
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_log_writer() -> LogWriter:
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = LogWriter(
+                batch_size=int(os.getenv("LOG_BATCH_SIZE", "100")),
+                flush_interval=float(os.getenv("LOG_FLUSH_INTERVAL", "2")),
+                max_queue=int(os.getenv("LOG_QUEUE_MAX", "10000")),
+            )
+        return _writer
+
+
+def _after_fork():
+    # Queued rows and the writer thread belong to the parent
+    global _writer, _writer_lock
+    _writer = None
+    _writer_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
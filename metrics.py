@@ -0,0 +1,282 @@
+"""
+Per-request stage timing and Prometheus metrics.
+
+A request gets a Trace (held in a context variable, so it follows the request
+into run_db threads). Code marks its stages with ``span("name")``; each span
+is timed into the ``tableau_ai_stage_seconds`` histogram, counted in
+``tableau_ai_stage_errors_total`` if it raises, and appended to the trace
+along with any attributes set on it (token usage, row counts, cache hits).
+``finish_trace`` records the request latency and, above SLOW_REQUEST_MS,
+logs the whole trace — including the generated SQL — as one JSON line.
+
+``render()`` returns every metric in the Prometheus text exposition format.
+Stats that already live elsewhere (cache, pool, token broker, log writer)
+are pulled at scrape time through ``register_collector`` instead of being
+counted twice.
+"""
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+logger = logging.getLogger("app")
+
+PREFIX = "tableau_ai"
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Log the full trace of any request slower than this (milliseconds); 0 = off
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "0"))
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key: tuple, extra: tuple = ()) -> str:
+    items = key + extra
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = f"{PREFIX}_{name}"
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list:
+        with self._lock:
+            values = dict(self._values)
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_format_labels(key)} {value}" for key, value in sorted(values.items())]
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: tuple = BUCKETS):
+        self.name = f"{PREFIX}_{name}"
+        self.help = help
+        self.buckets = buckets
+        self._values = {}  # label key -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    row[i] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    def render(self) -> list:
+        with self._lock:
+            values = {key: list(row) for key, row in self._values.items()}
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, row in sorted(values.items()):
+            for bound, count in zip(self.buckets, row):
+                lines.append(f"{self.name}_bucket{_format_labels(key, (('le', bound),))} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels(key, (('le', '+Inf'),))} {row[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {row[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {row[-1]}")
+        return lines
+
+
+REQUEST_SECONDS = Histogram("request_seconds", "End-to-end request latency by route and status.")
+STAGE_SECONDS = Histogram("stage_seconds", "Time spent in each pipeline stage.")
+STAGE_ERRORS = Counter("stage_errors_total", "Pipeline stages that raised, by stage.")
+REQUESTS = Counter("requests_total", "Requests by route and status.")
+LLM_TOKENS = Counter("llm_tokens_total", "Azure OpenAI tokens by call and kind (prompt, cached, completion).")
+_METRICS = [REQUEST_SECONDS, REQUESTS, STAGE_SECONDS, STAGE_ERRORS, LLM_TOKENS]
+
+_collectors = {}  # name -> callable returning a stats dict
+
+
+def register_collector(name: str, fn):
+    """Expose ``fn()``'s numeric values as ``tableau_ai_<name>{key=...}`` at scrape time."""
+    _collectors[name] = fn
+
+
+# --- Tracing ---
+class Trace:
+    __slots__ = ("route", "start", "spans", "attrs", "deferred", "finished")
+
+    def __init__(self, route: str):
+        self.route = route
+        self.start = time.perf_counter()
+        self.spans = []
+        self.attrs = {}
+        self.deferred = False   # set by handlers that keep working after the response starts (SSE)
+        self.finished = False
+
+    def to_dict(self, status) -> dict:
+        return {
+            "route": self.route,
+            "status": status,
+            "ms": round((time.perf_counter() - self.start) * 1000, 1),
+            "spans": self.spans,
+            **self.attrs,
+        }
+
+
+_current = contextvars.ContextVar("trace", default=None)
+
+
+def start_trace(route: str) -> Trace:
+    trace = Trace(route)
+    _current.set(trace)
+    return trace
+
+
+def current_trace() -> Optional[Trace]:
+    return _current.get()
+
+
+def annotate(**attrs):
+    """Attach request-level attributes (e.g. the generated SQL) to the current trace."""
+    trace = _current.get()
+    if trace is not None:
+        trace.attrs.update(attrs)
+
+
+@contextmanager
+def span(stage: str):
+    """
+    Time a stage. Yields a dict; anything put in it is recorded with the span:
+
+        with span("db_execute") as s:
+            ...
+            s["rows"] = len(results)
+    """
+    attrs = {}
+    trace = _current.get()
+    offset = time.perf_counter()
+    error = None
+    try:
+        yield attrs
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        elapsed = time.perf_counter() - offset
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        if error:
+            STAGE_ERRORS.inc(stage=stage)
+        if trace is not None:
+            record = {"stage": stage, "at_ms": round((offset - trace.start) * 1000, 1), "ms": round(elapsed * 1000, 1)}
+            if error:
+                record["error"] = error
+            record.update(attrs)
+            trace.spans.append(record)
+
+
+def usage_numbers(usage) -> dict:
+    """Prompt (cached/uncached) and completion token counts from a completion's ``usage``."""
+    if usage is None:
+        return {}
+    details = getattr(usage, "prompt_tokens_details", None)
+    if isinstance(details, dict):  # older SDKs keep unknown fields as plain dicts
+        cached = details.get("cached_tokens") or 0
+    else:
+        cached = getattr(details, "cached_tokens", 0) or 0
+    prompt_tokens = usage.prompt_tokens or 0
+    return {"prompt_tokens": prompt_tokens, "cached_tokens": cached,
+            "uncached_tokens": prompt_tokens - cached, "completion_tokens": usage.completion_tokens or 0}
+
+
+def record_tokens(call: str, usage: dict):
+    """Count one completion's token usage (as returned by usage_numbers)."""
+    if not usage:
+        return
+    LLM_TOKENS.inc(usage.get("uncached_tokens", 0), call=call, kind="prompt_uncached")
+    LLM_TOKENS.inc(usage.get("cached_tokens", 0), call=call, kind="prompt_cached")
+    LLM_TOKENS.inc(usage.get("completion_tokens", 0), call=call, kind="completion")
+
+
+def finish_trace(trace: Trace, status):
+    """Record the request's latency once; log it in full if it was slow."""
+    if trace.finished:
+        return
+    trace.finished = True
+    elapsed = time.perf_counter() - trace.start
+    REQUEST_SECONDS.observe(elapsed, route=trace.route, status=status)
+    REQUESTS.inc(route=trace.route, status=status)
+    if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+        logger.warning(f"🐢 Slow request: {json.dumps(trace.to_dict(status), default=str)}")
+    elif logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"⏱️ {json.dumps(trace.to_dict(status), default=str)}")
+
+
+class TraceMiddleware:
+    """
+    Pure ASGI middleware giving every HTTP request a trace, labelled with its
+    route path (or "other"), and finishing it with the status the app sent.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._routes = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        if self._routes is None:
+            self._routes = frozenset(route.path for route in scope["app"].routes)
+        path = scope["path"]
+        trace = start_trace(path if path in self._routes else "other")
+        status = 500
+
+        async def send_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            if not trace.deferred:
+                finish_trace(trace, status)
+
+# --- Exposition ---
+def _collector_lines(name: str, stats: dict) -> list:
+    metric = f"{PREFIX}_{name}"
+    lines = [f"# TYPE {metric} untyped"]
+    for key, value in sorted(stats.items()):
+        if isinstance(value, dict):
+            for sub, sub_value in sorted(value.items()):
+                if isinstance(sub_value, (int, float)) and not isinstance(sub_value, bool):
+                    lines.append(f"{metric}{_format_labels((('key', key), ('item', sub)))} {sub_value}")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            lines.append(f"{metric}{_format_labels((('key', key),))} {value}")
+    return lines
+
+
+def render() -> str:
+    lines = []
+    for metric in _METRICS:
+        lines += metric.render()
+    for name, fn in list(_collectors.items()):
+        try:
+            lines += _collector_lines(name, fn())
+        except Exception as e:
+            logger.warning(f"⚠️ Metrics collector {name} failed: {e}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,222 @@
+"""
+Drop the UNION ALL branch that cannot contribute rows.
+
+Every query unions v_TableauData_30Days (recent days) with
+Tableau_31DaysandOlder (everything before), even when its date predicates
+put the whole range on one side. Before running a statement we look at each
+``( SELECT … FROM <source> WHERE … UNION ALL SELECT … FROM <other> WHERE … )``
+group and drop a branch when its own WHERE provably excludes every row of
+its source:
+
+  - the bounds come from the branch's top-level AND-ed date predicates
+    (``date >= '…'``, ``<``, ``<=``, ``>``, ``BETWEEN``, ``CAST(date AS DATE)``,
+    and ``DATEADD(…, GETDATE())`` widened by a day for clock skew), never
+    from the question — a predicate the SQL doesn't have can't prune it. A
+    predicate only counts when it is a whole conjunct (right after WHERE or a
+    top-level AND, up to the next one); a WHERE with a top-level OR or CASE
+    is not read at all;
+  - the data bounds are probed from the database (MIN(date) of the view,
+    MAX(date) of the table) once per data epoch, so the 30/31-day boundary is
+    whatever the view says it is rather than an assumption. A probe can be
+    one nightly load behind (the load may land before the epoch rolls over),
+    so a branch is only dropped when the range clears its bound by more
+    than ``SLACK``;
+  - only plain row branches are dropped (no joins, aggregates or GROUP BY),
+    so an empty branch really contributes nothing, and never both branches.
+
+Anything we can't parse is left as it was.
+"""
+import re
+from datetime import date, datetime, timedelta, timezone
+
+from sql_governor import mask
+from sql_templates import SOURCES
+
+RECENT, OLDER = SOURCES
+PROBE_SQL = f"SELECT (SELECT MIN(date) FROM {RECENT}), (SELECT MAX(date) FROM {OLDER})"
+
+_COLUMN = r"(?:CAST\(\s*(?:\w+\.)?DATE\s+AS\s+DATE\s*\)|(?:\w+\.)?DATE\b)"
+_LITERAL = r"'(\d{4}-\d{2}-\d{2})([^']*)'"
+_NOW = r"(?:GETDATE\(\s*\)|GETUTCDATE\(\s*\)|SYSDATETIME\(\s*\)|CURRENT_TIMESTAMP|" \
+       r"CAST\(\s*GETDATE\(\s*\)\s+AS\s+DATE\s*\)|CONVERT\(\s*DATE\s*,\s*GETDATE\(\s*\)\s*\))"
+_RELATIVE = rf"DATEADD\(\s*(DAY|DD|D|WEEK|WK|WW|MONTH|MM|M|YEAR|YY|YYYY)\s*,\s*(-?\d+)\s*,\s*{_NOW}\s*\)|{_NOW}"
+_VALUE = rf"(?:{_LITERAL}|{_RELATIVE})"
+_COMPARISON = re.compile(rf"(?<![\w.\[]){_COLUMN}\s*(>=|<=|>|<|=)\s*{_VALUE}")
+_BETWEEN = re.compile(rf"(?<![\w.\[]){_COLUMN}\s+BETWEEN\s+{_VALUE}\s+AND\s+{_VALUE}")
+_BRANCH = re.compile(r"^\s*SELECT\s+(?P<select>.*?)\s+FROM\s+(?P<source>\w+)(?:\s+(?:AS\s+)?\w+)?"
+                     r"(?:\s+WHERE\s+(?P<where>.*))?\s*$", re.DOTALL)
+_AGGREGATE = re.compile(r"\b(?:SUM|COUNT|COUNT_BIG|AVG|MIN|MAX|STRING_AGG|STDEV|VAR)\s*\(")
+_NOT_PLAIN = re.compile(r"\b(?:JOIN|APPLY|GROUP|HAVING|UNION|EXCEPT|INTERSECT|TOP|OFFSET)\b")
+_UNITS = {"DAY": "d", "DD": "d", "D": "d", "WEEK": "w", "WK": "w", "WW": "w",
+          "MONTH": "m", "MM": "m", "M": "m", "YEAR": "y", "YY": "y", "YYYY": "y"}
+
+SLACK = timedelta(days=1)
+
+stats = {"checked": 0, "pruned_recent": 0, "pruned_older": 0, "unparsed": 0}
+
+
+def _as_date(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+
+def probe(conn) -> tuple:
+    """(first day in the recent view, last day in the older table); either may be None."""
+    cursor = conn.cursor()
+    cursor.execute(PROBE_SQL)
+    recent_min, older_max = cursor.fetchone()
+    cursor.close()
+    return _as_date(recent_min), _as_date(older_max)
+
+
+def _shift(day: date, unit: str, n: int) -> date:
+    if unit == "d":
+        return day + timedelta(days=n)
+    if unit == "w":
+        return day + timedelta(weeks=n)
+    months = day.year * 12 + day.month - 1 + (n if unit == "m" else 12 * n)
+    year, month = divmod(months, 12)
+    month += 1
+    last = (date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)).day
+    return date(year, month, min(day.day, last))
+
+
+def _value(groups: tuple, today: date, upper: bool):
+    """A day bound from one _VALUE match: (day, exact midnight) — relative values are widened by a day."""
+    literal, rest, unit, n = groups
+    if literal:
+        day = date.fromisoformat(literal)
+        return day, not rest.strip(" 0:.T")
+    day = _shift(today, _UNITS[unit], int(n)) if unit else today
+    return day + timedelta(days=1 if upper else -1), False
+
+
+def _depths(masked: str) -> list:
+    depth, out = 0, []
+    for ch in masked:
+        if ch == "(":
+            depth += 1
+        out.append(depth)
+        if ch == ")":
+            depth -= 1
+    return out
+
+
+def branch_range(where: str, masked: str, today: date) -> tuple:
+    """
+    (first day, last day) implied by the top-level date conjuncts of an
+    upper-cased WHERE clause; None = unbounded. ``masked`` is the same text
+    with literals blanked, for structure.
+    """
+    depths = _depths(masked)
+    if any(depths[m.start()] == 0 for m in re.finditer(r"\bOR\b|\bCASE\b", masked)):
+        return None, None
+    start = end = None
+
+    def top_level(match) -> bool:
+        """The match is a whole conjunct: after WHERE or a top-level AND, up to the next AND or the end."""
+        i = match.start()
+        if masked[i] != where[i] or depths[i] != 0:
+            return False
+        before = masked[:i].rstrip()
+        if before and not (re.search(r"\bAND$", before) and depths[len(before) - 1] == 0):
+            return False
+        after = masked[match.end():].lstrip()
+        return not after or re.match(r"AND\b", after) is not None
+
+    for match in _COMPARISON.finditer(where):
+        if not top_level(match):
+            continue
+        op = match.group(1)
+        if op in (">=", ">", "="):
+            day, _ = _value(match.groups()[1:5], today, upper=False)
+            start = day if start is None else max(start, day)
+        if op in ("<=", "<", "="):
+            day, midnight = _value(match.groups()[1:5], today, upper=True)
+            if op == "<" and midnight:
+                day -= timedelta(days=1)  # date < 'd' ends the day before
+            end = day if end is None else min(end, day)
+    for match in _BETWEEN.finditer(where):
+        if not top_level(match):
+            continue
+        low, _ = _value(match.groups()[0:4], today, upper=False)
+        high, _ = _value(match.groups()[4:8], today, upper=True)
+        start = low if start is None else max(start, low)
+        end = high if end is None else min(end, high)
+    return start, end
+
+
+def _groups(masked: str):
+    """(open, close, [branch spans]) for each parenthesized group that is exactly two UNION ALL branches."""
+    stack, groups = [], []
+    for i, ch in enumerate(masked):
+        if ch == "(":
+            stack.append(i)
+        elif ch == ")" and stack:
+            groups.append((stack.pop(), i))
+    for open_, close in groups:
+        inner = masked[open_ + 1:close]
+        depths = _depths(inner)
+        ops = [m for m in re.finditer(r"\bUNION(\s+ALL)?\b|\bEXCEPT\b|\bINTERSECT\b", inner) if depths[m.start()] == 0]
+        if len(ops) != 1 or not ops[0].group(1):
+            continue
+        op = ops[0]
+        yield open_, close, [(open_ + 1, open_ + 1 + op.start()), (open_ + 1 + op.end(), close)], \
+            (open_ + 1 + op.start(), open_ + 1 + op.end())
+
+
+def prune(sql: str, recent_min: date, older_max: date, today: date = None) -> tuple:
+    """``sql`` with empty branches removed, and the sources that were dropped."""
+    stats["checked"] += 1
+    today = today or datetime.now(timezone.utc).date()  # GETDATE() on Azure SQL is UTC
+    masked = mask(sql)
+    text = sql.upper()
+    cuts = []
+    for open_, close, spans, union in _groups(masked):
+        branches = []
+        for lo, hi in spans:
+            match = _BRANCH.match(masked[lo:hi])
+            if not match or match.group("source") not in (RECENT.upper(), OLDER.upper()):
+                break
+            body = masked[lo:hi]
+            if _AGGREGATE.search(match.group("select")) or _NOT_PLAIN.search(body):
+                break
+            branches.append((match.group("source"), match, lo, hi))
+        if len(branches) != 2 or {b[0] for b in branches} != {RECENT.upper(), OLDER.upper()}:
+            stats["unparsed"] += 1
+            continue
+
+        empty = []
+        for source, match, lo, hi in branches:
+            if match.group("where") is None:
+                continue
+            where = slice(lo + match.start("where"), lo + match.end("where"))
+            start, end = branch_range(text[where], masked[where], today)
+            if source == OLDER.upper() and start is not None and older_max is not None \
+                    and start > older_max + SLACK:
+                empty.append(source)
+            elif source == RECENT.upper() and end is not None and recent_min is not None \
+                    and end < recent_min - SLACK:
+                empty.append(source)
+        if len(empty) != 1:
+            continue
+        first, second = branches
+        if empty[0] == first[0]:
+            # The union takes its column names from the first branch
+            if re.sub(r"\s+", " ", first[1].group("select")) != re.sub(r"\s+", " ", second[1].group("select")):
+                continue
+            cuts.append((first[2], union[1], empty[0]))
+        else:
+            cuts.append((union[0], second[3], empty[0]))
+        stats["pruned_older" if empty[0] == OLDER.upper() else "pruned_recent"] += 1
+
+    dropped = []
+    for lo, hi, source in sorted(cuts, reverse=True):
+        dropped.append(OLDER if source == OLDER.upper() else RECENT)
+        sql = sql[:lo] + " " + sql[hi:]
+    return sql, dropped
@@ -0,0 +1,158 @@
+"""
+Retries and circuit breakers for Azure SQL and Azure OpenAI.
+
+``call`` retries a coroutine on transient errors with exponential backoff and
+full jitter, awaiting between attempts (no thread or worker held in a
+sleep) and honouring a server's Retry-After when it gives one — unless that
+is longer than ``max_delay``, in which case the error is returned at once.
+
+Each dependency has a ``CircuitBreaker``. After ``failure_threshold``
+consecutive transient failures it opens, and from the call that tripped it on
+every call fails fast with ``CircuitOpen`` (a 503 with Retry-After at the
+HTTP layer) instead of piling up requests behind a dead dependency. After ``reset_timeout`` it lets
+``half_open_max`` trial calls through: a success closes it, a failure opens
+it again. Errors that prove the dependency answered (bad SQL, a 400 from
+OpenAI) count as successes.
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger("app")
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+breakers = {}  # name -> CircuitBreaker, for metrics and health
+
+
+class CircuitOpen(Exception):
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name} is unavailable; retry in {retry_after:.0f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+def backoff(attempt: int, base_delay: float, max_delay: float) -> float:
+    """Full-jitter exponential backoff before retry number ``attempt`` (1-based)."""
+    return random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker:
+    """Thread-safe: the SQL path records outcomes from executor threads too."""
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0, half_open_max: int = 1):
+        self.name = name
+        self.failure_threshold = max(failure_threshold, 1)
+        self.reset_timeout = reset_timeout
+        self.half_open_max = max(half_open_max, 1)
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trials = 0
+        self._lock = threading.Lock()
+        self._stats = {"opened": 0, "rejected": 0, "failures": 0, "retries": 0}
+        breakers[name] = self
+
+    def before(self):
+        """Raise CircuitOpen unless a call may go through now."""
+        with self._lock:
+            if self.state == OPEN:
+                remaining = self._opened_at + self.reset_timeout - time.monotonic()
+                if remaining > 0:
+                    self._stats["rejected"] += 1
+                    raise CircuitOpen(self.name, remaining)
+                self.state, self._trials = HALF_OPEN, 0
+                logger.info(f"🔌 {self.name} circuit half-open, sending a trial call")
+            if self.state == HALF_OPEN:
+                if self._trials >= self.half_open_max:
+                    self._stats["rejected"] += 1
+                    raise CircuitOpen(self.name, self.reset_timeout)
+                self._trials += 1
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            if self.state != CLOSED:
+                self.state = CLOSED
+                logger.info(f"✅ {self.name} circuit closed")
+
+    def failure(self) -> bool:
+        """Record a transient failure; True if the circuit is now open."""
+        with self._lock:
+            self._failures += 1
+            self._stats["failures"] += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self._failures >= self.failure_threshold):
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+                self._stats["opened"] += 1
+                logger.error(f"❌ {self.name} circuit open for {self.reset_timeout:.0f}s "
+                             f"after {self._failures} consecutive failures")
+            return self.state == OPEN
+
+    def retried(self):
+        with self._lock:
+            self._stats["retries"] += 1
+
+    def release(self):
+        """A trial call ended without an outcome (cancelled); let another one through."""
+        with self._lock:
+            if self.state == HALF_OPEN and self._trials:
+                self._trials -= 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"state": _STATE_VALUES[self.state], "consecutive_failures": self._failures, **self._stats}
+
+    def status(self) -> dict:
+        with self._lock:
+            status = {"state": self.state}
+            if self.state == OPEN:
+                status["retry_in"] = round(max(0.0, self._opened_at + self.reset_timeout - time.monotonic()), 1)
+            return status
+
+
+async def call(fn, breaker: CircuitBreaker, transient, attempts: int = 3, base_delay: float = 0.5,
+               max_delay: float = 10.0, retry_after=None):
+    """
+    Await ``fn()`` through ``breaker``, retrying up to ``attempts`` times in
+    all while ``transient(exc)`` is true. ``retry_after(exc)`` may return the
+    server's requested delay in seconds.
+    """
+    for attempt in range(1, attempts + 1):
+        breaker.before()
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            breaker.release()
+            raise
+        except Exception as e:
+            if not transient(e):
+                breaker.success()  # the dependency answered; the request was at fault
+                raise
+            if breaker.failure():
+                raise CircuitOpen(breaker.name, breaker.reset_timeout) from e
+            if attempt == attempts:
+                raise
+            delay = backoff(attempt, base_delay, max_delay)
+            hinted = retry_after(e) if retry_after else None
+            if hinted is not None:
+                if hinted > max_delay:
+                    raise
+                delay = hinted + random.uniform(0, base_delay)
+            breaker.retried()
+            logger.warning(f"⚠️ {breaker.name} call failed ({str(e)[:200]}); retry {attempt}/{attempts - 1} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            continue
+        breaker.success()
+        return result
+
+
+def stats() -> dict:
+    return {name: breaker.stats() for name, breaker in breakers.items()}
+
+
+def status() -> dict:
+    return {name: breaker.status() for name, breaker in breakers.items()}
@@ -0,0 +1,86 @@
+"""
+Compact, bounded query results.
+
+Rows are fetched in batches with ``fetchmany`` up to a row cap and stored
+column-wise (one list per column) instead of one dict per row. Callers that
+need the old per-row dict shape ask for it explicitly (``records``), and the
+summarizer gets a bounded ``digest`` instead of the full result.
+"""
+from decimal import Decimal
+
+# Column names that hold ratios/averages; summing them would be meaningless.
+_NON_ADDITIVE = ("cpm", "cpc", "cpl", "cpsv", "cpev", "cpcv", "cpv", "ctr", "vcr",
+                 "rate", "pct", "percent", "viewability", "change", "avg", "ratio", "rn")
+
+
+class ResultSet:
+    __slots__ = ("columns", "data", "truncated")
+
+    def __init__(self, columns: list, data: list, truncated: bool = False):
+        self.columns = columns
+        self.data = data          # data[i] is the list of values for columns[i]
+        self.truncated = truncated
+
+    @classmethod
+    def from_cursor(cls, cursor, max_rows: int = 5000, batch_size: int = 500):
+        """Fetch at most ``max_rows`` rows from an executed cursor."""
+        columns = [desc[0] for desc in cursor.description]
+        data = [[] for _ in columns]
+        fetched = 0
+        truncated = False
+        while True:
+            batch = cursor.fetchmany(min(batch_size, max_rows - fetched + 1))
+            if not batch:
+                break
+            if fetched + len(batch) > max_rows:
+                batch = batch[:max_rows - fetched]
+                truncated = True
+            for values, column in zip(data, zip(*batch)):
+                values.extend(column)
+            fetched += len(batch)
+            if truncated:
+                break
+        return cls(columns, data, truncated)
+
+    def __len__(self):
+        return len(self.data[0]) if self.data else 0
+
+    def rows(self, limit: int = None):
+        """Row tuples, optionally limited to the first ``limit``."""
+        if not self.data:
+            return []
+        columns = self.data if limit is None else [values[:limit] for values in self.data]
+        return list(zip(*columns))
+
+    def head(self, limit: int) -> "ResultSet":
+        """The first ``limit`` rows as a ResultSet."""
+        return ResultSet(self.columns, [values[:limit] for values in self.data], self.truncated or len(self) > limit)
+
+    def records(self, limit: int = None) -> list:
+        """Rows as ``{column: value}`` dicts (the original /ai_query row shape)."""
+        return [dict(zip(self.columns, row)) for row in self.rows(limit)]
+
+    def totals(self) -> dict:
+        """Sums of the additive numeric columns."""
+        totals = {}
+        for name, values in zip(self.columns, self.data):
+            if any(tag in name.lower() for tag in _NON_ADDITIVE):
+                continue
+            numbers = [v for v in values if v is not None]
+            if numbers and all(isinstance(v, (int, float, Decimal)) and not isinstance(v, bool) for v in numbers):
+                totals[name] = sum(numbers)
+        return totals
+
+    def digest(self, max_rows: int = 50):
+        """
+        Bounded view for the summary prompt. Small results are passed through
+        as plain records; larger ones become top rows + totals + row count.
+        """
+        if len(self) <= max_rows and not self.truncated:
+            return self.records()
+        return {
+            "row_count": len(self),
+            "truncated": self.truncated,
+            "top_rows": self.records(max_rows),
+            "totals": self.totals(),
+        }
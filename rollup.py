@@ -0,0 +1,440 @@
+"""
+In-process daily rollup for template-shaped questions.
+
+Nearly every templated question (sql_templates.py) is a ratio of additive
+sums grouped by a low-cardinality dimension and filtered by a date range.
+Once a night we pull one aggregate from Azure SQL — the sums of every
+additive measure per day and per (channel, Platform, Publisher, journeyPhase,
+Campaign, FunnelStrategy, Geography) — into NumPy arrays, and answer those
+plans here with a few vectorized passes instead of a two-table scan.
+
+The combined Site Visits and Video Views formulas are additive, so they are
+summed per cell at build time. SQL semantics are kept where they show:
+a SUM over only NULLs is NULL, ratios use NULLIF(denominator, 0), filters
+compare case-insensitively like the database collation, and NULLs sort first
+ascending and last descending.
+
+The rollup is rebuilt in the background whenever ``epoch`` (the nightly load
+boundary) changes; until it is ready, or for anything it can't answer,
+``answer`` returns None and the caller runs the SQL. With ``directory`` set the
+arrays are saved as .npy files and later loaded memory-mapped, so a restart
+(or another worker) doesn't repeat the build; ``lock`` (a zero-arg callable
+returning a context manager, e.g. a shared_cache file lock) keeps workers
+that start together from building it side by side.
+"""
+import contextlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from datetime import date, datetime
+from typing import Optional
+
+try:
+    import numpy as np
+except ImportError:  # optional; without it every question goes to SQL
+    np = None
+
+from result_set import ResultSet
+from sql_templates import DIMENSIONS, FUNNEL_EXCLUSION, SITE_VISITS_SQL, SOURCES, VIDEO_VIEWS_SQL
+
+logger = logging.getLogger("app")
+
+DIMENSION_COLUMNS = ("channel", "Platform", "Publisher", "journeyPhase", "Campaign", "FunnelStrategy", "Geography")
+
+# (name, aggregate, integral)
+MEASURES = (
+    ("mediaCost", "SUM(mediaCost)", False),
+    ("impressions", "SUM(impressions)", True),
+    ("clicks", "SUM(clicks)", True),
+    ("Leads", "SUM(Leads)", True),
+    ("TotalConversions", "SUM(TotalConversions)", True),
+    ("videoFullyPlayed", "SUM(videoFullyPlayed)", True),
+    ("EngagedVisits", "SUM([Engaged Visits])", True),
+    ("ViewableImpressions", "SUM([Viewable Impressions])", True),
+    ("MeasuredImpressions", "SUM([Measured Impressions])", True),
+    ("SiteVisits", SITE_VISITS_SQL, True),
+    ("VideoViews", VIDEO_VIEWS_SQL, True),
+)
+_INTEGRAL = {name for name, _, integral in MEASURES if integral}
+_NEVER_NULL = {"SiteVisits", "VideoViews"}  # wrapped in ISNULL/COALESCE, so 0 over no rows
+_UNIX_EPOCH = date(1970, 1, 1).toordinal()
+
+# sql_templates.METRICS as (numerator, denominator or None, scale)
+FORMULAS = {
+    "CPCV": ("mediaCost", "videoFullyPlayed", 1.0),
+    "CPC": ("mediaCost", "clicks", 1.0),
+    "CPM": ("mediaCost", "impressions", 1000.0),
+    "CPL": ("mediaCost", "Leads", 1.0),
+    "CPSV": ("mediaCost", "SiteVisits", 1.0),
+    "CPEV": ("mediaCost", "EngagedVisits", 1.0),
+    "CTR": ("clicks", "impressions", 1.0),
+    "VCR": ("videoFullyPlayed", "VideoViews", 1.0),
+    "Viewability": ("ViewableImpressions", "MeasuredImpressions", 1.0),
+    "VideoCompletes": ("videoFullyPlayed", None, 1.0),
+    "VideoViews": ("VideoViews", None, 1.0),
+    "SiteVisits": ("SiteVisits", None, 1.0),
+    "EngagedVisits": ("EngagedVisits", None, 1.0),
+    "Impressions": ("impressions", None, 1.0),
+    "Clicks": ("clicks", None, 1.0),
+    "Leads": ("Leads", None, 1.0),
+    "Conversions": ("TotalConversions", None, 1.0),
+    "MediaCost": ("mediaCost", None, 1.0),
+}
+
+# sql_templates dimension name -> (rollup key, result column name)
+GROUPS = {name: (spec["columns"][0], spec["select"].rsplit(" AS ", 1)[-1]) for name, spec in DIMENSIONS.items()}
+GROUPS["Month"] = ("month", "Month")
+GROUPS["Day"] = ("day", "Day")
+
+JOURNEY_RANK = {"pre-explore awareness": 1, "pre-explore familiarity": 2, "explore": 3, "evaluate": 4}
+
+_SOURCE_COLUMNS = (
+    "date", *DIMENSION_COLUMNS, "mediaCost", "impressions", "clicks", "Leads", "TotalConversions", "videoFullyPlayed",
+    "[Engaged Visits]", "[Viewable Impressions]", "[Measured Impressions]", "siteVisits", "ConversionTagName",
+    "tablename", "videoViews", "VideoPlays", "mediaBuyName",
+)
+
+
+def available() -> bool:
+    return np is not None
+
+
+def build_sql() -> str:
+    """The nightly aggregate the rollup is built from."""
+    columns = ", ".join(_SOURCE_COLUMNS)
+    branches = "\n    UNION ALL\n".join(
+        f"    SELECT {columns}\n    FROM {source}\n    WHERE {FUNNEL_EXCLUSION}" for source in SOURCES
+    )
+    keys = ", ".join(("date",) + DIMENSION_COLUMNS)
+    measures = ", ".join(f"{sql} AS {name}" for name, sql, _ in MEASURES)
+    return f"SELECT {keys}, {measures}\nFROM (\n{branches}\n) AS CombinedData\nGROUP BY {keys}"
+
+
+def _fold(value) -> str:
+    """Comparison key matching the database's case-insensitive, trailing-space-insensitive collation."""
+    return str(value).casefold().rstrip()
+
+
+def _ordinal(value) -> int:
+    if isinstance(value, datetime):
+        return value.date().toordinal()
+    if isinstance(value, date):
+        return value.toordinal()
+    return date.fromisoformat(str(value)[:10]).toordinal()
+
+
+def _number(value) -> float:
+    return float("nan") if value is None else float(value)
+
+
+class _Data:
+    """One built rollup: arrays sorted by day, plus a vocabulary per dimension (code 0 is NULL)."""
+
+    def __init__(self, arrays: dict, vocab: dict, epoch: str):
+        self.arrays = arrays
+        self.vocab = vocab
+        self.epoch = epoch
+        self.codes_by_key = {
+            column: {_fold(v): i for i, v in enumerate(values) if i} for column, values in vocab.items()
+        }
+        if "month" not in arrays:  # year * 12 + month - 1, for grouping by month
+            days = (arrays["day"] - _UNIX_EPOCH).astype("datetime64[D]")
+            arrays["month"] = (days.astype("datetime64[M]").astype(np.int32) + 1970 * 12).astype(np.int32)
+        self.rows = len(arrays["day"])
+        self.nbytes = sum(a.nbytes for a in arrays.values())
+
+
+class RollupStore:
+    def __init__(self, connect, epoch=None, directory: str = None, fetch_batch: int = 50000,
+                 retry_interval: float = 300.0, lock=None):
+        self._connect = connect
+        self._epoch_fn = epoch
+        self.directory = directory
+        self._build_lock = lock or contextlib.nullcontext
+        self.fetch_batch = fetch_batch
+        self.retry_interval = retry_interval
+        self._data = None
+        self._lock = threading.Lock()
+        self._builder = None
+        self._failed_at = None
+        self._stats = {"answered": 0, "fallbacks": {}, "builds": 0, "loads": 0, "build_errors": 0,
+                       "build_seconds": 0.0}
+
+    # --- lifecycle ---
+    def _current_epoch(self) -> str:
+        return str(self._epoch_fn()) if self._epoch_fn else "static"
+
+    def ready(self) -> bool:
+        data = self._data
+        return data is not None and data.epoch == self._current_epoch()
+
+    def refresh(self, wait: bool = False, force: bool = False):
+        """Start a background build unless one is running or the last one failed recently."""
+        with self._lock:
+            if not force and self._failed_at is not None and time.monotonic() - self._failed_at < self.retry_interval:
+                return
+            if self._builder is None or not self._builder.is_alive():
+                self._builder = threading.Thread(target=self._build, name="rollup-build", daemon=True)
+                self._builder.start()
+            builder = self._builder
+        if wait:
+            builder.join()
+
+    def invalidate(self):
+        """Drop the current rollup (the nightly load landed early) and rebuild it."""
+        self._data = None
+        if self.directory:
+            shutil.rmtree(os.path.join(self.directory, f"rollup-{self._current_epoch()}"), ignore_errors=True)
+        self.refresh(force=True)
+
+    def _build(self):
+        epoch = self._current_epoch()
+        start = time.perf_counter()
+        try:
+            with self._build_lock():  # another worker may be building it; wait, then load theirs
+                data = self._load(epoch)
+                if data is None:
+                    data = self._query(epoch)
+                    self._save(data)
+                    self._count("builds")
+                else:
+                    self._count("loads")
+        except Exception as e:
+            self._count("build_errors")
+            self._failed_at = time.monotonic()
+            logger.warning(f"⚠️ Rollup build failed, questions go to SQL: {e}")
+            return
+        self._data = data
+        self._failed_at = None
+        seconds = round(time.perf_counter() - start, 3)
+        with self._lock:
+            self._stats["build_seconds"] = seconds
+        logger.info(f"✅ Rollup ready: {data.rows} rows, {data.nbytes / 1e6:.1f} MB in {seconds}s")
+
+    def _query(self, epoch: str) -> _Data:
+        vocab = {column: [None] for column in DIMENSION_COLUMNS}
+        index = {column: {} for column in DIMENSION_COLUMNS}
+        days, codes = [], {column: [] for column in DIMENSION_COLUMNS}
+        values = {name: [] for name, _, _ in MEASURES}
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(build_sql())
+            while True:
+                batch = cursor.fetchmany(self.fetch_batch)
+                if not batch:
+                    break
+                for row in batch:
+                    days.append(_ordinal(row[0]))
+                    for column, value in zip(DIMENSION_COLUMNS, row[1:]):
+                        if value is None:
+                            codes[column].append(0)
+                            continue
+                        key = _fold(value)
+                        code = index[column].get(key)
+                        if code is None:
+                            code = index[column][key] = len(vocab[column])
+                            vocab[column].append(str(value))
+                        codes[column].append(code)
+                    for (name, _, _), value in zip(MEASURES, row[1 + len(DIMENSION_COLUMNS):]):
+                        values[name].append(_number(value))
+            cursor.close()
+
+        day = np.array(days, dtype=np.int32)
+        order = np.argsort(day, kind="stable")
+        arrays = {"day": day[order]}
+        for column in DIMENSION_COLUMNS:
+            arrays[column] = np.array(codes[column], dtype=np.int32)[order]
+        for name, _, _ in MEASURES:
+            arrays[name] = np.array(values[name], dtype=np.float64)[order]
+        return _Data(arrays, vocab, epoch)
+
+    # --- persistence ---
+    def _save(self, data: _Data):
+        if not self.directory:
+            return
+        final = os.path.join(self.directory, f"rollup-{data.epoch}")
+        tmp = f"{final}.tmp-{os.getpid()}"
+        try:
+            os.makedirs(tmp, exist_ok=True)
+            for name, array in data.arrays.items():
+                np.save(os.path.join(tmp, f"{name}.npy"), array)
+            with open(os.path.join(tmp, "vocab.json"), "w") as f:
+                json.dump(data.vocab, f)
+            shutil.rmtree(final, ignore_errors=True)
+            os.replace(tmp, final)
+            for entry in os.listdir(self.directory):  # older nights
+                if entry.startswith("rollup-") and entry != os.path.basename(final):
+                    shutil.rmtree(os.path.join(self.directory, entry), ignore_errors=True)
+        except OSError as e:
+            shutil.rmtree(tmp, ignore_errors=True)
+            logger.warning(f"⚠️ Could not save rollup to {self.directory}: {e}")
+
+    def _load(self, epoch: str) -> Optional[_Data]:
+        if not self.directory:
+            return None
+        path = os.path.join(self.directory, f"rollup-{epoch}")
+        try:
+            with open(os.path.join(path, "vocab.json")) as f:
+                vocab = json.load(f)
+            names = ["day", "month", *DIMENSION_COLUMNS, *(name for name, _, _ in MEASURES)]
+            arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in names}
+        except (OSError, ValueError):
+            return None
+        return _Data(arrays, vocab, epoch)
+
+    def _count(self, name: str):
+        with self._lock:  # answer() runs on several DB threads at once
+            self._stats[name] += 1
+
+    # --- queries ---
+    def _fallback(self, reason: str) -> None:
+        with self._lock:
+            self._stats["fallbacks"][reason] = self._stats["fallbacks"].get(reason, 0) + 1
+        return None
+
+    def answer(self, plan: dict, max_rows: int = 5000) -> Optional[ResultSet]:
+        """The result of a sql_templates plan, or None if it has to go to SQL."""
+        if np is None:
+            return self._fallback("numpy_missing")
+        data = self._data
+        if data is None or data.epoch != self._current_epoch():
+            self.refresh()
+            return self._fallback("not_ready")
+        if any(name not in FORMULAS for name in plan["metrics"]):
+            return self._fallback("metric")
+        if any(name not in GROUPS for name in plan["dimensions"]) or \
+                any(column not in data.vocab for column in plan["filters"]):
+            return self._fallback("dimension")
+
+        arrays = data.arrays
+        lo, hi = 0, data.rows
+        if plan["date"]:
+            start = date.fromisoformat(plan["date"][0]).toordinal()
+            end = date.fromisoformat(plan["date"][-1]).toordinal()
+            lo, hi = np.searchsorted(arrays["day"], [start, end + 1], side="left")
+
+        mask = np.ones(hi - lo, dtype=bool)
+        for column, wanted in plan["filters"].items():
+            codes = [data.codes_by_key[column].get(_fold(v)) for v in wanted]
+            mask &= np.isin(arrays[column][lo:hi], [c for c in codes if c is not None])
+        if "Journey Phase" in plan["dimensions"] or "journeyPhase" in plan["filters"]:
+            none = data.codes_by_key["journeyPhase"].get("none")
+            phases = arrays["journeyPhase"][lo:hi]
+            mask &= phases != 0  # NULL <> 'None' is not true either
+            if none is not None:
+                mask &= phases != none
+        rows = np.nonzero(mask)[0] + lo
+
+        # --- group ---
+        keys = [GROUPS[name][0] for name in plan["dimensions"]]
+        if keys:
+            key = np.zeros(len(rows), dtype=np.int64)
+            parts = []
+            for name in keys:
+                part = np.asarray(arrays[name][rows], dtype=np.int64)
+                base = int(part.min()) if len(part) else 0
+                width = int(part.max()) - base + 1 if len(part) else 1
+                key = key * width + (part - base)
+                parts.append((base, width))
+            groups, inverse = np.unique(key, return_inverse=True)
+        else:
+            groups, inverse = np.zeros(1, dtype=np.int64), np.zeros(len(rows), dtype=np.int64)
+
+        sums, present = {}, {}
+        needed = {m for name in plan["metrics"] for m in FORMULAS[name][:2] if m}
+        for name in needed:
+            column = np.asarray(arrays[name][rows])
+            valid = ~np.isnan(column)
+            sums[name] = np.bincount(inverse, weights=np.where(valid, column, 0.0), minlength=len(groups))
+            present[name] = np.bincount(inverse, weights=valid, minlength=len(groups)) > 0
+            if name in _NEVER_NULL:
+                present[name][:] = True
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            results = []
+            for name in plan["metrics"]:
+                numerator, denominator, scale = FORMULAS[name]
+                value = np.where(present[numerator], sums[numerator] * scale, np.nan)
+                if denominator:
+                    den = np.where(present[denominator], sums[denominator], np.nan)
+                    value = np.where(den != 0, value / den, np.nan)
+                results.append(value)
+
+        # --- decode group keys back into dimension values ---
+        labels = []
+        remaining = groups.copy()
+        for name, (base, width) in reversed(list(zip(keys, parts if keys else []))):
+            codes = (remaining % width) + base
+            remaining //= width
+            labels.append(self._labels(data, name, codes))
+        labels.reverse()
+
+        records = []
+        for i in range(len(groups)):
+            row = [label[i] for label in labels]
+            for name, value in zip(plan["metrics"], results):
+                v = float(value[i])
+                if v != v:
+                    row.append(None)
+                elif FORMULAS[name][1] is None and FORMULAS[name][0] in _INTEGRAL:
+                    row.append(int(round(v)))
+                else:
+                    row.append(v)
+            records.append(row)
+
+        records = self._order(plan, records)
+        if plan["limit"]:
+            records = records[:plan["limit"]]
+        truncated = len(records) > max_rows
+        records = records[:max_rows]
+        self._count("answered")
+
+        columns = [GROUPS[name][1] for name in plan["dimensions"]] + list(plan["metrics"])
+        return ResultSet(columns, [list(values) for values in zip(*records)] if records else [[] for _ in columns],
+                         truncated)
+
+    @staticmethod
+    def _labels(data: _Data, key: str, codes) -> list:
+        if key == "day":
+            return [date.fromordinal(int(c)) for c in codes]
+        if key == "month":
+            return [f"{int(c) // 12:04d}-{int(c) % 12 + 1:02d}" for c in codes]
+        vocab = data.vocab[key]
+        return [vocab[int(c)] for c in codes]
+
+    @staticmethod
+    def _order(plan: dict, records: list) -> list:
+        """ORDER BY as sql_templates.render writes it; NULLs first ascending, last descending."""
+        dims = len(plan["dimensions"])
+        if not dims:
+            return records
+        if plan["order"]:
+            position = dims + plan["metrics"].index(plan["order"][0])
+            descending = plan["order"][1]
+            known = sorted((r for r in records if r[position] is not None), key=lambda r: r[position], reverse=descending)
+            nulls = [r for r in records if r[position] is None]
+            return known + nulls if descending else nulls + known
+        keys = []
+        for i, name in enumerate(plan["dimensions"]):
+            if name == "Journey Phase":
+                keys.append(lambda r, i=i: JOURNEY_RANK.get(_fold(r[i]) if r[i] is not None else "", 5))
+            elif name in ("Month", "Day"):
+                keys.append(lambda r, i=i: (r[i] is not None, r[i]))
+        if keys:
+            return sorted(records, key=lambda r: tuple(k(r) for k in keys))
+        known = sorted((r for r in records if r[dims] is not None), key=lambda r: r[dims], reverse=True)
+        return known + [r for r in records if r[dims] is None]
+
+    def stats(self) -> dict:
+        data = self._data
+        with self._lock:
+            counters = {**self._stats, "fallbacks": dict(self._stats["fallbacks"])}
+        return {
+            "ready": int(self.ready()),
+            "rows": data.rows if data else 0,
+            "bytes": data.nbytes if data else 0,
+            **counters,
+        }
@@ -0,0 +1,256 @@
+"""
+Cross-process cache store for multi-worker deployments.
+
+Each gunicorn worker keeps its own LRUCache / ResultCache / token cache, so
+with more than one worker a question answered by one process is a miss on
+the next, and every process fetches its own AAD tokens. SHARED_CACHE_PATH
+points all workers at one SQLite file on local disk (WAL mode, so readers
+don't block the writer) that sits under the in-process tiers:
+
+  - a local miss is looked up here before doing the work, and whatever is
+    stored locally is written through;
+  - entries carry the epoch they were computed in and an absolute expiry; a
+    row from another epoch is a miss;
+  - ``clear(namespace)`` bumps a per-namespace generation that the local
+    tiers fold into their epoch, so /cache/invalidate on one worker empties
+    every worker's cache;
+  - ``lock(name)`` is an exclusive file lock for work only one process
+    should do at a time (fetching a token, building the rollup).
+
+The store never fails a request: any SQLite error is logged and treated as a
+miss. Keep the file on local disk (e.g. /tmp) — SQLite locking isn't reliable
+over the SMB share mounted at /home on App Service. The file is created 0600
+since it can hold bearer tokens.
+"""
+import hashlib
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows local dev: single process, locks are in-process only
+    fcntl = None
+
+logger = logging.getLogger("app")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    namespace  TEXT NOT NULL,
+    key        TEXT NOT NULL,
+    epoch      TEXT,
+    expires_at REAL,
+    stored_at  REAL NOT NULL,
+    size       INTEGER NOT NULL,
+    value      BLOB NOT NULL,
+    PRIMARY KEY (namespace, key)
+);
+CREATE INDEX IF NOT EXISTS entries_stored_at ON entries (stored_at);
+CREATE TABLE IF NOT EXISTS generations (
+    namespace  TEXT PRIMARY KEY,
+    generation INTEGER NOT NULL
+);
+"""
+
+
+def _key(key) -> str:
+    return key if isinstance(key, str) else hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+
+
+class SharedStore:
+    """
+    Namespaced key/value store in one SQLite file, safe to use from every
+    thread of every worker. Values are pickled. When the file grows past
+    ``max_bytes`` the oldest writes are dropped first.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 256 * 1024 * 1024, busy_timeout: float = 5.0,
+                 trim_every: int = 64):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.busy_timeout = busy_timeout
+        self.trim_every = trim_every
+        self._local = threading.local()  # sqlite3 connections are per thread and per process
+        self._lock = threading.Lock()
+        self._thread_locks = {}  # name -> Lock, for lock() without fcntl
+        self._writes = 0
+        self._stats = {"hits": 0, "misses": 0, "writes": 0, "errors": 0, "trimmed": 0}
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+        conn = self._conn()
+        conn.executescript(_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():  # never reuse a connection across fork
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            local.conn, local.pid = conn, os.getpid()
+        return local.conn
+
+    def _count(self, key: str, n: int = 1):
+        with self._lock:
+            self._stats[key] += n
+
+    def _error(self, action: str, e: Exception):
+        self._count("errors")
+        logger.warning(f"⚠️ Shared cache {action} failed: {e}")
+
+    # --- entries ---
+    def get(self, namespace: str, key, epoch: str = None):
+        """(value, expires_at) if a live entry from ``epoch`` exists, else None."""
+        try:
+            row = self._conn().execute(
+                "SELECT epoch, expires_at, value FROM entries WHERE namespace = ? AND key = ?",
+                (namespace, _key(key)),
+            ).fetchone()
+        except sqlite3.Error as e:
+            self._error("read", e)
+            return None
+        if row is None or row[0] != epoch or (row[1] is not None and row[1] <= time.time()):
+            self._count("misses")
+            return None
+        try:
+            value = pickle.loads(row[2])
+        except Exception:  # written by an incompatible deploy
+            self._count("misses")
+            return None
+        self._count("hits")
+        return value, row[1]
+
+    def set(self, namespace: str, key, value, epoch: str = None, expires_at: float = None):
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(blob) > self.max_bytes:
+            return
+        try:
+            self._conn().execute(
+                "INSERT OR REPLACE INTO entries (namespace, key, epoch, expires_at, stored_at, size, value) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (namespace, _key(key), epoch, expires_at, time.time(), len(blob), blob),
+            )
+        except sqlite3.Error as e:
+            self._error("write", e)
+            return
+        with self._lock:
+            self._stats["writes"] += 1
+            self._writes += 1
+            due = self._writes % self.trim_every == 0
+        if due:
+            self.trim()
+
+    def delete(self, namespace: str, key):
+        try:
+            self._conn().execute("DELETE FROM entries WHERE namespace = ? AND key = ?", (namespace, _key(key)))
+        except sqlite3.Error as e:
+            self._error("delete", e)
+
+    def trim(self):
+        """Drop expired entries, then the oldest writes until the file is under ``max_bytes``."""
+        conn = self._conn()
+        try:
+            removed = conn.execute("DELETE FROM entries WHERE expires_at IS NOT NULL AND expires_at <= ?",
+                                   (time.time(),)).rowcount
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if total > self.max_bytes:
+                cutoff, excess = None, total - self.max_bytes
+                for stored_at, size in conn.execute("SELECT stored_at, size FROM entries ORDER BY stored_at"):
+                    excess -= size
+                    cutoff = stored_at
+                    if excess <= 0:
+                        break
+                removed += conn.execute("DELETE FROM entries WHERE stored_at <= ?", (cutoff,)).rowcount
+        except sqlite3.Error as e:
+            self._error("trim", e)
+            return
+        self._count("trimmed", max(removed, 0))
+
+    # --- invalidation ---
+    def generation(self, namespace: str) -> int:
+        try:
+            row = self._conn().execute("SELECT generation FROM generations WHERE namespace = ?",
+                                       (namespace,)).fetchone()
+        except sqlite3.Error as e:
+            self._error("read", e)
+            return 0
+        return row[0] if row else 0
+
+    def clear(self, namespace: str):
+        """Drop every entry in ``namespace`` and tell the other workers to drop their local copies."""
+        conn = self._conn()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("INSERT INTO generations (namespace, generation) VALUES (?, 1) "
+                             "ON CONFLICT (namespace) DO UPDATE SET generation = generation + 1", (namespace,))
+                conn.execute("DELETE FROM entries WHERE namespace = ?", (namespace,))
+                conn.execute("COMMIT")
+            except sqlite3.Error:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            self._error("clear", e)
+
+    # --- cross-process lock ---
+    @contextmanager
+    def lock(self, name: str):
+        """Hold an exclusive lock on ``name`` across every process sharing the store."""
+        with self._lock:
+            thread_lock = self._thread_locks.setdefault(name, threading.Lock())
+        with thread_lock:
+            if fcntl is None:
+                yield
+                return
+            fd = os.open(f"{self.path}.{name}.lock", os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(fd)  # releases the flock
+
+    def stats(self) -> dict:
+        try:
+            entries, size = self._conn().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        except sqlite3.Error:
+            entries = size = None
+        with self._lock:
+            return {"entries": entries, "bytes": size, "max_bytes": self.max_bytes, **self._stats}
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """The store at SHARED_CACHE_PATH, or None when cross-process sharing is off (the default)."""
+    global _store
+    path = os.getenv("SHARED_CACHE_PATH")
+    if not path:
+        return None
+    with _store_lock:
+        if _store is None:
+            try:
+                _store = SharedStore(path, max_bytes=int(os.getenv("SHARED_CACHE_MAX_MB", "256")) * 1024 * 1024)
+            except (OSError, sqlite3.Error) as e:
+                logger.warning(f"⚠️ Shared cache at {path} unavailable, caches stay per-process: {e}")
+                _store = False
+        return _store or None
+
+
+def _after_fork():
+    global _store_lock
+    _store_lock = threading.Lock()
+    if _store:
+        _store._lock = threading.Lock()
+        _store._thread_locks = {}
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
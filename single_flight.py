@@ -0,0 +1,63 @@
+"""
+Single-flight coalescing of identical in-flight work.
+
+When a dashboard opens, several viewers tend to ask the same starter question
+within the same second; without coalescing each one pays for its own SQL
+generation, DB scan and summary. ``SingleFlight.do(key, fn)`` runs ``fn()``
+once per key at a time and every concurrent caller with that key awaits the
+same result (or the same exception).
+
+The shared work runs in its own task, so a caller that goes away (client
+disconnect, timeout) only stops waiting — the others still get the result.
+The task is cancelled only when every caller waiting on it has gone.
+"""
+import asyncio
+from typing import Awaitable, Callable, Hashable
+
+
+class _Call:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self, name: str = "flight", enabled: bool = True):
+        self.name = name
+        self.enabled = enabled
+        self._calls = {}  # key -> _Call; only touched from the event loop thread
+        self._stats = {"leaders": 0, "joined": 0, "failures": 0, "abandoned": 0}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable]):
+        """``await fn()``, shared with any concurrent call for the same key. Returns (result, shared)."""
+        if not self.enabled:
+            return await fn(), False
+        call = self._calls.get(key)
+        shared = call is not None
+        if shared:
+            self._stats["joined"] += 1
+        else:
+            self._stats["leaders"] += 1
+            call = self._calls[key] = _Call(asyncio.ensure_future(fn()))
+            call.task.add_done_callback(lambda task, key=key: self._done(key, task))
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task), shared
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                # Every caller gave up; nobody is left to use the result
+                self._stats["abandoned"] += 1
+                call.task.cancel()
+
+    def _done(self, key, task: asyncio.Task):
+        if self._calls.get(key) is not None and self._calls[key].task is task:
+            del self._calls[key]
+        if not task.cancelled() and task.exception() is not None:
+            self._stats["failures"] += 1
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self._calls), **self._stats}
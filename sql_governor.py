@@ -0,0 +1,165 @@
+"""
+Guard rails for LLM-generated SQL.
+
+The generated statement used to run as-is, with gunicorn's 600 s worker
+timeout as the only backstop, so one bad query (a cross join, a two-table scan
+with no date predicate) could hold a pooled connection and a DB thread for
+minutes. Before step 2 runs a statement we:
+
+  - check it locally: a single SELECT (or WITH … SELECT), no DML/DDL/EXEC,
+    no SELECT INTO, no CROSS JOIN/APPLY;
+  - cap the rows it can return by injecting TOP (n), or lowering a larger TOP;
+  - run it with a per-query timeout on the connection (SQL_QUERY_TIMEOUT);
+  - cancel it on the server (``cursor.cancel()``) when nobody is waiting for
+    the answer any more.
+
+Rejections, caps, timeouts and cancellations are counted in ``stats``.
+"""
+import re
+import threading
+
+# String literals, [bracketed identifiers] and comments are masked before
+# any keyword check, so their contents can't trigger (or hide) anything.
+_MASK = re.compile(r"'(?:[^']|'')*'|\[[^\]]*\]|--[^\n]*|/\*.*?\*/", re.DOTALL)
+_FORBIDDEN = re.compile(
+    r"\b(INSERT|UPDATE|DELETE|MERGE|DROP|ALTER|CREATE|TRUNCATE|EXEC|EXECUTE|GRANT|REVOKE|DENY|"
+    r"BACKUP|RESTORE|SHUTDOWN|DBCC|DECLARE|SET|USE|WAITFOR|BULK|OPENROWSET|OPENQUERY|OPENDATASOURCE|INTO)\b"
+)
+_CROSS = re.compile(r"\bCROSS\s+(JOIN|APPLY)\b")
+_WORD = re.compile(r"[A-Z_][A-Z0-9_]*|[()]")
+_TOP = re.compile(r"\s*TOP\s*(\(\s*(\d+)\s*\)|(\d+))(\s+PERCENT|\s+WITH\s+TIES)?")
+_DISTINCT = re.compile(r"\s+(DISTINCT|ALL)\b")
+_TIMEOUT_STATES = ("HYT00", "HYT01")
+
+stats = {"checked": 0, "rejected": {}, "capped": 0, "uncapped": 0, "timed_out": 0, "cancelled": 0}
+
+
+class QueryRejected(ValueError):
+    """The generated SQL failed the static check; it is never sent to the database."""
+
+
+class QueryTimeout(Exception):
+    """The statement ran past SQL_QUERY_TIMEOUT and was stopped by the driver."""
+
+
+class QueryCancelled(Exception):
+    """Nobody was waiting for the statement any more, so it was not run (or was stopped)."""
+
+
+def mask(sql: str) -> str:
+    """Upper-cased ``sql`` with literals/identifiers/comments blanked out, same length."""
+    return _MASK.sub(lambda m: " " * len(m.group()), sql).upper()
+
+
+def _reject(reason: str, message: str):
+    stats["rejected"][reason] = stats["rejected"].get(reason, 0) + 1
+    raise QueryRejected(message)
+
+
+def check(sql: str) -> str:
+    """The statement without a trailing semicolon, or QueryRejected if it isn't a single read-only SELECT."""
+    stats["checked"] += 1
+    sql = sql.strip()
+    masked = mask(sql).rstrip()
+    while masked.endswith(";"):
+        masked = masked[:-1].rstrip()
+    sql = sql[:len(masked)]
+    if ";" in masked:
+        _reject("multiple_statements", "Only a single SQL statement is allowed.")
+    first = re.match(r"\s*(\w+)", masked)
+    if not first or first.group(1) not in ("SELECT", "WITH"):
+        _reject("not_select", "Only SELECT queries are allowed.")
+    keyword = _FORBIDDEN.search(masked)
+    if keyword:
+        _reject("forbidden_keyword", f"{keyword.group(1)} is not allowed in generated SQL.")
+    if _CROSS.search(masked):
+        _reject("cross_join", "CROSS JOIN/APPLY is not allowed in generated SQL.")
+    return sql
+
+
+def _outer_select(masked: str):
+    """End offset of the outermost SELECT keyword, or None if a TOP there wouldn't cap the whole result."""
+    depth = 0
+    select_end = None
+    for match in _WORD.finditer(masked):
+        token = match.group()
+        if token == "(":
+            depth += 1
+        elif token == ")":
+            depth -= 1
+        elif depth == 0:
+            if token == "SELECT" and select_end is None:
+                select_end = match.end()
+            elif token in ("UNION", "EXCEPT", "INTERSECT", "OFFSET"):
+                return None  # TOP would only cover the first branch / conflicts with OFFSET
+    return select_end
+
+
+def cap_rows(sql: str, max_rows: int) -> str:
+    """Make the outermost SELECT return at most ``max_rows`` rows."""
+    masked = mask(sql)
+    pos = _outer_select(masked)
+    if pos is None:
+        stats["uncapped"] += 1
+        return sql
+    distinct = _DISTINCT.match(masked, pos)
+    if distinct:
+        pos = distinct.end()
+    top = _TOP.match(masked, pos)
+    if top is None:
+        stats["capped"] += 1
+        return f"{sql[:pos]} TOP ({max_rows}){sql[pos:]}"
+    if top.group(4):  # PERCENT / WITH TIES: leave it to the fetch cap
+        stats["uncapped"] += 1
+        return sql
+    if int(top.group(2) or top.group(3)) <= max_rows:
+        return sql
+    stats["capped"] += 1
+    return f"{sql[:pos]} TOP ({max_rows}){sql[top.end(1):]}"
+
+
+def prepare(sql: str, max_rows: int) -> str:
+    """check() then cap_rows(); the statement that is actually executed."""
+    return cap_rows(check(sql), max_rows)
+
+
+def is_timeout(error: Exception) -> bool:
+    args = getattr(error, "args", ())
+    return bool(args) and args[0] in _TIMEOUT_STATES or "timeout expired" in str(error).lower()
+
+
+class QueryGuard:
+    """
+    Lets the event loop cancel a statement running on a DB thread.
+
+    run_sql attaches its cursor; ``cancel()`` (from any thread) asks the
+    server to stop the statement, before or after it has started.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self._cursor = None
+        self._lock = threading.Lock()
+
+    def attach(self, cursor):
+        with self._lock:
+            if self.cancelled:
+                raise QueryCancelled("Query cancelled before it started")
+            self._cursor = cursor
+
+    def detach(self):
+        with self._lock:
+            self._cursor = None
+
+    def cancel(self):
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            cursor = self._cursor
+        stats["cancelled"] += 1
+        if cursor is not None:
+            try:
+                cursor.cancel()
+            except Exception:
+                pass  # the statement finished (or the connection died) in the meantime
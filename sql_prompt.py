@@ -0,0 +1,240 @@
+"""
+Prompt assembly for step 1 (natural language → SQL).
+
+The SQL-generation prompt used to be one ~4k-token f-string carrying every
+formula and column description on every call. Here it is assembled from a
+library of sections:
+
+    PREFIX      static schema + general SQL rules — identical on every call,
+                so the provider's prompt-prefix cache can reuse it
+    RULES       metric formulas, metric columns and situational rules, each
+                included only when its trigger matches the question (or the
+                Tableau filters extracted from it)
+    date line   changes once a day, so it goes after everything static
+    question
+
+If the question names no metric at all, every metric rule is included, which
+reproduces the original prompt. SQL_PROMPT_MAX_TOKENS (estimated tokens,
+0 = unlimited) drops optional reference sections when a prompt runs over.
+"""
+import logging
+import re
+from collections import Counter
+from datetime import date, timedelta
+from typing import Optional
+
+from metrics import usage_numbers
+from sql_templates import SITE_VISIT_FLOODLIGHTS
+
+logger = logging.getLogger("app")
+
+PREFIX = """You are a data assistant. Convert this natural-language question into a safe SQL query for Microsoft SQL Server. All data is stored in two tables with the following schema:
+
+The database contains advertising campaign performance data with the following tables (table name: description):
+    v_TableauData_30Days: view with data 1-31 days old.
+    Tableau_31DaysandOlder: table with data older than 32 days and up to 25 months old.
+
+These two tables have identical columns. Relevant columns and their descriptions are outlined below (column name: description):
+    date: day.
+    Campaign: campaign category. Valid values are: 250K, EdWoW, GenNext, Investor, NA, PIC, PII. IMPORTANT: '250K' is a campaign name, not a dollar amount — never interpret it as a numeric threshold.
+    channel: media channel. Values include Connected TV, Paid Search, Article, TV, Skimms IG, Video - Pre-Roll, Display, None, Podcast, Paid Social, YouTube, Native, Video, Newsletter, Audio, DOOH.
+    FunnelStrategy: funnel strategy. Valid values are: Brand and Performance. NULL, NA, and Quarter 2 should not be queried unless specified.
+    journeyPhase: journey/funnel location. Values include Pre-Explore Awareness (aka PREA or PRE-A), None, Evaluate (aka EVA), Explore (aka EXP), Pre-Explore Familiarity (aka PREF or PRE-F).
+    Platform: Values include ABC, Amazon, Bing, Bleacher Report, CBS, CNBC, Discovery Plus, Disney, DV360, ENT, ESP2, ESPN, Facebook, FBN, FOX, FS1, GOLF, Google, HTS, Hulu, Instagram,
+        LinkedIn, Meredith, NASDAQ, Nativo, NBAT, NBC, Netflix, NGC, NPR, Pandora, Paramount, PARB, PARC, Pinterest, She Media, SiriusXM, SoundCloud, Spotify, TBS,
+        The Street Editorial, The Trade Desk, TheSkimm, TNT, TRU, USA, Vox, WSJ
+    Geography: Values include Designated Market Areas, National, High Net Worth, None, Local.
+    [Targeting Strategy]: targeting strategy.
+    [Target Audience]: target audience.
+    Publisher: BusinessInsider, Conde Nast, Discovery, Meredith, Nasdaq, Nativo, NBC, Netflix, None, Paramount, Pinterest, Roku, Sirius XM, The Trade Desk, TripleLift, USA Today, Wall Street Journal, YouTube
+    clicks: number of clicks.
+    impressions: number of impressions.
+    mediaCost: media spend/budget.
+    tablename: source table identifier. The value 'v_YouTubePaidMedia' identifies YouTube rows.
+
+Return only **valid SQL**, do not include explanations, comments, or markdown.
+Do not include any text outside the SQL query.
+Queries that reference both tables should use a UNION ALL in a subquery. You MUST include AND FunnelStrategy NOT IN ('Null', 'NA', 'Quarter 2') in the WHERE clause of EVERY inner subquery — no exceptions, even if FunnelStrategy is not selected or grouped:
+SELECT ...
+FROM (
+    SELECT ...
+    FROM v_TableauData_30Days
+    WHERE <date or other conditions> AND FunnelStrategy NOT IN ('Null', 'NA', 'Quarter 2')
+    UNION ALL
+    SELECT ...
+    FROM Tableau_31DaysandOlder
+    WHERE <date or other conditions> AND FunnelStrategy NOT IN ('Null', 'NA', 'Quarter 2')
+) AS CombinedData
+Acronyms: CPC = Cost Per Click, CPL = Cost Per Lead, CTR = Click-Through Rate (clicks / impressions), CPEV = Cost Per Engaged Visit, CPM = Cost Per Mille (Cost per 1000 Impressions), CPSV = Cost Per Site Visit, CPCV = Cost Per Completed View, VCR = Video Completion Rate (also called Audio Completion Rate for audio placements — same formula), EV = Engaged Visits, TTD = The Trade Desk. CPV = Cost Per View = CPCV.
+INTERVAL should not be used for date ranges (it is not valid SQL); use DATEADD and DATEDIFF functions instead.
+Integers cannot be added to dates in SQL code like: WHERE date < '2025-01-01' + 365; use DATEADD and DATEDIFF functions instead.
+When a user asks about a specific brand, network, or service by name (e.g., ESPN, CNBC, Pandora, Spotify, Disney, Hulu, Netflix, Instagram, Nativo, SiriusXM, YouTube, Facebook, Roku, LinkedIn, Pinterest, Bloomberg, NBC, ABC, CBS, FOX, Amazon), always filter by the Platform or Publisher column — NEVER by channel. The channel column only contains broad media types: Connected TV, Paid Search, Paid Social, Display, Video, Audio, TV, Podcast, Native, Article, Newsletter, DOOH.
+Column names that contain spaces must be wrapped in square brackets, e.g., [Engaged Visits], [Keyword Type], [Budget Source].
+Unless the user specifically asks about FunnelStrategy 'Null', 'NA', or 'Quarter 2', always exclude those rows by default using WHERE FunnelStrategy NOT IN ('Null', 'NA', 'Quarter 2').
+When the user asks to see results 'by [dimension]' (e.g., 'by Journey Phase', 'by Platform', 'by month', 'by Channel'), always include that dimension in both SELECT and GROUP BY. For 'by month', use FORMAT(date, 'yyyy-MM') AS Month in SELECT and GROUP BY, ordered by Month. When asked for 'top N per month' (e.g., 'top 3 platforms by month'), use a CTE to compute monthly totals per dimension, then apply ROW_NUMBER() OVER (PARTITION BY Month ORDER BY metric DESC) and filter WHERE rn <= N in the outer SELECT.
+When the user specifies a channel type (e.g., 'Paid Social platform', 'Display publisher', 'Connected TV placement'), filter by channel = 'channel_value' (e.g., WHERE channel = 'Paid Social') — never match channel type names against the Platform or Publisher columns. The channel column holds broad media types; Platform and Publisher hold specific vendor/network names within a channel.
+When filtering Publisher or Platform by a name that may have variants (e.g., 'Hulu' could match 'Hulu', 'Hulu Slate', 'Hulu DSE'), use LIKE '%name%' in the WHERE clause to include all variants.
+Direction rules — always apply ORDER BY and TOP N to return only what the user asked for:
+  - For volume metrics (impressions, clicks, leads, site visits, engaged visits): "highest/most/top" = ORDER BY metric DESC; "lowest/fewest/least" = ORDER BY metric ASC.
+  - For cost-efficiency metrics (CPM, CPC, CPL, CPSV, CPEV, CPCV): LOWER values are better. "lowest/cheapest/most efficient/best" = ORDER BY metric ASC; "highest/most expensive/worst" = ORDER BY metric DESC.
+  - Use SELECT TOP 1 when asking for a single winner; TOP N when the user specifies a count (e.g., "top 3").
+When querying any metric over a time period (month, quarter, year), always use a date range with >= and < (e.g., date >= '2025-10-01' AND date < '2025-11-01'). Never use a single date equality filter (WHERE date = 'YYYY-MM-DD') unless the user explicitly asks about a specific single day.
+"""
+
+_FLOODLIGHT_LIST = ",\n".join(f"        '{name}'" for name in SITE_VISIT_FLOODLIGHTS)
+_VIDEO_VIEWS = ("COALESCE(SUM(videoViews),0) + COALESCE(SUM(VideoPlays),0) + COALESCE(SUM(CASE WHEN tablename='v_YouTubePaidMedia' "
+                "AND (mediaBuyName LIKE '%NonSkippable%' OR mediaBuyName LIKE '%Bumper%') THEN impressions ELSE 0 END),0)")
+
+# --- Rule library ---
+# (name, trigger, text), in prompt order. A rule is included when its trigger
+# matches the lower-cased question; "filters" names Tableau filter fields that
+# also pull it in. Rules in METRIC_RULES are the ones a metric-less question
+# falls back to; OPTIONAL rules are reference material the budget may drop.
+RULES = (
+    ("site_visits",
+     r"\bsite visits?\b|\bvisits?\b|\bcpsv\b|\bcost per site visit\b|\bconversions?\b|\bfloodlights?\b",
+     f"""Site visit columns:
+    siteVisits: direct site visits recorded at the placement level.
+    TotalConversions: conversion count used for CM Floodlight and LinkedIn-sourced site visits.
+    ConversionTagName: name of the conversion tag. Rows where this field matches specific CM Floodlight tag names represent additional site visits.
+    Site Visits (combined, matches Tableau dashboard): ALWAYS use this formula — never use siteVisits alone — when the user asks about site visits or CPSV:
+        ISNULL(SUM(siteVisits), 0)
+        + ISNULL(SUM(CASE WHEN ConversionTagName IN (
+{_FLOODLIGHT_LIST}
+        ) THEN TotalConversions ELSE 0 END), 0)
+        + ISNULL(SUM(CASE WHEN tablename = 'v_LinkedInCampaign' THEN TotalConversions ELSE 0 END), 0)
+For CPSV (Cost Per Site Visit) and any site visit count, NEVER use SUM(siteVisits) alone — always use the combined Site Visits formula above. CPSV = SUM(mediaCost) / NULLIF(<combined site visits>, 0).
+"""),
+    ("engaged_visits",
+     r"\bengaged\b|\bcp ?evs?\b|\bevs?\b",
+     """Engaged visit columns:
+    [Engaged Visits]: engaged visits. IMPORTANT: this column name contains a space and MUST always be referenced as [Engaged Visits] in SQL.
+For CP EV / CPEV calculations, use: SUM(mediaCost) / NULLIF(SUM([Engaged Visits]), 0). Note: [Engaged Visits] must always be in square brackets.
+"""),
+    ("video",
+     r"\bvideos?\b|\bvcr\b|\bcpcv\b|\bcpv\b|\bviews?\b|\bplays?\b|\bcomplet|\bcost per view\b",
+     f"""Video columns:
+    videoFullyPlayed: videos played completely, 100%. Frequently referred to as "Video Completes".
+    videoViews: video view count for non-YouTube platforms.
+    VideoPlays: video play/start count, primarily for YouTube and other platforms.
+    mediaBuyName: name of the media buy/placement.
+    Video Views (calculated): The correct formula for "Video Views" matches the Tableau dashboard and MUST be used whenever the user asks for video views, video plays, or any metric whose denominator is video views (VCR, CPCV). Formula: {_VIDEO_VIEWS}
+For CPCV (Cost Per Completed View) calculations, use: SUM(mediaCost) / NULLIF(SUM(videoFullyPlayed), 0).
+For VCR (Video Completion Rate) calculations, use: SUM(videoFullyPlayed) / NULLIF(<Video Views formula>, 0) where <Video Views formula> = {_VIDEO_VIEWS}.
+"""),
+    ("cpc",
+     r"\bcpcv?\b|\bcost per click\b",
+     """For CPC (Cost Per Click) calculations, use: SUM(mediaCost) / NULLIF(SUM(clicks), 0). IMPORTANT: CPC (Cost Per Click) is completely different from CPCV (Cost Per Completed View) — never use videoFullyPlayed for CPC.
+"""),
+    ("cpm",
+     r"\bcpms?\b|\bcost per (?:mille|thousand)\b",
+     """For CPM calculations, use the weighted average formula: SUM(mediaCost) * 1000.0 / NULLIF(SUM(impressions), 0). Do NOT add a WHERE impressions > 0 filter — non-impression channels (Audio, Podcast, Paid Search) have impressions = 0 and their spend must still be included in the mediaCost numerator. NULLIF handles division by zero.
+"""),
+    ("leads",
+     r"\bleads?\b|\bcpl\b|\bcp lead\b|\bcost per lead\b",
+     """Lead columns:
+    Leads: leads (applies only to pinterest data).
+For CPL / CP Lead (Cost Per Lead) calculations, use: SUM(mediaCost) / NULLIF(SUM(Leads), 0).
+"""),
+    ("calls",
+     r"\bcalls?\b|\bcallcount\b",
+     """Call columns:
+    callcount: number of calls.
+    CallCount: number of calls (Google only).
+"""),
+    ("viewability",
+     r"\bviewab",
+     """Viewability: calculated as SUM([Viewable Impressions]) / SUM([Measured Impressions]). Use this formula directly when asked for viewability — do not use these two columns for anything else.
+"""),
+    ("targeting",
+     r"\btargeting\b|\btargeted\b|\bretargeting\b|\blookalike\b|\bcontextual\b|\baffinity\b|\bin market\b|\bcustom intent\b|\brecency\b|\bsite list\b",
+     """[Targeting Strategy] values include Hyper Local Targeting, 1st Party Audience Data, Demographic Targeting Only, Google Custom Intent, Recency RTG, Retargeting Targeting, Lookalike Modeling,
+    Topic Targeting, Google Custom Affinity, Specific Site List, Google In Market, Keyword Contextual, Run of Site Targeting, Video Retargeting, Multiple Targeting Methods, Google Affinity Data,
+    None, Run of Network Targeting, Behavioral Targeting, Website Retargeting, Contextual Targeting.
+"""),
+    ("journey_phase",
+     r"\bjourney\b|\bphases?\b|\bpre-explore\b|\bexplore\b|\bevaluate\b|\bfunnel\b",
+     """When grouping or filtering by Journey Phase (journeyPhase), always exclude rows where journeyPhase = 'None'.
+When ordering results by Journey Phase, always use this order via a CASE expression in ORDER BY: Pre-Explore Awareness = 1, Pre-Explore Familiarity = 2, Explore = 3, Evaluate = 4.
+"""),
+    ("period_comparison",
+     r"\bvs\b|\bversus\b|\bcompar|\bchange|\bgrowth\b|\bgrew\b|\bincrease|\bdecrease|\bdeclin|\bdrop|\bdifference\b|\btrend|\bover\b|\bmom\b|\byoy\b",
+     """For period-over-period comparisons (month-over-month, year-over-year, or any "change from X to Y"): compute both periods in a single query using conditional aggregation with CASE WHEN inside a CTE, then calculate the difference in the outer SELECT. For simple metrics: SUM(CASE WHEN date >= 'A_start' AND date < 'A_end' THEN column ELSE 0 END) AS period_A. For weighted-average metrics like CPM, compute numerator and denominator separately per period: SUM(CASE WHEN period_A THEN mediaCost ELSE 0 END)*1000.0/NULLIF(SUM(CASE WHEN period_A THEN impressions ELSE 0 END),0) AS CPM_A. Percent change: (metric_B - metric_A) / NULLIF(metric_A, 0) * 100. Always label columns clearly (e.g., CPM_March, CPM_April, CPM_Change, CPM_PctChange).
+"""),
+)
+METRIC_RULES = {"site_visits", "engaged_visits", "video", "cpc", "cpm", "leads", "calls", "viewability"}
+OPTIONAL = {"targeting"}
+FILTER_RULES = {"Journey Phase": "journey_phase", "Targeting Strategy": "targeting"}
+
+# Metrics fully described by PREFIX; naming one of these is enough to skip the fallback
+_BASE_METRICS = re.compile(r"\bclicks?\b|\bimpressions?\b|\bctr\b|\bclick[- ]through\b|\bspend\b|\bspent\b|\bmedia ?cost\b|\bbudget\b")
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token for English + SQL)."""
+    return (len(text) + 3) // 4
+
+
+_TRIGGERS = [(name, re.compile(trigger)) for name, trigger, _ in RULES]
+_TEXT = {name: text for name, _, text in RULES}
+_TOKENS = {name: estimate_tokens(text) for name, text in _TEXT.items()}
+PREFIX_TOKENS = estimate_tokens(PREFIX)
+
+stats = {"prompts": 0, "estimated_tokens": 0, "dropped": 0, "completions": 0,
+         "prompt_tokens": 0, "cached_tokens": 0, "uncached_tokens": 0, "completion_tokens": 0}
+section_counts = Counter()
+
+
+def select_rules(question: str, filters: Optional[dict] = None) -> list:
+    """Names of the rules relevant to ``question``, in prompt order."""
+    text = question.lower()
+    selected = {name for name, trigger in _TRIGGERS if trigger.search(text)}
+    for field in filters or ():
+        if field in FILTER_RULES:
+            selected.add(FILTER_RULES[field])
+    if not selected & METRIC_RULES and not _BASE_METRICS.search(text):
+        selected |= METRIC_RULES  # no metric named: keep every formula, as the full prompt did
+    return [name for name, _, _ in RULES if name in selected]
+
+
+def date_line(today: date) -> str:
+    yesterday = today - timedelta(days=1)
+    return (f"Today's date is {today.strftime('%B %d, %Y')}. There is a 1 day lag in data availability — the most recent data "
+            f"in the database is for {yesterday.strftime('%B %d, %Y')}. Use today's date to resolve any ambiguous time references "
+            f"(e.g., \"this month\", \"since January\", \"last quarter\", bare month names with no year).\n")
+
+
+def build_sql_prompt(user_query: str, filters: Optional[dict] = None, today: date = None,
+                     max_tokens: int = 0) -> str:
+    """Static prefix, then the relevant rules, then the date line and the question."""
+    names = select_rules(user_query, filters)
+    tail = date_line(today or date.today()) + f"\nUser question: {user_query}\n"
+    total = PREFIX_TOKENS + sum(_TOKENS[n] for n in names) + estimate_tokens(tail)
+    if max_tokens and total > max_tokens:
+        for name in reversed(names):
+            if name in OPTIONAL and total > max_tokens:
+                names.remove(name)
+                total -= _TOKENS[name]
+                stats["dropped"] += 1
+        if total > max_tokens:
+            logger.warning(f"⚠️ SQL prompt ~{total} tokens is over SQL_PROMPT_MAX_TOKENS={max_tokens}")
+
+    stats["prompts"] += 1
+    stats["estimated_tokens"] += total
+    section_counts.update(names)
+    return PREFIX + "\n" + "".join(_TEXT[n] for n in names) + tail
+
+
+def record_usage(usage) -> dict:
+    """Add one completion's ``usage`` to the counters; returns this call's numbers."""
+    call = usage_numbers(usage)
+    if not call:
+        return call
+    stats["completions"] += 1
+    for key, value in call.items():
+        stats[key] += value
+    return call
+
+
+def get_stats() -> dict:
+    return {**stats, "prefix_tokens": PREFIX_TOKENS, "sections": dict(section_counts)}
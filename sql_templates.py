@@ -0,0 +1,346 @@
+"""
+Deterministic SQL for common question shapes.
+
+Most questions are "<metric(s)> [by <dimension>] [for <channel/phase/campaign>]
+[<date range>]", optionally with "top N"/"highest"/"lowest". For those we
+compile the UNION ALL query directly from the metric registry below (the same
+formulas the SQL-generation prompt describes in prose) instead of asking the
+LLM. The recognizer is deliberately strict: any word it does not understand
+makes ``compile_question`` return None and the caller falls back to the LLM.
+"""
+import re
+from datetime import date, timedelta
+from typing import Optional
+
+SOURCES = ("v_TableauData_30Days", "Tableau_31DaysandOlder")
+FUNNEL_EXCLUSION = "FunnelStrategy NOT IN ('Null', 'NA', 'Quarter 2')"
+
+SITE_VISIT_FLOODLIGHTS = (
+    'Floodlight - ACC - EJ Investor All Pages',
+    'ejgen : Floodlight - ACC - EJ Investor All Pages: Paid Search Actions',
+    'Floodlight - ACC - Match Tool - Landing Page',
+    'Floodlight - ACC - Starting Point - Homepage',
+    'MatchTool : Floodlight - ACC - Match Tool - Landing Page: Paid Search Actions',
+    'Startp002 : Floodlight - ACC - Starting Point - Homepage: Paid Search Actions',
+    'FLOODLIGHT_ACC_EJ_INVESTOR_ALL_PAGES',
+    'FLOODLIGHT_ACC_MATCH_TOOL_LANDING_PAGE',
+    'FLOODLIGHT_ACC_STARTING_POINT_HOMEPAGE',
+    'EJGEN_FLOODLIGHT_ACC_EJ_INVESTOR_ALL_PAGES_PAID_SEARCH_ACTIONS',
+    'MATCHTOOL_FLOODLIGHT_ACC_MATCH_TOOL_LANDING_PAGE_PAID_SEARCH_ACTIONS',
+    'STARTP002_FLOODLIGHT_ACC_STARTING_POINT_HOMEPAGE_PAID_SEARCH_ACTIONS',
+)
+
+# Combined Site Visits (matches the Tableau dashboard) — never SUM(siteVisits) alone
+SITE_VISITS_SQL = (
+    "(ISNULL(SUM(siteVisits), 0)"
+    " + ISNULL(SUM(CASE WHEN ConversionTagName IN ("
+    + ", ".join(f"'{name}'" for name in SITE_VISIT_FLOODLIGHTS)
+    + ") THEN TotalConversions ELSE 0 END), 0)"
+    " + ISNULL(SUM(CASE WHEN tablename = 'v_LinkedInCampaign' THEN TotalConversions ELSE 0 END), 0))"
+)
+SITE_VISITS_COLUMNS = ("siteVisits", "ConversionTagName", "TotalConversions", "tablename")
+
+# Video Views (matches the Tableau dashboard)
+VIDEO_VIEWS_SQL = (
+    "(COALESCE(SUM(videoViews), 0) + COALESCE(SUM(VideoPlays), 0)"
+    " + COALESCE(SUM(CASE WHEN tablename = 'v_YouTubePaidMedia' AND (mediaBuyName LIKE '%NonSkippable%'"
+    " OR mediaBuyName LIKE '%Bumper%') THEN impressions ELSE 0 END), 0))"
+)
+VIDEO_VIEWS_COLUMNS = ("videoViews", "VideoPlays", "tablename", "mediaBuyName", "impressions")
+
+# --- Metric registry ---
+# Checked in order; each match is blanked out of the question before the next
+# pattern runs, so "cost per click" is not also read as "clicks".
+#   kind: "cost" (lower is better), "volume" or "rate" (higher is better)
+METRICS = {
+    "CPCV": {"pattern": r"\bcpcv\b|\bcpv\b|\bcost per (?:completed )?view\b", "kind": "cost",
+             "sql": "SUM(mediaCost) / NULLIF(SUM(videoFullyPlayed), 0)", "columns": ("mediaCost", "videoFullyPlayed")},
+    "CPC": {"pattern": r"\bcpc\b|\bcost per click\b", "kind": "cost",
+            "sql": "SUM(mediaCost) / NULLIF(SUM(clicks), 0)", "columns": ("mediaCost", "clicks")},
+    "CPM": {"pattern": r"\bcpm\b|\bcost per (?:mille|thousand(?: impressions)?)\b", "kind": "cost",
+            "sql": "SUM(mediaCost) * 1000.0 / NULLIF(SUM(impressions), 0)", "columns": ("mediaCost", "impressions")},
+    "CPL": {"pattern": r"\bcpl\b|\bcp lead\b|\bcost per lead\b", "kind": "cost",
+            "sql": "SUM(mediaCost) / NULLIF(SUM(Leads), 0)", "columns": ("mediaCost", "Leads")},
+    "CPSV": {"pattern": r"\bcpsv\b|\bcost per site visit\b", "kind": "cost",
+             "sql": f"SUM(mediaCost) / NULLIF({SITE_VISITS_SQL}, 0)", "columns": ("mediaCost",) + SITE_VISITS_COLUMNS},
+    "CPEV": {"pattern": r"\bcp ?ev\b|\bcost per engaged visit\b", "kind": "cost",
+             "sql": "SUM(mediaCost) / NULLIF(SUM([Engaged Visits]), 0)", "columns": ("mediaCost", "[Engaged Visits]")},
+    "CTR": {"pattern": r"\bctr\b|\bclick[- ]through rate\b", "kind": "rate",
+            "sql": "SUM(clicks) * 1.0 / NULLIF(SUM(impressions), 0)", "columns": ("clicks", "impressions")},
+    "VCR": {"pattern": r"\bvcr\b|\b(?:video|audio) completion rate\b", "kind": "rate",
+            "sql": f"SUM(videoFullyPlayed) * 1.0 / NULLIF({VIDEO_VIEWS_SQL}, 0)",
+            "columns": ("videoFullyPlayed",) + VIDEO_VIEWS_COLUMNS},
+    "Viewability": {"pattern": r"\bviewability\b", "kind": "rate",
+                    "sql": "SUM([Viewable Impressions]) * 1.0 / NULLIF(SUM([Measured Impressions]), 0)",
+                    "columns": ("[Viewable Impressions]", "[Measured Impressions]")},
+    "VideoCompletes": {"pattern": r"\bvideo completes?\b|\bcompleted views\b|\bvideos? fully played\b", "kind": "volume",
+                       "sql": "SUM(videoFullyPlayed)", "columns": ("videoFullyPlayed",)},
+    "VideoViews": {"pattern": r"\bvideo (?:views|plays)\b", "kind": "volume",
+                   "sql": VIDEO_VIEWS_SQL, "columns": VIDEO_VIEWS_COLUMNS},
+    "SiteVisits": {"pattern": r"\bsite visits?\b", "kind": "volume",
+                   "sql": SITE_VISITS_SQL, "columns": SITE_VISITS_COLUMNS},
+    "EngagedVisits": {"pattern": r"\bengaged visits?\b", "kind": "volume",
+                      "sql": "SUM([Engaged Visits])", "columns": ("[Engaged Visits]",)},
+    "Impressions": {"pattern": r"\bimpressions\b", "kind": "volume",
+                    "sql": "SUM(impressions)", "columns": ("impressions",)},
+    "Clicks": {"pattern": r"\bclicks\b", "kind": "volume",
+               "sql": "SUM(clicks)", "columns": ("clicks",)},
+    "Leads": {"pattern": r"\bleads\b", "kind": "volume",
+              "sql": "SUM(Leads)", "columns": ("Leads",)},
+    "Conversions": {"pattern": r"\b(?:total )?conversions\b", "kind": "volume",
+                    "sql": "SUM(TotalConversions)", "columns": ("TotalConversions",)},
+    "MediaCost": {"pattern": r"\bmedia ?cost\b|\bmedia spend\b|\bspend\b|\bspent\b", "kind": "volume",
+                  "sql": "SUM(mediaCost)", "columns": ("mediaCost",)},
+}
+
+# --- Dimensions ("by X") ---
+DIMENSIONS = {
+    "Platform": {"pattern": r"\bplatforms?\b", "select": "Platform", "columns": ("Platform",)},
+    "Publisher": {"pattern": r"\bpublishers?\b", "select": "Publisher", "columns": ("Publisher",)},
+    "Channel": {"pattern": r"\bchannels?\b", "select": "channel", "columns": ("channel",)},
+    "Journey Phase": {"pattern": r"\bjourney phases?\b|\bphases?\b", "select": "journeyPhase", "columns": ("journeyPhase",)},
+    "Campaign Category": {"pattern": r"\bcampaigns?\b", "select": "Campaign", "columns": ("Campaign",)},
+    "FunnelStrategy": {"pattern": r"\bfunnel strateg(?:y|ies)\b", "select": "FunnelStrategy", "columns": ("FunnelStrategy",)},
+    "Month": {"pattern": r"\bmonthly\b|\b(?:by|per|each) month\b", "select": "FORMAT(date, 'yyyy-MM') AS Month",
+              "group": "FORMAT(date, 'yyyy-MM')", "order": "Month", "columns": ("date",)},
+    "Day": {"pattern": r"\bdaily\b|\b(?:by|per|each) day\b", "select": "date AS Day",
+            "group": "date", "order": "Day", "columns": ("date",)},
+}
+
+# Filters from extract_filters_from_query that map cleanly onto one column.
+# Any other filter field (Publisher/Platform variants, Branded, Geography, ...)
+# needs the LLM's judgement, so its presence disables the fast path.
+FILTER_COLUMNS = {"Channel": "channel", "Journey Phase": "journeyPhase", "Campaign Category": "Campaign"}
+IGNORED_FILTERS = {"date", "Date Granularity", "Measure Names"}
+
+JOURNEY_ORDER = ("CASE journeyPhase WHEN 'Pre-Explore Awareness' THEN 1 WHEN 'Pre-Explore Familiarity' THEN 2 "
+                 "WHEN 'Explore' THEN 3 WHEN 'Evaluate' THEN 4 ELSE 5 END")
+
+ORDER_WORDS = {
+    "top": "high", "highest": "high", "most": "high", "biggest": "high", "largest": "high",
+    "lowest": "low", "least": "low", "fewest": "low", "smallest": "low", "cheapest": "low", "bottom": "low",
+    "best": "best", "worst": "worst",
+}
+
+FILLER = {
+    "what", "whats", "s", "was", "were", "is", "are", "be", "been", "the", "a", "an", "our", "my", "me", "us",
+    "show", "give", "get", "tell", "list", "see", "for", "in", "on", "of", "during", "total", "overall",
+    "all", "by", "per", "and", "each", "across", "from", "to", "between", "through", "with", "did", "do",
+    "does", "we", "have", "has", "had", "how", "much", "many", "which", "performance", "breakdown",
+    "broken", "down", "split", "please", "at", "metrics", "numbers", "can", "you", "i", "it",
+    "drove", "drive", "generated", "generate", "delivered", "deliver", "got",
+}
+
+_MONTH = r"(?:january|february|march|april|may|june|july|august|september|october|november|december)"
+
+# Date phrases understood by parse_date_from_query, most specific first. Each
+# counts as one phrase; a question may contain at most one.
+_DATE_PHRASES = [re.compile(p) for p in (
+    r"\b\d{1,2}/\d{1,2}/\d{2,4}\s*-+\s*\d{1,2}/\d{1,2}/\d{2,4}\b",
+    rf"\b{_MONTH}\s+\d{{1,2}}\s*-+\s*\d{{1,2}},?\s+20\d{{2}}\b",
+    rf"\b{_MONTH}\s+\d{{1,2}}(?:,?\s+20\d{{2}})?\s*-+\s*{_MONTH}\s+\d{{1,2}},?\s+20\d{{2}}\b",
+    rf"\b{_MONTH}(?:\s+20\d{{2}})?\s+(?:and|through|to|-)\s+{_MONTH}(?:\s+20\d{{2}})?\b",
+    rf"\b{_MONTH}\s+20\d{{2}}\b",
+    r"\b(?:q[1-4]|quarter\s+[1-4])\s+20\d{2}\b",
+    r"\blast month\b|\blast quarter\b|\bytd\b|\byear to date\b",
+    rf"\b{_MONTH}\b",
+    r"\b20\d{2}\b",
+)]
+
+_MONTH_NAME = re.compile(_MONTH)
+_MONTH_NUMBERS = {name: i for i, name in enumerate(
+    ("january", "february", "march", "april", "may", "june", "july", "august", "september", "october",
+     "november", "december"), 1)}
+
+# Time groupings we don't template; without this they'd be eaten as date words.
+_UNSUPPORTED = re.compile(r"\b(?:by|per|each)\s+(?:week|quarter|year)\b|\b(?:weekly|quarterly|yearly|annual)\b")
+
+_METRIC_PATTERNS = {name: re.compile(m["pattern"]) for name, m in METRICS.items()}
+_DIMENSION_PATTERNS = {name: re.compile(d["pattern"]) for name, d in DIMENSIONS.items()}
+
+stats = {"compiled": 0, "fallbacks": 0}
+
+
+def _quote(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _fallback():
+    stats["fallbacks"] += 1
+    return None
+
+
+def compile_question(question: str, filters: dict) -> Optional[str]:
+    """
+    Return T-SQL for ``question`` if it fits a known shape, else None.
+
+    ``filters`` is the output of extract_filters_from_query for the same
+    question; its "date" entry (inclusive start/end) bounds the query.
+    """
+    plan = plan_question(question, filters)
+    return render(plan) if plan is not None else None
+
+
+def _covers(phrase: str, date_values: list) -> bool:
+    """
+    False if ``phrase`` names several months but the resolved range doesn't
+    run from the first to the last of them: without a year the date parser
+    reads "march to may" as March alone.
+    """
+    named = _MONTH_NAME.findall(phrase)
+    if len(named) < 2:
+        return True
+    resolved = (int(date_values[0][5:7]), int(date_values[-1][5:7]))
+    return resolved == (_MONTH_NUMBERS[named[0]], _MONTH_NUMBERS[named[-1]])
+
+
+def plan_question(question: str, filters: dict) -> Optional[dict]:
+    """
+    The recognized shape of ``question``, or None. Plans are plain dicts:
+
+        metrics     metric names (METRICS keys), in select order
+        dimensions  dimension names (DIMENSIONS keys), in group-by order
+        filters     {column: [values]} equality filters
+        date        [start, end] inclusive ISO dates, or None
+        order       (metric, descending) or None
+        limit       row limit or None
+
+    render() turns a plan into T-SQL; rollup.py can answer the same plan in-process.
+    """
+    text = re.sub(r"[–—]", "-", question.lower())
+    if _UNSUPPORTED.search(text):
+        return _fallback()
+
+    # --- metrics ---
+    metrics = []
+    for name, pattern in _METRIC_PATTERNS.items():
+        if pattern.search(text):
+            metrics.append(name)
+            text = pattern.sub(" ", text)
+    if not metrics:
+        return _fallback()
+
+    # --- categorical filters ---
+    where = {}
+    filtered_fields = set()
+    for field, values in filters.items():
+        if field in IGNORED_FILTERS:
+            continue
+        column = FILTER_COLUMNS.get(field)
+        if column is None:
+            return _fallback()
+        filtered_fields.add(field)
+        where[column] = list(values)
+        for value in values:
+            text = re.sub(r"\b" + re.escape(value.lower()) + r"\b", " ", text)
+
+    # --- date range ---
+    phrases = []
+    for pattern in _DATE_PHRASES:
+        phrases += [m.group(0) for m in pattern.finditer(text)]
+        text = pattern.sub(" ", text)
+    date_values = filters.get("date")
+    if len(phrases) > 1 or (phrases and not (date_values and _covers(phrases[0], date_values))):
+        return _fallback()
+
+    # --- dimensions ---
+    dimensions = []
+    singular = False
+    for name, pattern in _DIMENSION_PATTERNS.items():
+        match = pattern.search(text)
+        if not match:
+            continue
+        grouped = re.search(r"\b(?:by|per|each)\s+$", text[:match.start()]) is not None
+        # "for the Paid Social channel" names the filter, it doesn't group by it
+        if name in filtered_fields and not grouped:
+            text = pattern.sub(" ", text)
+            continue
+        dimensions.append(name)
+        # "which platform had the highest CTR" asks for a single winner
+        singular = singular or not (grouped or match.group(0).endswith("s"))
+        text = pattern.sub(" ", text)
+
+    # --- ordering ("top 3", "highest", "lowest") ---
+    limit = None
+    direction = None
+    top_n = re.search(r"\b(top|bottom)\s+(\d{1,3})\b", text)
+    if top_n:
+        limit = int(top_n.group(2))
+        text = text[:top_n.start(2)] + " " + text[top_n.end(2):]
+    for word in re.findall(r"[a-z]+", text):
+        if word in ORDER_WORDS:
+            if direction is not None and direction != ORDER_WORDS[word]:
+                return _fallback()
+            direction = ORDER_WORDS[word]
+
+    leftover = [t for t in re.findall(r"[a-z0-9]+", text) if t not in FILLER and t not in ORDER_WORDS]
+    if leftover:
+        return _fallback()
+
+    order_by = None
+    if direction:
+        kind = METRICS[metrics[0]]["kind"]
+        if not dimensions or len(metrics) > 1 or len(dimensions) > 1:
+            return _fallback()
+        if kind == "cost":
+            if top_n and top_n.group(1) == "top":
+                return _fallback()  # "top" is ambiguous for cost metrics
+            descending = direction in ("high", "worst")
+        else:
+            descending = direction in ("high", "best")
+        order_by = (metrics[0], descending)
+        if limit is None and singular:
+            limit = 1
+    elif limit is not None:
+        return _fallback()
+
+    stats["compiled"] += 1
+    return {"metrics": metrics, "dimensions": dimensions, "filters": where, "date": date_values,
+            "order": order_by, "limit": limit}
+
+
+def render(plan: dict) -> str:
+    """T-SQL for a plan from plan_question."""
+    metrics, dimensions, date_values, limit = plan["metrics"], plan["dimensions"], plan["date"], plan["limit"]
+    inner_columns = []
+    for name in dimensions:
+        inner_columns.extend(DIMENSIONS[name]["columns"])
+    for name in metrics:
+        inner_columns.extend(METRICS[name]["columns"])
+    inner_columns = list(dict.fromkeys(inner_columns))
+
+    conditions = []
+    if date_values:
+        start = date.fromisoformat(date_values[0])
+        end = date.fromisoformat(date_values[-1]) + timedelta(days=1)
+        conditions.append(f"date >= '{start}' AND date < '{end}'")
+    conditions.extend(f"{column} IN ({', '.join(_quote(v) for v in values)})" for column, values in plan["filters"].items())
+    if "Journey Phase" in dimensions or "journeyPhase" in plan["filters"]:
+        conditions.append("journeyPhase <> 'None'")
+    conditions.append(FUNNEL_EXCLUSION)
+
+    branches = "\n        UNION ALL\n".join(
+        f"        SELECT {', '.join(inner_columns)}\n"
+        f"        FROM {source}\n"
+        f"        WHERE {' AND '.join(conditions)}"
+        for source in SOURCES
+    )
+
+    select = [DIMENSIONS[name]["select"] for name in dimensions]
+    select += [f"{METRICS[name]['sql']} AS {name}" for name in metrics]
+    top = f"TOP {limit} " if limit else ""
+    sql = f"SELECT {top}{', '.join(select)}\nFROM (\n{branches}\n) AS CombinedData"
+
+    if dimensions:
+        sql += "\nGROUP BY " + ", ".join(DIMENSIONS[name].get("group", DIMENSIONS[name]["select"]) for name in dimensions)
+        order_by = f"{plan['order'][0]} {'DESC' if plan['order'][1] else 'ASC'}" if plan["order"] else None
+        if order_by is None:
+            order = []
+            for name in dimensions:
+                if name == "Journey Phase":
+                    order.append(JOURNEY_ORDER)
+                elif "order" in DIMENSIONS[name]:
+                    order.append(DIMENSIONS[name]["order"])
+            order_by = ", ".join(order) if order else f"{metrics[0]} DESC"
+        sql += f"\nORDER BY {order_by}"
+    return sql
@@ -57,5 +57,15 @@ EOF
 echo "=== [Startup] Set typing_extensions==4.12.2 pydantic==2.9.2 ==="
 pip install --upgrade --no-cache-dir typing_extensions==4.12.2 pydantic==2.9.2
 
-echo "=== [Startup] Launching FastAPI app ==="
-exec gunicorn app:app --workers 1 --bind=0.0.0.0:8000 --timeout 600 -k uvicorn.workers.UvicornWorker
+# WEB_CONCURRENCY = number of worker processes. Pools are per worker, so the
+# DB sees up to WEB_CONCURRENCY x SQL_POOL_MAX connections and Azure OpenAI up
+# to WEB_CONCURRENCY x OPENAI_MAX_CONNECTIONS; size those to match. With more
+# than one worker, caches, tokens and the rollup are shared through local disk.
+WORKERS="${WEB_CONCURRENCY:-1}"
+if [ "$WORKERS" -gt 1 ]; then
+    export SHARED_CACHE_PATH="${SHARED_CACHE_PATH:-/tmp/tableau-ai/shared-cache.sqlite}"
+    export ROLLUP_DIR="${ROLLUP_DIR:-/tmp/tableau-ai/rollup}"
+fi
+
+echo "=== [Startup] Launching FastAPI app ($WORKERS workers) ==="
+exec gunicorn app:app --workers "$WORKERS" --bind=0.0.0.0:8000 --timeout 600 -k uvicorn.workers.UvicornWorker
@@ -0,0 +1,218 @@
+"""
+Shared AAD token cache.
+
+Every Azure SQL connection and every Azure OpenAI call needs a bearer token.
+Fetching one through managed identity is an IMDS round-trip, so tokens are
+cached per scope and refreshed in the background before they expire.
+Concurrent callers that miss the cache share a single fetch per scope; with a
+shared_cache.SharedStore (several workers) that holds across processes too —
+a worker that needs a token takes it from the store, and only one process
+fetches under the store's lock.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import platform
+import threading
+import time
+
+from azure.core.credentials import AccessToken
+from azure.identity import AzureCliCredential, DefaultAzureCredential
+
+import shared_cache
+
+logger = logging.getLogger("app")
+
+SQL_SCOPE = "https://database.windows.net/.default"
+OPENAI_SCOPE = "https://cognitiveservices.azure.com/.default"
+
+
+def default_credential():
+    """
+    - Windows local: AzureCliCredential
+    - Linux / Azure App Service: DefaultAzureCredential (Managed Identity)
+    """
+    if platform.system() == "Windows":
+        return AzureCliCredential()
+    return DefaultAzureCredential()
+
+
+class TokenBroker:
+    """Per-scope token cache with single-flight fetch and proactive refresh."""
+
+    def __init__(self, credential_factory=default_credential, refresh_margin: float = 300.0, background: bool = True,
+                 shared=None):
+        self._credential_factory = credential_factory
+        self._credential = None
+        self.refresh_margin = refresh_margin
+        self.background = background
+        self.shared = shared
+
+        self._tokens = {}        # scope -> AccessToken
+        self._scope_locks = {}   # scope -> Lock (single-flight)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._refresher = None
+        self._stats = {"hits": 0, "misses": 0, "shared_hits": 0, "refreshes": 0, "refresh_failures": 0}
+
+    @property
+    def credential(self):
+        with self._lock:
+            if self._credential is None:
+                self._credential = self._credential_factory()
+            return self._credential
+
+    def _count(self, key: str):
+        with self._lock:
+            self._stats[key] += 1
+
+    def _scope_lock(self, scope: str) -> threading.Lock:
+        with self._lock:
+            return self._scope_locks.setdefault(scope, threading.Lock())
+
+    def _fresh(self, token, now: float) -> bool:
+        return token is not None and token.expires_on - now > 60
+
+    def _shared_token(self, scope: str, min_remaining: float):
+        item = self.shared.get("tokens", scope)
+        if item is None:
+            return None
+        token = AccessToken(*item[0])
+        return token if token.expires_on - time.time() > min_remaining else None
+
+    def _fetch(self, scope: str, min_remaining: float = 60):
+        """A token with more than ``min_remaining`` seconds left: another worker's if it has one, else a new one."""
+        if self.shared is None:
+            token = self.credential.get_token(scope)
+        else:
+            with self.shared.lock("token-" + hashlib.sha256(scope.encode()).hexdigest()[:16]):
+                token = self._shared_token(scope, min_remaining)
+                if token is not None:
+                    self._count("shared_hits")
+                else:
+                    token = self.credential.get_token(scope)
+                    self.shared.set("tokens", scope, tuple(token), expires_at=token.expires_on)
+        with self._lock:
+            self._tokens[scope] = token
+        self._ensure_refresher()
+        self._wake.set()
+        return token
+
+    def get_token(self, scope: str):
+        """Return a cached AccessToken for ``scope``, fetching it at most once concurrently."""
+        token = self._tokens.get(scope)
+        if self._fresh(token, time.time()):
+            self._count("hits")
+            return token
+
+        with self._scope_lock(scope):
+            # Another caller may have fetched it while we waited on the lock
+            token = self._tokens.get(scope)
+            if self._fresh(token, time.time()):
+                self._count("hits")
+                return token
+            self._count("misses")
+            return self._fetch(scope)
+
+    def peek(self, scope: str):
+        """Return the cached token string if it is still fresh, else None. Never blocks."""
+        token = self._tokens.get(scope)
+        if self._fresh(token, time.time()):
+            self._count("hits")
+            return token.token
+        return None
+
+    def async_token_provider(self, scope: str):
+        """Async variant for AsyncAzureOpenAI; a cache miss is fetched off the event loop."""
+        async def provider():
+            return self.peek(scope) or (await asyncio.to_thread(self.get_token, scope)).token
+        return provider
+
+    def token_provider(self, scope: str):
+        """Callable returning the raw token string, e.g. for ``azure_ad_token_provider``."""
+        return lambda: self.get_token(scope).token
+
+    def refresh(self, scope: str):
+        """Force a new token for ``scope`` (single-flight with get_token)."""
+        with self._scope_lock(scope):
+            try:
+                token = self._fetch(scope, min_remaining=self.refresh_margin)
+                self._count("refreshes")
+                return token
+            except Exception:
+                self._count("refresh_failures")
+                raise
+
+    # --- background refresh ---
+    def _ensure_refresher(self):
+        if not self.background or self._refresher is not None:
+            return
+        with self._lock:
+            if self._refresher is None:
+                self._refresher = threading.Thread(target=self._refresh_loop, name="token-refresher", daemon=True)
+                self._refresher.start()
+
+    def _next_due(self):
+        with self._lock:
+            items = list(self._tokens.items())
+        if not items:
+            return None, None
+        scope, token = min(items, key=lambda kv: kv[1].expires_on)
+        return scope, token.expires_on - self.refresh_margin
+
+    def _refresh_loop(self):
+        while not self._stop.is_set():
+            scope, due = self._next_due()
+            wait = 300.0 if due is None else max(0.0, due - time.time())
+            self._wake.clear()
+            if wait > 0 and self._wake.wait(wait):
+                continue  # a token changed; recompute the next due time
+            if self._stop.is_set() or scope is None:
+                continue
+            try:
+                token = self.refresh(scope)
+                if token.expires_on - self.refresh_margin <= time.time():
+                    # The identity endpoint handed back a token that is already
+                    # inside the margin; don't spin on it.
+                    self._stop.wait(30)
+            except Exception as e:
+                logger.warning(f"⚠️ Background token refresh failed for {scope}: {e}")
+                self._stop.wait(10)
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+
+    def stats(self) -> dict:
+        now = time.time()
+        with self._lock:
+            return {
+                **self._stats,
+                "scopes": {scope: int(token.expires_on - now) for scope, token in self._tokens.items()},
+            }
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker() -> TokenBroker:
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            shared = shared_cache.get_store() if os.getenv("SHARED_CACHE_TOKENS", "1") == "1" else None
+            _broker = TokenBroker(refresh_margin=float(os.getenv("TOKEN_REFRESH_MARGIN", "300")), shared=shared)
+        return _broker
+
+
+def _after_fork():
+    # The refresher thread and any credential state belong to the parent
+    global _broker, _broker_lock
+    _broker = None
+    _broker_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
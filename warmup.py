@@ -0,0 +1,97 @@
+"""
+Per-worker pre-warming and readiness.
+
+Without it a fresh worker pays for its first AAD token fetches, its first
+ODBC login and its first TLS handshake to Azure OpenAI on the first
+dashboard request — several seconds after every deploy or scale-out. The
+lifespan startup in app.py runs these steps, concurrently, before the worker
+starts serving; if they take longer than ``timeout`` it serves anyway and
+keeps warming in the background.
+
+Liveness (``/``) only says the process is up. Readiness (``/ready``) is true
+once every required step has succeeded. A failed step is retried, at most
+every ``retry_interval`` seconds, whenever readiness is asked for again, so a
+worker that started while the database was down becomes ready on its own.
+"""
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger("app")
+
+
+class Warmup:
+    def __init__(self, timeout: float = 30.0, retry_interval: float = 10.0):
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self._steps = {}    # name -> (async fn, required)
+        self._results = {}  # name -> {"ok": bool, "seconds": float, "error": str}
+        self._task = None
+        self._last_run = None
+        self._stats = {"runs": 0, "failures": 0}
+
+    def add(self, name: str, fn, required: bool = True):
+        """Register ``fn`` (a zero-arg coroutine function) as a warm-up step."""
+        self._steps[name] = (fn, required)
+
+    @property
+    def ready(self) -> bool:
+        return all(self._results.get(name, {}).get("ok") for name, (_, required) in self._steps.items() if required)
+
+    async def _step(self, name: str, fn):
+        start = time.perf_counter()
+        try:
+            await fn()
+        except Exception as e:
+            self._stats["failures"] += 1
+            self._results[name] = {"ok": False, "seconds": round(time.perf_counter() - start, 3), "error": str(e)}
+            logger.warning(f"⚠️ Warm-up step {name} failed: {e}")
+            return
+        self._results[name] = {"ok": True, "seconds": round(time.perf_counter() - start, 3)}
+
+    async def _run(self):
+        self._stats["runs"] += 1
+        start = time.perf_counter()
+        pending = [(name, fn) for name, (fn, _) in self._steps.items() if not self._results.get(name, {}).get("ok")]
+        await asyncio.gather(*(self._step(name, fn) for name, fn in pending))
+        seconds = time.perf_counter() - start
+        if self.ready:
+            logger.info(f"✅ Worker warmed up in {seconds:.2f}s: "
+                        + ", ".join(f"{name} {r['seconds']}s" for name, r in self._results.items()))
+
+    def start(self):
+        """Run the steps that haven't succeeded yet, unless a run is in progress or the last one was too recent."""
+        if not self._steps or (self._task is not None and not self._task.done()):
+            return self._task
+        if self.ready and self._results:
+            return self._task
+        if self._last_run is not None and time.monotonic() - self._last_run < self.retry_interval:
+            return self._task
+        self._last_run = time.monotonic()
+        self._task = asyncio.ensure_future(self._run())
+        return self._task
+
+    async def wait(self):
+        """Start warming and wait for it, up to ``timeout``; the run continues in the background after that."""
+        task = self.start()
+        if task is None:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(task), self.timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"⚠️ Warm-up still running after {self.timeout:.0f}s; serving cold until it finishes")
+
+    async def close(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def status(self) -> dict:
+        return {"ready": self.ready, "steps": dict(self._results)}
+
+    def stats(self) -> dict:
+        return {"ready": int(self.ready), **self._stats,
+                "seconds": {name: r["seconds"] for name, r in self._results.items()}}